@@ -1,5 +1,26 @@
 import os
-from datetime import datetime, timedelta
+import re
+import resource
+import sys
+import csv
+import json
+import abc
+import argparse
+import asyncio
+import contextlib
+import functools
+import glob
+import itertools
+import math
+import mmap
+import sqlite3
+import struct
+import multiprocessing
+import shutil
+import signal
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 from typing import Optional, Tuple
 
 import discord
@@ -7,9 +28,12 @@ from discord.ext import commands
 from discord import app_commands
 import aiosqlite
 
-from flask import Flask
+from flask import Flask, jsonify
 from threading import Thread
 
+PROCESS_STARTED_AT = time.perf_counter()  # 起動時間の計測用
+
+
 # ===================== Replit用 HTTP keep-alive =====================
 
 app = Flask(__name__)
@@ -18,6 +42,14 @@ app = Flask(__name__)
 def home():
     return "ok"  # 監視ツール用
 
+
+@app.route("/metrics")
+def metrics_route():
+    # クラスタ起動時はコーディネーターが全ワーカー分を集計して返す
+    if cluster_workers:
+        return jsonify(aggregate_cluster_metrics())
+    return jsonify(metrics)
+
 def run_web():
     app.run(host="0.0.0.0", port=8080)
 
@@ -30,16 +62,123 @@ def keep_alive():
 # ===================== Bot 設定 =====================
 
 COMMAND_PREFIX = "!"
-FACTION_CREATE_COST = 1000  # 派閥作成コスト
+FACTION_CREATE_COST = 1000  # 派閥作成コスト（ギルド設定が無い場合の既定値）
+MESSAGE_REWARD = 1  # 1メッセージあたりの報酬（既定値）
+REWARD_COOLDOWN_SECONDS = 10  # 報酬のクールダウン（既定値）
 DB_PATH = "bot.db"
 
+# "shared": 全ギルドを DB_PATH に置く（既定）
+# "partitioned": 派閥・メンバー・戦争・設定をギルドごとのファイルに分ける（users などは DB_PATH のまま）
+STORAGE_MODE = os.getenv("STORAGE_MODE", "shared")
+GUILD_DB_DIR = os.getenv("GUILD_DB_DIR", "guild_dbs")
+GUILD_DB_CACHE_SIZE = int(os.getenv("GUILD_DB_CACHE_SIZE", "64"))  # 開いたままにするギルドDBの上限
+GUILD_DB_IDLE_SECONDS = 300  # これだけ使われなかったギルドDBは閉じる
+# "sqlite"（既定） / "memory"（テスト・ベンチマーク用。ユーザー・派閥・戦争・設定をプロセス内だけに持つ）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+# get_active_war / get_faction_by_id の結果を使い回す秒数（0 なら同時に来た問い合わせをまとめるだけ）
+READ_COALESCE_TTL = float(os.getenv("READ_COALESCE_TTL", "0.5"))
+
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 intents.guilds = True
 
+# 省メモリモード: 起動時のメンバー一括取得をやめ、メンバーキャッシュも持たない。
+# 必要なメンバーはその都度 fetch し、表示名だけ小さな LRU に覚える。
+LEAN_GATEWAY = os.getenv("LEAN_GATEWAY", "0") == "1"
+MEMBER_NAME_CACHE_SIZE = 2048
+MEMBER_NAME_CACHE_TTL = 600.0  # 秒
+
+# on_message の DB 処理はキューに積んでワーカーで処理する
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000"))
+MESSAGE_WORKERS = int(os.getenv("MESSAGE_WORKERS", "4"))
+# キューが満杯のとき: block=空くまで待つ（最大 MESSAGE_QUEUE_PUT_TIMEOUT 秒、超えたら破棄）
+#                     drop_new=新しいものを捨てる / drop_oldest=一番古いものを捨てる
+MESSAGE_QUEUE_POLICY = os.getenv("MESSAGE_QUEUE_POLICY", "block")
+MESSAGE_QUEUE_PUT_TIMEOUT = 2.0
+
+# スラッシュコマンドがこの秒数以内に応答しなければ自動で defer する（Discord の期限は3秒）
+LATENCY_GUARD_SECONDS = 2.0
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+BACKUP_RETENTION = int(os.getenv("BACKUP_RETENTION", "8"))  # 残す世代数
+
+FACTION_RETENTION_DAYS = int(os.getenv("FACTION_RETENTION_DAYS", "30"))  # 解体済み派閥をアーカイブへ移すまでの日数
+WAR_RETENTION_DAYS = int(os.getenv("WAR_RETENTION_DAYS", "30"))  # 終了した戦争をアーカイブへ移すまでの日数
+RETENTION_BATCH = 200  # 1トランザクションで移す行数
+RETENTION_INTERVAL_HOURS = 1.0
+RETENTION_VACUUM_PAGES = 1000  # 1回の incremental_vacuum で解放するページ数
+
+ECONOMY_JOB_CHECK_INTERVAL = 300.0  # 実行時刻になったジョブを確認する間隔（秒）
+ECONOMY_JOB_CHUNK = 5000  # 1トランザクションで更新するユーザー数
+BULK_GRANT_CHUNK = 500  # /give_bulk で1回の executemany に渡すユーザー数
+
+DEPARTURE_FLUSH_INTERVAL = 10.0  # サーバーを抜けたメンバーをまとめて派閥から外す間隔（秒）
+DEPARTURE_QUERY_CHUNK = 500  # 1回の IN (...) に入れるユーザー数
+GUILD_PURGE_CHUNK = 1000  # ボットが外されたギルドの行を1トランザクションで消す数
+GUILD_PURGE_PAUSE = 0.05  # チャンクの間に他の書き込みへ譲る時間（秒）
+
+AUDIT_FLUSH_INTERVAL = 5.0  # 監査ログのバッファを書き出す間隔（秒）
+AUDIT_FLUSH_MAX = 500  # バッファがこの件数を超えたら即書き出す
+AUDIT_RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", "90"))  # これより古い生ログは集計に畳む
+AUDIT_COMPACT_CHUNK = 2000
+
+ACTIVITY_FLUSH_INTERVAL = 30.0  # 発言数のバッファを書き出す間隔（秒）
+ACTIVITY_FLUSH_MAX = 5000  # バッファの (ギルド, ユーザー, 日) がこの数を超えたら即書き出す
+ACTIVITY_DAILY_RETENTION_DAYS = int(os.getenv("ACTIVITY_DAILY_RETENTION_DAYS", "90"))  # 日別の行を残す日数（週別は消さない）
+ACTIVITY_STATS_PERIODS = {"day": 7, "week": 8}  # /f_stats で表示する期間数
+
+# 送信アウトボックス（チャンネルへの通知はキュー経由で送る）
+OUTBOX_CHANNEL_INTERVAL = 1.0  # 同じチャンネルへの送信間隔（秒）
+OUTBOX_GLOBAL_RATE = 20.0  # 全チャンネル合計の送信上限（件/秒）
+OUTBOX_MAX_PENDING = 50  # チャンネルごとの未送信上限（超えたら古いものから捨てる）
+OUTBOX_MAX_RETRIES = 5
+OUTBOX_SHUTDOWN_TIMEOUT = 10.0  # 終了時に未送信分を送り切るのを待つ上限（秒）
+
+# 戦争スコアボード（1つのメッセージを編集し続ける）の更新間隔（秒）
+SCOREBOARD_INTERVAL = 15.0
+
+BULK_INVITE_MAX = 200  # 一括招待の1回あたり上限人数
+BULK_ROLE_INTERVAL = 0.5  # 一括ロール付与の1件ごとの間隔（秒）
+BULK_PROGRESS_EVERY = 10  # 何件ごとに進捗メッセージを更新するか
+
 last_message_times: dict[int, datetime] = {}  # 通貨用クールダウン
 
+# ウォームリスタート用スナップショット（STORAGE_BACKEND=sqlite のときだけ使う）
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "state.snap")
+SNAPSHOT_INTERVAL = 300.0  # 定期保存の間隔（秒）
+
+# クラスタ設定（python main.py cluster で使用）
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "2"))
+CLUSTER_HEARTBEAT_INTERVAL = 5.0  # ワーカー → コーディネーターの生存通知間隔（秒）
+CLUSTER_HEARTBEAT_TIMEOUT = 60.0  # これ以上通知が無いワーカーは再起動
+CLUSTER_RESTART_BACKOFF_MAX = 60.0
+CLUSTER_STABLE_SECONDS = 600.0  # これだけ動き続けたワーカーは再起動のバックオフを最初からに戻す
+
+cluster_worker_id: Optional[int] = None  # ワーカープロセス内でのみ設定される
+cluster_status_queue = None  # ワーカー → コーディネーターの通知キュー
+
+
+# ===================== メトリクス =====================
+
+# カウンタ/ゲージの簡易レジストリ。名前が "_max" で終わるものは
+# クラスタ集計時に最大値、それ以外は合計値で集計する。
+metrics: dict[str, float] = {}
+
+
+def incr_metric(name: str, value: float = 1) -> None:
+    metrics[name] = metrics.get(name, 0) + value
+
+
+def set_metric(name: str, value: float) -> None:
+    metrics[name] = value
+
+
+def is_primary_worker() -> bool:
+    """単一プロセス起動、またはクラスタのワーカー0なら True（定期ジョブの担当）"""
+    return cluster_worker_id in (None, 0)
+
 
 # ===================== 共通: フォーラム作成ヘルパー =====================
 
@@ -74,10 +213,324 @@ async def create_forum_channel(
     )
 
 
+# ===================== 共通: レート制限を考慮したバッチ実行 =====================
+
+async def run_rate_limited_batch(
+    items: list,
+    action,
+    *,
+    interval: float = BULK_ROLE_INTERVAL,
+    max_retries: int = 3,
+    on_progress=None,
+    progress_every: int = BULK_PROGRESS_EVERY,
+) -> Tuple[list, list]:
+    """items を1件ずつ間隔をあけて action に渡す。429/5xx はバックオフして再試行する。
+
+    戻り値は (成功したもの, 失敗したもの)。
+    """
+    done, failed = [], []
+    total = len(items)
+    for i, item in enumerate(items, 1):
+        for attempt in range(max_retries + 1):
+            try:
+                await action(item)
+                done.append(item)
+                break
+            except discord.HTTPException as e:
+                retryable = e.status == 429 or e.status >= 500
+                if not retryable or attempt == max_retries:
+                    failed.append(item)
+                    break
+                retry_after = getattr(e, "retry_after", None) or 2 ** attempt
+                incr_metric("batch.retries")
+                await asyncio.sleep(retry_after)
+
+        if on_progress is not None and (i % progress_every == 0 or i == total):
+            try:
+                await on_progress(i, total)
+            except discord.HTTPException:
+                pass
+        if i < total:
+            await asyncio.sleep(interval)
+
+    incr_metric("batch.done", len(done))
+    incr_metric("batch.failed", len(failed))
+    return done, failed
+
+
+# ===================== 送信アウトボックス =====================
+
+# channel_id -> {key: (送信処理, 試行回数)}。同じ key で積み直すと未送信の古い方を置き換える。
+outbox_pending: dict[int, "OrderedDict[object, Tuple[object, int]]"] = {}
+outbox_tasks: dict[int, asyncio.Task] = {}
+outbox_next_global_slot = 0.0
+outbox_seq = itertools.count()
+
+
+def enqueue_outbound(channel_id: int, factory, coalesce_key: Optional[str] = None):
+    """送信処理（引数なしで呼ぶとコルーチンを返すもの）をチャンネルのキューに積む"""
+    pending = outbox_pending.setdefault(channel_id, OrderedDict())
+    key = coalesce_key if coalesce_key is not None else ("_", next(outbox_seq))
+    if key in pending:
+        # 未送信の同種メッセージは最新の内容で置き換える（順番はそのまま）
+        pending[key] = (factory, 0)
+        incr_metric("outbox.coalesced")
+    else:
+        pending[key] = (factory, 0)
+        while len(pending) > OUTBOX_MAX_PENDING:
+            pending.popitem(last=False)
+            incr_metric("outbox.dropped")
+
+    task = outbox_tasks.get(channel_id)
+    if task is None or task.done():
+        outbox_tasks[channel_id] = asyncio.create_task(outbox_channel_worker(channel_id))
+
+
+def outbox_send(
+    channel: discord.abc.Messageable,
+    content: Optional[str] = None,
+    *,
+    view: Optional[discord.ui.View] = None,
+    coalesce_key: Optional[str] = None,
+):
+    """channel.send をアウトボックス経由で行う（呼び出し側は待たない）"""
+    kwargs = {}
+    if view is not None:
+        kwargs["view"] = view
+    enqueue_outbound(channel.id, lambda: channel.send(content, **kwargs), coalesce_key)
+
+
+async def reserve_outbox_slot():
+    """全体の送信レートを OUTBOX_GLOBAL_RATE 以下に保つ"""
+    global outbox_next_global_slot
+    now = time.monotonic()
+    slot = max(now, outbox_next_global_slot)
+    outbox_next_global_slot = slot + 1.0 / OUTBOX_GLOBAL_RATE
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+
+async def outbox_channel_worker(channel_id: int):
+    pending = outbox_pending[channel_id]
+    last_sent = 0.0
+    while pending:
+        wait = OUTBOX_CHANNEL_INTERVAL - (time.monotonic() - last_sent)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if not pending:
+            break
+        key, (factory, attempts) = pending.popitem(last=False)
+        await reserve_outbox_slot()
+        try:
+            await factory()
+            incr_metric("outbox.sent")
+        except discord.HTTPException as e:
+            retryable = e.status == 429 or e.status >= 500
+            if retryable and attempts < OUTBOX_MAX_RETRIES:
+                # 待っている間に新しい版が積まれていなければ先頭に戻して再送する
+                if key not in pending:
+                    pending[key] = (factory, attempts + 1)
+                    pending.move_to_end(key, last=False)
+                incr_metric("outbox.retries")
+                await asyncio.sleep(getattr(e, "retry_after", None) or 2 ** attempts)
+            else:
+                incr_metric("outbox.failed")
+                print(f"Outbox send to {channel_id} failed: {e}")
+        except Exception as e:
+            incr_metric("outbox.failed")
+            print(f"Outbox send to {channel_id} failed: {e}")
+        last_sent = time.monotonic()
+        set_metric("outbox.pending", sum(len(p) for p in outbox_pending.values()))
+
+    outbox_pending.pop(channel_id, None)
+    outbox_tasks.pop(channel_id, None)
+
+
 # ===================== DB 初期化 =====================
 
+SCHEMA_VERSION = 2
+
+# 発言数の集計テーブル（窓 -> 種類 -> テーブル名）
+ACTIVITY_TABLES = {
+    "day": {"user": "activity_user_daily", "faction": "activity_faction_daily"},
+    "week": {"user": "activity_user_weekly", "faction": "activity_faction_weekly"},
+}
+
+async def init_guild_schema(db: aiosqlite.Connection):
+    """ギルド単位のテーブル（派閥・メンバー・戦争・設定・アーカイブ）を作る。commit は呼び出し側。"""
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS factions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            leader_id INTEGER NOT NULL,
+            base_role_id INTEGER NOT NULL,
+            leader_role_id INTEGER NOT NULL,
+            officer_role_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            forum_channel_id INTEGER NOT NULL,
+            chat_channel_id INTEGER NOT NULL,
+            vc_channel_id INTEGER NOT NULL,
+            listen_vc_channel_id INTEGER NOT NULL,
+            control_panel_channel_id INTEGER NOT NULL,
+            destroyed INTEGER NOT NULL DEFAULT 0,
+            is_open INTEGER NOT NULL DEFAULT 0,
+            destroyed_at INTEGER
+        );
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS faction_members (
+            user_id INTEGER NOT NULL,
+            faction_id INTEGER NOT NULL,
+            role TEXT NOT NULL, -- 'leader' / 'officer' / 'member'
+            PRIMARY KEY (user_id, faction_id)
+        );
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS wars (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            attacker_faction_id INTEGER NOT NULL,
+            defender_faction_id INTEGER NOT NULL,
+            active INTEGER NOT NULL DEFAULT 1,
+            attacker_messages INTEGER NOT NULL DEFAULT 0,
+            defender_messages INTEGER NOT NULL DEFAULT 0,
+            ended_at INTEGER,
+            scoreboard_channel_id INTEGER,
+            scoreboard_message_id INTEGER
+        );
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS guild_settings (
+            guild_id INTEGER PRIMARY KEY,
+            war_status_channel_id INTEGER,
+            faction_create_cost INTEGER,
+            message_reward INTEGER,
+            reward_cooldown_seconds INTEGER
+        );
+        """
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_faction_members_faction ON faction_members (faction_id);"
+    )
+    # 既存DBに is_open が無い場合だけ追加
+    try:
+        await db.execute(
+            "ALTER TABLE factions ADD COLUMN is_open INTEGER NOT NULL DEFAULT 0;"
+        )
+    except Exception:
+        pass
+    # 既存DBに後から増えた列が無い場合だけ追加
+    for alter_sql in (
+        "ALTER TABLE factions ADD COLUMN destroyed_at INTEGER;",
+        "ALTER TABLE wars ADD COLUMN ended_at INTEGER;",
+        "ALTER TABLE wars ADD COLUMN scoreboard_channel_id INTEGER;",
+        "ALTER TABLE wars ADD COLUMN scoreboard_message_id INTEGER;",
+        "ALTER TABLE wars_archive ADD COLUMN scoreboard_channel_id INTEGER;",
+        "ALTER TABLE wars_archive ADD COLUMN scoreboard_message_id INTEGER;",
+        "ALTER TABLE guild_settings ADD COLUMN faction_create_cost INTEGER;",
+        "ALTER TABLE guild_settings ADD COLUMN message_reward INTEGER;",
+        "ALTER TABLE guild_settings ADD COLUMN reward_cooldown_seconds INTEGER;",
+    ):
+        try:
+            await db.execute(alter_sql)
+        except Exception:
+            pass
+
+    # 生きている行だけを対象にした部分インデックス
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_factions_live ON factions (guild_id, name) WHERE destroyed = 0;"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_wars_active ON wars (guild_id) WHERE active = 1;"
+    )
+
+    # アーカイブ（解体済み派閥・終了した戦争の移動先）
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS factions_archive (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            leader_id INTEGER NOT NULL,
+            base_role_id INTEGER NOT NULL,
+            leader_role_id INTEGER NOT NULL,
+            officer_role_id INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            forum_channel_id INTEGER NOT NULL,
+            chat_channel_id INTEGER NOT NULL,
+            vc_channel_id INTEGER NOT NULL,
+            listen_vc_channel_id INTEGER NOT NULL,
+            control_panel_channel_id INTEGER NOT NULL,
+            destroyed INTEGER NOT NULL,
+            is_open INTEGER NOT NULL,
+            destroyed_at INTEGER,
+            archived_at INTEGER NOT NULL
+        );
+        """
+    )
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS wars_archive (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            attacker_faction_id INTEGER NOT NULL,
+            defender_faction_id INTEGER NOT NULL,
+            active INTEGER NOT NULL,
+            attacker_messages INTEGER NOT NULL,
+            defender_messages INTEGER NOT NULL,
+            ended_at INTEGER,
+            scoreboard_channel_id INTEGER,
+            scoreboard_message_id INTEGER,
+            archived_at INTEGER NOT NULL
+        );
+        """
+    )
+
+    # 発言数の集計（bucket は日別なら その日、週別なら週の月曜日の YYYY-MM-DD）
+    # 主キーとインデックスに messages まで含め、/f_stats の集計は表を読まずに済ませる
+    for table in ACTIVITY_TABLES.values():
+        await db.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table["user"]} (
+                guild_id INTEGER NOT NULL,
+                bucket TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                messages INTEGER NOT NULL,
+                PRIMARY KEY (guild_id, bucket, user_id)
+            ) WITHOUT ROWID;
+            """
+        )
+        await db.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table['user']}_user "
+            f"ON {table['user']} (guild_id, user_id, bucket, messages);"
+        )
+        await db.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table["faction"]} (
+                guild_id INTEGER NOT NULL,
+                faction_id INTEGER NOT NULL,
+                bucket TEXT NOT NULL,
+                messages INTEGER NOT NULL,
+                PRIMARY KEY (guild_id, faction_id, bucket)
+            ) WITHOUT ROWID;
+            """
+        )
+
+
 async def init_db():
     async with aiosqlite.connect(DB_PATH) as db:
+        # 新規DBのみ有効（既存DBに反映するには一度オフラインで VACUUM が必要）
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        # 複数プロセスから同じファイルを読み書きするので WAL にしておく
+        await db.execute("PRAGMA journal_mode=WAL;")
         await db.execute(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -88,301 +541,2216 @@ async def init_db():
         )
         await db.execute(
             """
-            CREATE TABLE IF NOT EXISTS factions (
+            CREATE TABLE IF NOT EXISTS economy_jobs (
+                name TEXT PRIMARY KEY,
+                kind TEXT NOT NULL, -- 'interest' / 'decay' / 'season_reset'
+                rate REAL NOT NULL DEFAULT 0,
+                min_balance INTEGER NOT NULL DEFAULT 0,
+                interval_hours REAL NOT NULL,
+                enabled INTEGER NOT NULL DEFAULT 0,
+                last_run_at INTEGER
+            );
+            """
+        )
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS economy_job_runs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                guild_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                leader_id INTEGER NOT NULL,
-                base_role_id INTEGER NOT NULL,
-                leader_role_id INTEGER NOT NULL,
-                officer_role_id INTEGER NOT NULL,
-                category_id INTEGER NOT NULL,
-                forum_channel_id INTEGER NOT NULL,
-                chat_channel_id INTEGER NOT NULL,
-                vc_channel_id INTEGER NOT NULL,
-                listen_vc_channel_id INTEGER NOT NULL,
-                control_panel_channel_id INTEGER NOT NULL,
-                destroyed INTEGER NOT NULL DEFAULT 0,
-                is_open INTEGER NOT NULL DEFAULT 0
+                job_name TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                started_at INTEGER NOT NULL,
+                duration_ms INTEGER NOT NULL,
+                rows_affected INTEGER NOT NULL,
+                status TEXT NOT NULL, -- 'running' / 'ok' / 'error'
+                error TEXT,
+                last_key INTEGER, -- 処理済みの最後の user_id（途中で止まったらここから再開する）
+                season INTEGER
             );
             """
         )
+        for alter_sql in (
+            "ALTER TABLE economy_job_runs ADD COLUMN last_key INTEGER;",
+            "ALTER TABLE economy_job_runs ADD COLUMN season INTEGER;",
+        ):
+            try:
+                await db.execute(alter_sql)
+            except Exception:
+                pass
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_economy_job_runs_job ON economy_job_runs (job_name, id);"
+        )
         await db.execute(
             """
-            CREATE TABLE IF NOT EXISTS faction_members (
+            CREATE TABLE IF NOT EXISTS users_season_archive (
+                season INTEGER NOT NULL,
                 user_id INTEGER NOT NULL,
-                faction_id INTEGER NOT NULL,
-                role TEXT NOT NULL, -- 'leader' / 'officer' / 'member'
-                PRIMARY KEY (user_id, faction_id)
+                balance INTEGER NOT NULL,
+                archived_at INTEGER NOT NULL,
+                PRIMARY KEY (season, user_id)
             );
             """
         )
+        # 既定のジョブ（無効状態で登録。/eco_job で有効化する）
+        await db.executemany(
+            """
+            INSERT OR IGNORE INTO economy_jobs (name, kind, rate, min_balance, interval_hours)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            [
+                ("interest", "interest", 0.01, 0, 24),
+                ("decay", "decay", 0.02, 10000, 24),
+                ("season_reset", "season_reset", 0, 0, 24 * 30),
+            ],
+        )
         await db.execute(
             """
-            CREATE TABLE IF NOT EXISTS wars (
+            CREATE TABLE IF NOT EXISTS bulk_grants (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 guild_id INTEGER NOT NULL,
-                attacker_faction_id INTEGER NOT NULL,
-                defender_faction_id INTEGER NOT NULL,
-                active INTEGER NOT NULL DEFAULT 1,
-                attacker_messages INTEGER NOT NULL DEFAULT 0,
-                defender_messages INTEGER NOT NULL DEFAULT 0
+                actor_id INTEGER NOT NULL,
+                target_kind TEXT NOT NULL,
+                target_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                user_count INTEGER NOT NULL,
+                total INTEGER NOT NULL,
+                created_at INTEGER NOT NULL
             );
             """
         )
         await db.execute(
             """
-            CREATE TABLE IF NOT EXISTS guild_settings (
-                guild_id INTEGER PRIMARY KEY,
-                war_status_channel_id INTEGER
+            CREATE TABLE IF NOT EXISTS bot_state (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
             );
             """
         )
-        # 既存DBに is_open が無い場合だけ追加
-        try:
-            await db.execute(
-                "ALTER TABLE factions ADD COLUMN is_open INTEGER NOT NULL DEFAULT 0;"
-            )
-        except Exception:
-            pass
-
-        await db.commit()
-
-
-# ===================== 通貨関連 =====================
-
-async def get_balance(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        row = await cur.fetchone()
-        await cur.close()
-        if row:
-            return row[0]
         await db.execute(
-            "INSERT INTO users (user_id, balance) VALUES (?, ?)",
-            (user_id, 0),
+            """
+            CREATE TABLE IF NOT EXISTS reconciler_state (
+                key TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            """
         )
-        await db.commit()
-        return 0
-
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS audit_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                guild_id INTEGER NOT NULL,
+                faction_id INTEGER,
+                actor_id INTEGER,
+                action TEXT NOT NULL,
+                target_id INTEGER,
+                payload TEXT,
+                created_at INTEGER NOT NULL -- UNIX 秒
+            );
+            """
+        )
+        for index_sql in (
+            "CREATE INDEX IF NOT EXISTS idx_audit_guild ON audit_events (guild_id, id);",
+            "CREATE INDEX IF NOT EXISTS idx_audit_faction ON audit_events (faction_id, id);",
+            "CREATE INDEX IF NOT EXISTS idx_audit_actor ON audit_events (actor_id, id);",
+            "CREATE INDEX IF NOT EXISTS idx_audit_target ON audit_events (target_id, id);",
+            "CREATE INDEX IF NOT EXISTS idx_audit_created ON audit_events (created_at);",
+        ):
+            await db.execute(index_sql)
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS audit_summaries (
+                guild_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                action TEXT NOT NULL,
+                faction_id INTEGER NOT NULL DEFAULT 0, -- 派閥に紐づかないものは 0
+                count INTEGER NOT NULL,
+                PRIMARY KEY (guild_id, day, action, faction_id)
+            );
+            """
+        )
+        if not is_partitioned():
+            await init_guild_schema(db)
+        # スキーマを変えたら SCHEMA_VERSION を上げる（古いスナップショットを使わないため）
+        await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
-async def add_balance(user_id: int, amount: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        row = await cur.fetchone()
-        if row:
-            new_balance = row[0] + amount
-            await db.execute(
-                "UPDATE users SET balance = ? WHERE user_id = ?",
-                (new_balance, user_id),
-            )
-        else:
-            new_balance = amount
-            await db.execute(
-                "INSERT INTO users (user_id, balance) VALUES (?, ?)",
-                (user_id, new_balance),
-            )
         await db.commit()
-        await cur.close()
-        return new_balance
 
 
-async def remove_balance(user_id: int, amount: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        row = await cur.fetchone()
-        if not row or row[0] < amount:
-            await cur.close()
-            return False
-        new_balance = row[0] - amount
-        await db.execute(
-            "UPDATE users SET balance = ? WHERE user_id = ?",
-            (new_balance, user_id),
-        )
-        await db.commit()
-        await cur.close()
-        return True
+# アーカイブテーブルは本体と同じ列（+ archived_at）を持つ
+FACTION_ARCHIVE_COLUMNS = (
+    "id", "guild_id", "name", "leader_id", "base_role_id", "leader_role_id",
+    "officer_role_id", "category_id", "forum_channel_id", "chat_channel_id",
+    "vc_channel_id", "listen_vc_channel_id", "control_panel_channel_id",
+    "destroyed", "is_open", "destroyed_at",
+)
+WAR_ARCHIVE_COLUMNS = (
+    "id", "guild_id", "attacker_faction_id", "defender_faction_id", "active",
+    "attacker_messages", "defender_messages", "ended_at",
+    "scoreboard_channel_id", "scoreboard_message_id",
+)
 
 
-# ===================== 派閥関連 =====================
+# ===================== ギルド別ストレージ =====================
 
-async def get_user_faction_id(user_id: int, guild_id: int) -> Optional[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT f.id
-            FROM faction_members fm
-            JOIN factions f ON fm.faction_id = f.id
-            WHERE fm.user_id = ? AND f.guild_id = ? AND f.destroyed = 0
-            """,
-            (user_id, guild_id),
+# ギルド単位のテーブル。partitioned モードではギルドごとのファイルに置く
+GUILD_TABLES = (
+    "factions",
+    "faction_members",
+    "wars",
+    "guild_settings",
+    "factions_archive",
+    "wars_archive",
+    *(table for tables in ACTIVITY_TABLES.values() for table in tables.values()),
+)
+
+# purge_guild が消す順序: (テーブル, 行を特定する列, そのギルドの行を選ぶ SELECT)
+# faction_members は guild_id を持たないので、派閥が残っているうちに派閥から辿って消す
+GUILD_PURGE_STEPS = (
+    (
+        "faction_members",
+        "rowid",
+        "SELECT fm.rowid FROM faction_members fm JOIN factions f ON f.id = fm.faction_id WHERE f.guild_id = ?",
+    ),
+    *(
+        (table, "rowid", f"SELECT rowid FROM {table} WHERE guild_id = ?")
+        for table in ("wars", "factions", "guild_settings", "factions_archive", "wars_archive")
+    ),
+    *(
+        step
+        for tables in ACTIVITY_TABLES.values()
+        for step in (
+            # 主キーごと指定しないと、同じ日・同じユーザーの他ギルドの行まで消える
+            (
+                tables["user"],
+                "guild_id, bucket, user_id",
+                f"SELECT guild_id, bucket, user_id FROM {tables['user']} WHERE guild_id = ?",
+            ),
+            (
+                tables["faction"],
+                "guild_id, faction_id, bucket",
+                f"SELECT guild_id, faction_id, bucket FROM {tables['faction']} WHERE guild_id = ?",
+            ),
         )
-        row = await cur.fetchone()
-        await cur.close()
-        return row[0] if row else None
+    ),
+)
 
+# guild_id -> {"conn", "lock", "refs", "last_used"}。LRU 順（末尾が最近使ったもの）
+guild_db_handles: "OrderedDict[int, dict]" = OrderedDict()
+guild_db_open_lock = asyncio.Lock()
+# このプロセスでスキーマ作成済みのギルドDB
+guild_schema_ready: set[int] = set()
 
-async def get_faction_by_id(faction_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT id, guild_id, name, leader_id, base_role_id, leader_role_id,
-                   officer_role_id, category_id, forum_channel_id, chat_channel_id,
-                   vc_channel_id, listen_vc_channel_id, control_panel_channel_id,
-                   destroyed, is_open
-            FROM factions
-            WHERE id = ?
-            """,
-            (faction_id,),
-        )
-        row = await cur.fetchone()
-        await cur.close()
-        return row
 
+def is_partitioned() -> bool:
+    return STORAGE_MODE == "partitioned"
 
-async def get_faction_by_name(name: str, guild_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT id, name, leader_id, base_role_id, leader_role_id,
-                   officer_role_id, category_id, forum_channel_id, chat_channel_id,
-                   vc_channel_id, listen_vc_channel_id, control_panel_channel_id,
-                   destroyed, is_open
-            FROM factions
-            WHERE guild_id = ? AND name = ? AND destroyed = 0
-            """,
-            (guild_id, name),
-        )
-        row = await cur.fetchone()
-        await cur.close()
-        return row
 
+def guild_db_path(guild_id: int) -> str:
+    return os.path.join(GUILD_DB_DIR, f"guild-{guild_id}.db")
 
-async def add_faction_member(user_id: int, faction_id: int, role: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT OR REPLACE INTO faction_members (user_id, faction_id, role)
-            VALUES (?, ?, ?)
-            """,
-            (user_id, faction_id, role),
-        )
-        await db.commit()
 
+def list_storage_partitions() -> list[Optional[int]]:
+    """ギルド単位のテーブルを持つ DB の一覧。shared モードでは [None]（= DB_PATH）だけ。"""
+    if not is_partitioned():
+        return [None]
+    guild_ids = []
+    for path in glob.glob(os.path.join(GUILD_DB_DIR, "guild-*.db")):
+        try:
+            guild_ids.append(int(os.path.basename(path)[len("guild-"):-len(".db")]))
+        except ValueError:
+            continue
+    return sorted(guild_ids)
 
-async def remove_faction_member(user_id: int, faction_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "DELETE FROM faction_members WHERE user_id = ? AND faction_id = ?",
-            (user_id, faction_id),
-        )
-        await db.commit()
 
+async def connect_guild_db(guild_id: int) -> aiosqlite.Connection:
+    os.makedirs(GUILD_DB_DIR, exist_ok=True)
+    db = await aiosqlite.connect(guild_db_path(guild_id))
+    if guild_id not in guild_schema_ready:
+        try:
+            await db.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            await db.execute("PRAGMA journal_mode=WAL;")
+            await init_guild_schema(db)
+            await db.commit()
+        except Exception:
+            await db.close()
+            raise
+        guild_schema_ready.add(guild_id)
+    return db
+
+
+async def close_guild_handle(guild_id: int):
+    handle = guild_db_handles.pop(guild_id, None)
+    if handle is not None:
+        await handle["conn"].close()
+        incr_metric("storage.handles_closed")
+
+
+async def acquire_guild_handle(guild_id: int) -> dict:
+    """ギルドDBの接続を LRU から取り出す（無ければ開く）。呼び出し側は refs を戻すこと。"""
+    handle = guild_db_handles.get(guild_id)
+    if handle is None:
+        async with guild_db_open_lock:
+            handle = guild_db_handles.get(guild_id)
+            if handle is None:
+                handle = {
+                    "conn": await connect_guild_db(guild_id),
+                    "lock": asyncio.Lock(),
+                    "refs": 0,
+                    "last_used": time.monotonic(),
+                }
+                guild_db_handles[guild_id] = handle
+                incr_metric("storage.handles_opened")
+            handle["refs"] += 1
+            guild_db_handles.move_to_end(guild_id)
+            # 上限を超えた分は使われていない古いものから閉じる
+            excess = len(guild_db_handles) - GUILD_DB_CACHE_SIZE
+            for old_id in list(guild_db_handles):
+                if excess <= 0:
+                    break
+                old = guild_db_handles.get(old_id)
+                if old is not None and old["refs"] == 0:
+                    await close_guild_handle(old_id)
+                    excess -= 1
+            set_metric("storage.open_handles", len(guild_db_handles))
+            return handle
+    handle["refs"] += 1
+    guild_db_handles.move_to_end(guild_id)
+    return handle
+
+
+@contextlib.asynccontextmanager
+async def open_db(guild_id: Optional[int] = None, *, cached: bool = True):
+    """guild_id のギルド単位テーブルを持つ DB を開く。None なら共有ファイル（users など）。
+
+    partitioned モードではギルドごとの接続を使い回し、接続ごとのロックで1タスクずつ使う。
+    一括処理（全ギルドの走査など）は cached=False で LRU を荒らさないようにする。
+    """
+    if guild_id is None or not is_partitioned():
+        async with aiosqlite.connect(DB_PATH) as db:
+            yield db
+        return
+    if not cached:
+        db = await connect_guild_db(guild_id)
+        try:
+            yield db
+        finally:
+            await db.close()
+        return
 
-async def get_faction_role(user_id: int, guild_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT fm.faction_id, fm.role
-            FROM faction_members fm
-            JOIN factions f ON fm.faction_id = f.id
-            WHERE fm.user_id = ? AND f.guild_id = ? AND f.destroyed = 0
-            """,
-            (user_id, guild_id),
-        )
-        row = await cur.fetchone()
+    handle = await acquire_guild_handle(guild_id)
+    try:
+        async with handle["lock"]:
+            db = handle["conn"]
+            try:
+                yield db
+            finally:
+                # 途中で失敗した書き込みを次の利用者に持ち越さない
+                if db.in_transaction:
+                    await db.rollback()
+    finally:
+        handle["refs"] -= 1
+        handle["last_used"] = time.monotonic()
+
+
+async def close_idle_guild_dbs(max_idle: float = GUILD_DB_IDLE_SECONDS):
+    cutoff = time.monotonic() - max_idle
+    for guild_id in list(guild_db_handles):
+        handle = guild_db_handles.get(guild_id)
+        if handle is not None and handle["refs"] == 0 and handle["last_used"] <= cutoff:
+            await close_guild_handle(guild_id)
+    set_metric("storage.open_handles", len(guild_db_handles))
+
+
+async def guild_db_idle_loop():
+    while not bot.is_closed():
+        await asyncio.sleep(60)
+        await close_idle_guild_dbs()
+
+
+async def migrate_to_partitions(src_path: str) -> dict[int, int]:
+    """既存 DB のギルド単位テーブルをギルドごとのファイルへコピーする（元ファイルは変更しない）。
+
+    ギルドID -> コピーした行数 を返す。同じ主キーは上書きするので再実行してよい。
+    古い DB に無いテーブルは飛ばし、無い列はコピー先の既定値のままにする。
+    """
+    # 元ファイルは読み取り専用で開き、あるテーブルと列だけを調べる
+    src_columns: dict[str, set[str]] = {}
+    async with aiosqlite.connect(f"file:{src_path}?mode=ro", uri=True) as src:
+        cur = await src.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        names = [r[0] for r in await cur.fetchall()]
         await cur.close()
-        if row:
-            return row[0], row[1]
-        return None, None
+        for name in names:
+            cur = await src.execute(f"PRAGMA table_info({name})")
+            src_columns[name] = {r[1] for r in await cur.fetchall()}
+            await cur.close()
 
+        guild_tables = [
+            t for t in (
+                "factions", "wars", "guild_settings", "factions_archive", "wars_archive", "activity_user_weekly",
+            )
+            if t in src_columns
+        ]
+        guild_ids = []
+        if guild_tables:
+            cur = await src.execute(" UNION ".join(f"SELECT guild_id FROM {t}" for t in guild_tables))
+            guild_ids = [r[0] for r in await cur.fetchall()]
+            await cur.close()
 
-# ===================== 戦争関連 =====================
+    all_tables = (
+        ("factions", FACTION_ARCHIVE_COLUMNS),
+        ("wars", WAR_ARCHIVE_COLUMNS),
+        ("guild_settings", ("guild_id", *GUILD_SETTING_KEYS)),
+        ("factions_archive", (*FACTION_ARCHIVE_COLUMNS, "archived_at")),
+        ("wars_archive", (*WAR_ARCHIVE_COLUMNS, "archived_at")),
+        *(
+            (tables["user"], ("guild_id", "bucket", "user_id", "messages"))
+            for tables in ACTIVITY_TABLES.values()
+        ),
+        *(
+            (tables["faction"], ("guild_id", "faction_id", "bucket", "messages"))
+            for tables in ACTIVITY_TABLES.values()
+        ),
+    )
+    tables = [
+        (table, [c for c in columns if c in src_columns[table]])
+        for table, columns in all_tables
+        if table in src_columns
+    ]
+    copied: dict[int, int] = {}
+    for guild_id in guild_ids:
+        db = await connect_guild_db(guild_id)
+        try:
+            await db.execute("ATTACH DATABASE ? AS src", (src_path,))
+            rows = 0
+            for table, columns in tables:
+                cols = ", ".join(columns)
+                cur = await db.execute(
+                    f"INSERT OR REPLACE INTO {table} ({cols}) SELECT {cols} FROM src.{table} WHERE guild_id = ?",
+                    (guild_id,),
+                )
+                rows += cur.rowcount
+            cur = await db.execute(
+                """
+                INSERT OR REPLACE INTO faction_members (user_id, faction_id, role)
+                SELECT fm.user_id, fm.faction_id, fm.role
+                FROM src.faction_members fm
+                JOIN src.factions f ON f.id = fm.faction_id
+                WHERE f.guild_id = ?
+                """,
+                (guild_id,),
+            )
+            rows += cur.rowcount
+            await db.commit()
+            await db.execute("DETACH DATABASE src")
+        finally:
+            await db.close()
+        copied[guild_id] = rows
+    return copied
 
-async def get_active_war(guild_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT id, attacker_faction_id, defender_faction_id,
-                   attacker_messages, defender_messages
-            FROM wars
-            WHERE guild_id = ? AND active = 1
-            """,
-            (guild_id,),
-        )
-        row = await cur.fetchone()
-        await cur.close()
-        return row
 
+# ===================== ストレージ層 =====================
 
-async def add_message_for_war(user_id: int, guild_id: int):
-    faction_id = await get_user_faction_id(user_id, guild_id)
-    if not faction_id:
-        return
+# factions の列（get_faction_by_id が返す順）
+FACTION_COLUMNS = FACTION_ARCHIVE_COLUMNS[:-1]  # destroyed_at は返さない
+FACTION_SELECT = ", ".join(FACTION_COLUMNS)
+# create_faction に渡すロール/チャンネル ID の列
+FACTION_RESOURCE_COLUMNS = FACTION_COLUMNS[4:13]
 
-    war = await get_active_war(guild_id)
-    if not war:
-        return
 
-    war_id, attacker_id, defender_id, attacker_msgs, defender_msgs = war
-    if faction_id not in (attacker_id, defender_id):
-        return
+class _LeaderCancelled(Exception):
+    """SingleFlight で先に問い合わせていたタスクがキャンセルされた"""
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        if faction_id == attacker_id:
-            attacker_msgs += 1
-            await db.execute(
-                "UPDATE wars SET attacker_messages = ? WHERE id = ?",
-                (attacker_msgs, war_id),
-            )
-        else:
-            defender_msgs += 1
-            await db.execute(
-                "UPDATE wars SET defender_messages = ? WHERE id = ?",
-                (defender_msgs, war_id),
-            )
-        await db.commit()
 
+class SingleFlight:
+    """同じキーの読み取りが同時に来たら問い合わせを1回だけ実行し、結果を全員で共有する。
 
-# ===================== ギルド設定（戦争状況チャンネル） =====================
+    ttl > 0 なら結果をその秒数だけ使い回す。書き込んだら forget(key) で捨てること
+    （実行中の問い合わせにも以後は相乗りさせない）。
+    """
 
-async def get_guild_war_status_channel_id(guild_id: int) -> Optional[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT war_status_channel_id FROM guild_settings WHERE guild_id = ?",
-            (guild_id,),
-        )
-        row = await cur.fetchone()
-        await cur.close()
-        return row[0] if row else None
+    def __init__(self, name: str, ttl: float = 0.0):
+        self.name = name
+        self.ttl = ttl
+        self.inflight: dict = {}  # key -> Future
+        self.results: dict = {}  # key -> (期限, 値)
 
+    async def do(self, key, func):
+        cached = self.results.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                incr_metric(f"singleflight.{self.name}.hits")
+                return cached[1]
+            del self.results[key]
 
-async def set_guild_war_status_channel_id(guild_id: int, channel_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT OR REPLACE INTO guild_settings (guild_id, war_status_channel_id)
-            VALUES (?, ?)
-            """,
-            (guild_id, channel_id),
+        fut = self.inflight.get(key)
+        if fut is not None:
+            incr_metric(f"singleflight.{self.name}.coalesced")
+            try:
+                # 相乗りした側がキャンセルされても元の問い合わせは止めない
+                return await asyncio.shield(fut)
+            except _LeaderCancelled:
+                # 問い合わせた側だけがキャンセルされたので、自分で問い合わせ直す
+                incr_metric(f"singleflight.{self.name}.retries")
+                return await self.do(key, func)
+
+        fut = asyncio.get_running_loop().create_future()
+        self.inflight[key] = fut
+        incr_metric(f"singleflight.{self.name}.calls")
+        try:
+            value = await func()
+        except BaseException as e:
+            # キャンセルは問い合わせた側の都合なので、相乗りした側には問い合わせ直させる
+            fut.set_exception(_LeaderCancelled() if isinstance(e, asyncio.CancelledError) else e)
+            fut.exception()  # 相乗りが無くても「未取得の例外」警告を出さない
+            if self.inflight.get(key) is fut:
+                del self.inflight[key]
+            raise
+        fut.set_result(value)
+        # 実行中に forget されていなければ（まだ自分が登録されていれば）結果を保存する
+        if self.inflight.get(key) is fut:
+            del self.inflight[key]
+            if self.ttl > 0:
+                self.results[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def forget(self, key):
+        self.results.pop(key, None)
+        self.inflight.pop(key, None)
+
+
+class Storage(abc.ABC):
+    """ユーザー・派閥・メンバー・戦争・ギルド設定の永続化。
+
+    コマンドやイベント処理はこのクラスのメソッドだけを使い、SQL を直接書かない。
+    ギルド単位のデータを扱うメソッドは guild_id を最後の引数に取る。
+    """
+
+    name = "base"
+
+    async def close(self):
+        pass
+
+    # --- users ---
+    @abc.abstractmethod
+    async def get_balance(self, user_id: int) -> int:
+        ...
+
+    @abc.abstractmethod
+    async def add_balance(self, user_id: int, amount: int) -> int:
+        ...
+
+    @abc.abstractmethod
+    async def remove_balance(self, user_id: int, amount: int) -> bool:
+        ...
+
+    @abc.abstractmethod
+    async def transfer_balance(self, from_user_id: int, to_user_id: int, amount: int) -> Optional[Tuple[int, int]]:
+        """送金する。残高不足なら None、成功時は (送金元残高, 送金先残高)。"""
+
+    @abc.abstractmethod
+    async def reset_balances(self, user_ids: list[int], balance: int):
+        ...
+
+    @abc.abstractmethod
+    async def balance_stats(self, user_ids: list[int]) -> Tuple[int, int]:
+        """(合計, 最小) を返す"""
+
+    @abc.abstractmethod
+    async def grant_bulk(
+        self,
+        user_ids: list[int],
+        amount: int,
+        guild_id: int,
+        actor_id: int,
+        target_kind: str,
+        target_id: int,
+    ) -> Tuple[int, int]:
+        """全員の残高に amount を足し（0 未満にはしない）、bulk_grants の記録と一緒に確定する。
+
+        (記録ID, 実際に増減した合計) を返す。
+        """
+
+    # --- factions ---
+    @abc.abstractmethod
+    async def get_faction_by_id(self, faction_id: int, guild_id: int):
+        ...
+
+    @abc.abstractmethod
+    async def get_faction_by_name(self, name: str, guild_id: int):
+        """生きている派閥を名前で探す（guild_id を除いた列を返す）"""
+
+    @abc.abstractmethod
+    async def create_faction(self, name: str, leader_id: int, resources: dict, guild_id: int) -> int:
+        """resources は FACTION_RESOURCE_COLUMNS をキーに持つ dict。新しい派閥 ID を返す。"""
+
+    @abc.abstractmethod
+    async def set_faction_open(self, faction_id: int, is_open: int, guild_id: int):
+        ...
+
+    @abc.abstractmethod
+    async def set_faction_panel_channel(self, faction_id: int, channel_id: int, guild_id: int):
+        ...
+
+    @abc.abstractmethod
+    async def destroy_faction(self, faction_id: int, guild_id: int):
+        """解体済みにしてメンバーを全員外す"""
+
+    @abc.abstractmethod
+    async def list_factions(self, guild_id: int, after_id: int = 0, limit: Optional[int] = None) -> list[tuple]:
+        """生きている派閥を ID 順に返す"""
+
+    @abc.abstractmethod
+    async def count_faction_members(self, faction_id: int, guild_id: int) -> int:
+        ...
+
+    # --- members ---
+    @abc.abstractmethod
+    async def get_faction_role(self, user_id: int, guild_id: int) -> Tuple[Optional[int], Optional[str]]:
+        ...
+
+    async def get_user_faction_id(self, user_id: int, guild_id: int) -> Optional[int]:
+        faction_id, _role = await self.get_faction_role(user_id, guild_id)
+        return faction_id
+
+    @abc.abstractmethod
+    async def list_memberships(self, guild_id: int) -> list[Tuple[int, int, str]]:
+        """生きている派閥の (user_id, faction_id, role) を全件返す"""
+
+    async def get_faction_context(
+        self,
+        user_id: int,
+        guild_id: int,
+        *,
+        faction_id: Optional[int] = None,
+        target_id: Optional[int] = None,
+    ) -> Tuple[Optional[int], Optional[str], Optional[int], Optional[str], Optional[tuple], int]:
+        """権限チェックに要るものをまとめて返す。
+
+        (実行者の派閥ID, 実行者の役職, 対象の派閥ID, 対象の役職, 派閥の行, メンバー数)。
+        派閥は faction_id、省略時は実行者の派閥（解体済みでも行は返す）。
+        """
+        my_faction_id, my_role = await self.get_faction_role(user_id, guild_id)
+        target_faction_id, target_role = (
+            await self.get_faction_role(target_id, guild_id) if target_id is not None else (None, None)
         )
-        await db.commit()
+        fid = faction_id if faction_id is not None else my_faction_id
+        faction = await self.get_faction_by_id(fid, guild_id) if fid is not None else None
+        member_count = await self.count_faction_members(fid, guild_id) if faction else 0
+        return my_faction_id, my_role, target_faction_id, target_role, faction, member_count
 
+    @abc.abstractmethod
+    async def list_faction_members(self, faction_ids: list[int], guild_id: int) -> list[Tuple[int, int]]:
+        """(user_id, faction_id) を返す"""
 
-async def get_war_status_channel(guild: discord.Guild) -> Optional[discord.TextChannel]:
-    channel_id = await get_guild_war_status_channel_id(guild.id)
-    if channel_id:
-        ch = guild.get_channel(channel_id)
-        if isinstance(ch, discord.TextChannel):
-            return ch
-    return None
+    @abc.abstractmethod
+    async def add_faction_members(self, user_ids: list[int], faction_id: int, role: str, guild_id: int):
+        ...
 
+    @abc.abstractmethod
+    async def remove_faction_member(self, user_id: int, faction_id: int, guild_id: int):
+        ...
 
-# ===================== 派閥解体 & 解散ヘルパー =====================
+    @abc.abstractmethod
+    async def remove_departed_members(
+        self,
+        user_ids: list[int],
+        guild_id: int,
+    ) -> Tuple[list[Tuple[int, int]], list[Tuple[int, int, Optional[int]]]]:
+        """サーバーを抜けたユーザーを生きている派閥から外し、抜けたリーダーの後任を決める（1トランザクション）。
+
+        後任は幹部 → メンバーの順で、同じ役職なら古くからいる人。
+        (外した (user_id, faction_id), (faction_id, 元リーダー, 後任 または None)) を返す。
+        後任がいない派閥は解体しないので、呼び出し側でロールやチャンネルごと片付ける。
+        """
+
+    # --- wars ---
+    @abc.abstractmethod
+    async def get_active_war(self, guild_id: int):
+        """(id, attacker, defender, attacker_messages, defender_messages) または None"""
+
+    @abc.abstractmethod
+    async def load_active_wars(self) -> Tuple[list[tuple], list[tuple]]:
+        """全ギルドの進行中の戦争と、その参加者 (guild_id, user_id, faction_id) を返す"""
+
+    @abc.abstractmethod
+    async def start_war(self, attacker_id: int, defender_id: int, guild_id: int) -> int:
+        ...
+
+    @abc.abstractmethod
+    async def end_war(self, war_id: int, guild_id: int):
+        ...
+
+    @abc.abstractmethod
+    async def add_war_message(self, war_id: int, attacker: bool, guild_id: int) -> bool:
+        """進行中の戦争のカウントを1増やす。戦争が終わっていれば False。"""
+
+    @abc.abstractmethod
+    async def set_war_scoreboard(self, war_id: int, channel_id: int, message_id: int, guild_id: int):
+        ...
+
+    # --- guild settings ---
+    @abc.abstractmethod
+    async def load_guild_settings(self) -> list[tuple]:
+        """(guild_id, *GUILD_SETTING_KEYS の値) を全ギルド分返す"""
+
+    @abc.abstractmethod
+    async def update_guild_settings(self, values: dict, guild_id: int):
+        ...
+
+    # --- activity ---
+    @abc.abstractmethod
+    async def record_activity(self, rows: list[Tuple[str, str, int, Optional[int], int]], guild_id: int):
+        """(日, 週, user_id, faction_id または None, 件数) を日別・週別の集計に1トランザクションで足し込む"""
+
+    @abc.abstractmethod
+    async def activity_series(
+        self,
+        window: str,
+        since: str,
+        guild_id: int,
+        *,
+        faction_id: Optional[int] = None,
+        user_id: Optional[int] = None,
+    ) -> list[Tuple[str, int]]:
+        """since 以降の (bucket, 件数) を古い順に返す。faction_id か user_id のどちらかを指定する。"""
+
+    @abc.abstractmethod
+    async def top_activity(
+        self,
+        window: str,
+        since: str,
+        guild_id: int,
+        *,
+        faction_id: Optional[int] = None,
+        limit: int = 5,
+    ) -> list[Tuple[int, int]]:
+        """faction_id を指定すればその派閥の現メンバー上位 (user_id, 件数)、省略すれば生きている派閥の上位 (faction_id, 件数)"""
 
-async def destroy_faction(guild: discord.Guild, faction_row):
-    (
-        faction_id,
+    # --- guild removal ---
+    @abc.abstractmethod
+    async def purge_guild(self, guild_id: int, limit: int) -> int:
+        """ギルド単位のテーブルからそのギルドの行を最大 limit 行消す。消した行数を返し、0 なら完了。"""
+
+
+# 送金はキューに集め、1本の専用コネクションでまとめてコミットする（グループコミット）。
+# 同一プロセス内ではロック競合が起きず、他プロセスとは BEGIN IMMEDIATE + busy timeout で調停する。
+TRANSFER_BATCH_MAX = 200
+TRANSFER_DB_TIMEOUT = 30.0  # 他プロセスの書き込みを待つ最大秒数
+
+
+class SQLiteStorage(Storage):
+    """aiosqlite による実装。ギルド単位のテーブルは open_db(guild_id) 経由で読み書きする。"""
+
+    name = "sqlite"
+
+    def __init__(self):
+        self.transfer_queue: Optional[asyncio.Queue] = None
+        self.transfer_worker_task: Optional[asyncio.Task] = None
+        # メッセージの集中時に同じ行を読む問い合わせをまとめる
+        self.active_war_reads = SingleFlight("active_war", READ_COALESCE_TTL)
+        self.faction_reads = SingleFlight("faction", READ_COALESCE_TTL)
+
+    async def close(self):
+        if self.transfer_worker_task is not None:
+            self.transfer_worker_task.cancel()
+
+    # --- users ---
+    async def get_balance(self, user_id: int) -> int:
+        async with open_db() as db:
+            cur = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+            row = await cur.fetchone()
+            await cur.close()
+            if row:
+                return row[0]
+            await db.execute(
+                "INSERT INTO users (user_id, balance) VALUES (?, ?)",
+                (user_id, 0),
+            )
+            await db.commit()
+            return 0
+
+    async def add_balance(self, user_id: int, amount: int) -> int:
+        # メッセージ処理ワーカーから並行に呼ばれるので、読んでから書くのではなく1文で加算する
+        async with open_db() as db:
+            await db.execute(
+                """
+                INSERT INTO users (user_id, balance) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET balance = balance + excluded.balance
+                """,
+                (user_id, amount),
+            )
+            cur = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+            row = await cur.fetchone()
+            await cur.close()
+            await db.commit()
+            return row[0]
+
+    async def remove_balance(self, user_id: int, amount: int) -> bool:
+        # 残高が足りるときだけ減らす（読んでから書かないので並行実行でもマイナスにならない）
+        async with open_db() as db:
+            cur = await db.execute(
+                "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?",
+                (amount, user_id, amount),
+            )
+            ok = cur.rowcount == 1
+            await cur.close()
+            await db.commit()
+            return ok
+
+    async def transfer_balance(self, from_user_id: int, to_user_id: int, amount: int) -> Optional[Tuple[int, int]]:
+        if amount <= 0 or from_user_id == to_user_id:
+            raise ValueError("invalid transfer")
+        if self.transfer_worker_task is None or self.transfer_worker_task.done():
+            # 止まったワーカーのキューに残った依頼は誰も処理しないので、失敗させてから入れ替える
+            if self.transfer_queue is not None:
+                self.fail_pending_transfers(self.transfer_queue)
+            self.transfer_queue = asyncio.Queue()
+            self.transfer_worker_task = asyncio.create_task(self.transfer_worker(self.transfer_queue))
+            self.transfer_worker_task.add_done_callback(
+                functools.partial(self.on_transfer_worker_done, self.transfer_queue)
+            )
+        fut = asyncio.get_running_loop().create_future()
+        await self.transfer_queue.put((from_user_id, to_user_id, amount, fut))
+        return await fut
+
+    @classmethod
+    def on_transfer_worker_done(cls, queue: asyncio.Queue, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[transfer] worker stopped: {task.exception()!r}")
+        cls.fail_pending_transfers(queue)
+
+    @staticmethod
+    def fail_pending_transfers(queue: asyncio.Queue):
+        """キューに残った送金依頼をすべてエラーで終わらせる"""
+        failed = 0
+        while not queue.empty():
+            *_args, fut = queue.get_nowait()
+            if not fut.done():
+                fut.set_exception(RuntimeError("transfer worker stopped"))
+                failed += 1
+        if failed:
+            incr_metric("transfer.errors", failed)
+
+    async def transfer_worker(self, queue: asyncio.Queue):
+        async with aiosqlite.connect(DB_PATH, timeout=TRANSFER_DB_TIMEOUT, isolation_level=None) as db:
+            while True:
+                batch = [await queue.get()]
+                while len(batch) < TRANSFER_BATCH_MAX and not queue.empty():
+                    batch.append(queue.get_nowait())
+
+                results = []
+                try:
+                    # 最初に書き込みロックを取る（途中でロック昇格に失敗しない）
+                    await db.execute("BEGIN IMMEDIATE")
+                    for from_user_id, to_user_id, amount, _fut in batch:
+                        # 残高が足りるときだけ引き落とす
+                        cur = await db.execute(
+                            "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?",
+                            (amount, from_user_id, amount),
+                        )
+                        debited = cur.rowcount == 1
+                        await cur.close()
+                        if not debited:
+                            results.append(None)
+                            continue
+                        await db.execute(
+                            """
+                            INSERT INTO users (user_id, balance) VALUES (?, ?)
+                            ON CONFLICT (user_id) DO UPDATE SET balance = balance + excluded.balance
+                            """,
+                            (to_user_id, amount),
+                        )
+                        cur = await db.execute(
+                            "SELECT user_id, balance FROM users WHERE user_id IN (?, ?)",
+                            (from_user_id, to_user_id),
+                        )
+                        balances = dict(await cur.fetchall())
+                        await cur.close()
+                        results.append((balances[from_user_id], balances[to_user_id]))
+                    await db.execute("COMMIT")
+                except Exception as e:
+                    try:
+                        await db.execute("ROLLBACK")
+                    except Exception:
+                        pass
+                    for *_args, fut in batch:
+                        if not fut.done():
+                            fut.set_exception(e)
+                    incr_metric("transfer.errors", len(batch))
+                    continue
+
+                for (*_args, fut), result in zip(batch, results):
+                    if not fut.done():
+                        fut.set_result(result)
+                incr_metric("transfer.done", sum(1 for r in results if r))
+                incr_metric("transfer.rejected", sum(1 for r in results if r is None))
+                incr_metric("transfer.batches")
+
+    async def reset_balances(self, user_ids: list[int], balance: int):
+        async with open_db() as db:
+            await db.executemany(
+                """
+                INSERT INTO users (user_id, balance) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET balance = excluded.balance
+                """,
+                [(uid, balance) for uid in user_ids],
+            )
+            await db.commit()
+
+    async def balance_stats(self, user_ids: list[int]) -> Tuple[int, int]:
+        marks = ", ".join("?" for _ in user_ids)
+        async with open_db() as db:
+            cur = await db.execute(
+                f"SELECT SUM(balance), MIN(balance) FROM users WHERE user_id IN ({marks})",
+                user_ids,
+            )
+            total, minimum = await cur.fetchone()
+            await cur.close()
+        return total or 0, minimum or 0
+
+    async def grant_bulk(
+        self,
+        user_ids: list[int],
+        amount: int,
+        guild_id: int,
+        actor_id: int,
+        target_kind: str,
+        target_id: int,
+    ) -> Tuple[int, int]:
+        async def chunk_sum(chunk: list[int]) -> int:
+            cur = await db.execute(
+                f"SELECT COALESCE(SUM(balance), 0) FROM users WHERE user_id IN ({', '.join('?' for _ in chunk)})",
+                chunk,
+            )
+            (value,) = await cur.fetchone()
+            await cur.close()
+            return value
+
+        # 全チャンクと記録を1トランザクションにまとめ、途中で失敗したら誰にも付与しない
+        async with aiosqlite.connect(DB_PATH, timeout=TRANSFER_DB_TIMEOUT, isolation_level=None) as db:
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                total = 0
+                for start in range(0, len(user_ids), BULK_GRANT_CHUNK):
+                    chunk = user_ids[start:start + BULK_GRANT_CHUNK]
+                    before = await chunk_sum(chunk)
+                    await db.executemany(
+                        """
+                        INSERT INTO users (user_id, balance) VALUES (?, ?)
+                        ON CONFLICT (user_id) DO UPDATE SET balance = MAX(balance + ?, 0)
+                        """,
+                        [(uid, max(amount, 0), amount) for uid in chunk],
+                    )
+                    total += await chunk_sum(chunk) - before
+                cur = await db.execute(
+                    """
+                    INSERT INTO bulk_grants (
+                        guild_id, actor_id, target_kind, target_id, amount, user_count, total, created_at
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (guild_id, actor_id, target_kind, target_id, amount, len(user_ids), total, int(time.time())),
+                )
+                grant_id = cur.lastrowid
+                await cur.close()
+                await db.execute("COMMIT")
+            except Exception:
+                await db.execute("ROLLBACK")
+                raise
+        return grant_id, total
+
+    # --- factions ---
+    async def get_faction_by_id(self, faction_id: int, guild_id: int):
+        async def query():
+            async with open_db(guild_id) as db:
+                cur = await db.execute(
+                    f"SELECT {FACTION_SELECT} FROM factions WHERE id = ? AND guild_id = ?",
+                    (faction_id, guild_id),
+                )
+                row = await cur.fetchone()
+                await cur.close()
+                return row
+
+        return await self.faction_reads.do((guild_id, faction_id), query)
+
+    async def get_faction_by_name(self, name: str, guild_id: int):
+        async with open_db(guild_id) as db:
+            cur = await db.execute(
+                """
+                SELECT id, name, leader_id, base_role_id, leader_role_id,
+                       officer_role_id, category_id, forum_channel_id, chat_channel_id,
+                       vc_channel_id, listen_vc_channel_id, control_panel_channel_id,
+                       destroyed, is_open
+                FROM factions
+                WHERE guild_id = ? AND name = ? AND destroyed = 0
+                """,
+                (guild_id, name),
+            )
+            row = await cur.fetchone()
+            await cur.close()
+            return row
+
+    async def create_faction(self, name: str, leader_id: int, resources: dict, guild_id: int) -> int:
+        cols = ("guild_id", "name", "leader_id", *FACTION_RESOURCE_COLUMNS)
+        async with open_db(guild_id) as db:
+            cur = await db.execute(
+                f"INSERT INTO factions ({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)})",
+                (guild_id, name, leader_id, *(resources[c] for c in FACTION_RESOURCE_COLUMNS)),
+            )
+            faction_id = cur.lastrowid
+            await db.commit()
+        return faction_id
+
+    async def set_faction_open(self, faction_id: int, is_open: int, guild_id: int):
+        async with open_db(guild_id) as db:
+            await db.execute(
+                "UPDATE factions SET is_open = ? WHERE id = ?",
+                (is_open, faction_id),
+            )
+            await db.commit()
+        self.faction_reads.forget((guild_id, faction_id))
+
+    async def set_faction_panel_channel(self, faction_id: int, channel_id: int, guild_id: int):
+        async with open_db(guild_id) as db:
+            await db.execute(
+                "UPDATE factions SET control_panel_channel_id = ? WHERE id = ?",
+                (channel_id, faction_id),
+            )
+            await db.commit()
+        self.faction_reads.forget((guild_id, faction_id))
+
+    async def destroy_faction(self, faction_id: int, guild_id: int):
+        async with open_db(guild_id) as db:
+            await db.execute(
+                "UPDATE factions SET destroyed = 1, destroyed_at = ? WHERE id = ?",
+                (int(time.time()), faction_id),
+            )
+            await db.execute(
+                "DELETE FROM faction_members WHERE faction_id = ?",
+                (faction_id,),
+            )
+            await db.commit()
+        self.faction_reads.forget((guild_id, faction_id))
+
+    async def list_factions(self, guild_id: int, after_id: int = 0, limit: Optional[int] = None) -> list[tuple]:
+        async with open_db(guild_id) as db:
+            cur = await db.execute(
+                f"""
+                SELECT {FACTION_SELECT}
+                FROM factions
+                WHERE guild_id = ? AND destroyed = 0 AND id > ?
+                ORDER BY id
+                LIMIT ?
+                """,
+                (guild_id, after_id, -1 if limit is None else limit),
+            )
+            rows = await cur.fetchall()
+            await cur.close()
+        return rows
+
+    async def count_faction_members(self, faction_id: int, guild_id: int) -> int:
+        async with open_db(guild_id) as db:
+            cur = await db.execute(
+                "SELECT COUNT(*) FROM faction_members WHERE faction_id = ?",
+                (faction_id,),
+            )
+            row = await cur.fetchone()
+            await cur.close()
+        return row[0] if row else 0
+
+    # --- members ---
+    async def get_faction_role(self, user_id: int, guild_id: int) -> Tuple[Optional[int], Optional[str]]:
+        async with open_db(guild_id) as db:
+            cur = await db.execute(
+                """
+                SELECT fm.faction_id, fm.role
+                FROM faction_members fm
+                JOIN factions f ON fm.faction_id = f.id
+                WHERE fm.user_id = ? AND f.guild_id = ? AND f.destroyed = 0
+                """,
+                (user_id, guild_id),
+            )
+            row = await cur.fetchone()
+            await cur.close()
+        if row:
+            return row[0], row[1]
+        return None, None
+
+    async def get_faction_context(
+        self,
+        user_id: int,
+        guild_id: int,
+        *,
+        faction_id: Optional[int] = None,
+        target_id: Optional[int] = None,
+    ) -> Tuple[Optional[int], Optional[str], Optional[int], Optional[str], Optional[tuple], int]:
+        # ボタンやコマンド1回につき接続1本・問い合わせ1回で済むようにまとめる
+        async with open_db(guild_id) as db:
+            cur = await db.execute(
+                f"""
+                WITH me AS (
+                    SELECT fm.faction_id, fm.role
+                    FROM faction_members fm
+                    JOIN factions f ON fm.faction_id = f.id
+                    WHERE fm.user_id = :user AND f.guild_id = :guild AND f.destroyed = 0
+                ),
+                target AS (
+                    SELECT fm.faction_id, fm.role
+                    FROM faction_members fm
+                    JOIN factions f ON fm.faction_id = f.id
+                    WHERE fm.user_id = :target AND f.guild_id = :guild AND f.destroyed = 0
+                ),
+                fac AS (
+                    SELECT {FACTION_SELECT}
+                    FROM factions
+                    WHERE guild_id = :guild AND id = COALESCE(:faction, (SELECT faction_id FROM me))
+                )
+                SELECT (SELECT faction_id FROM me), (SELECT role FROM me),
+                       (SELECT faction_id FROM target), (SELECT role FROM target),
+                       (SELECT COUNT(*) FROM faction_members WHERE faction_id = fac.id),
+                       fac.*
+                FROM (SELECT 1) LEFT JOIN fac ON 1
+                """,
+                {"user": user_id, "guild": guild_id, "target": target_id, "faction": faction_id},
+            )
+            row = await cur.fetchone()
+            await cur.close()
+        faction = row[5:] if row[5] is not None else None
+        return row[0], row[1], row[2], row[3], faction, row[4] if faction else 0
+
+    async def list_memberships(self, guild_id: int) -> list[Tuple[int, int, str]]:
+        async with open_db(guild_id) as db:
+            cur = await db.execute(
+                """
+                SELECT fm.user_id, fm.faction_id, fm.role
+                FROM faction_members fm
+                JOIN factions f ON fm.faction_id = f.id
+                WHERE f.guild_id = ? AND f.destroyed = 0
+                """,
+                (guild_id,),
+            )
+            rows = await cur.fetchall()
+            await cur.close()
+        return rows
+
+    async def list_faction_members(self, faction_ids: list[int], guild_id: int) -> list[Tuple[int, int]]:
+        marks = ", ".join("?" for _ in faction_ids)
+        async with open_db(guild_id) as db:
+            cur = await db.execute(
+                f"SELECT user_id, faction_id FROM faction_members WHERE faction_id IN ({marks})",
+                faction_ids,
+            )
+            rows = await cur.fetchall()
+            await cur.close()
+        return rows
+
+    async def add_faction_members(self, user_ids: list[int], faction_id: int, role: str, guild_id: int):
+        async with open_db(guild_id) as db:
+            await db.executemany(
+                """
+                INSERT OR REPLACE INTO faction_members (user_id, faction_id, role)
+                VALUES (?, ?, ?)
+                """,
+                [(uid, faction_id, role) for uid in user_ids],
+            )
+            await db.commit()
+
+    async def remove_faction_member(self, user_id: int, faction_id: int, guild_id: int):
+        async with open_db(guild_id) as db:
+            await db.execute(
+                "DELETE FROM faction_members WHERE user_id = ? AND faction_id = ?",
+                (user_id, faction_id),
+            )
+            await db.commit()
+
+    async def remove_departed_members(
+        self,
+        user_ids: list[int],
+        guild_id: int,
+    ) -> Tuple[list[Tuple[int, int]], list[Tuple[int, int, Optional[int]]]]:
+        removed: list[Tuple[int, int]] = []
+        successions: list[Tuple[int, int, Optional[int]]] = []
+        async with open_db(guild_id) as db:
+            leaders = []
+            for start in range(0, len(user_ids), DEPARTURE_QUERY_CHUNK):
+                chunk = user_ids[start:start + DEPARTURE_QUERY_CHUNK]
+                cur = await db.execute(
+                    f"""
+                    SELECT fm.user_id, fm.faction_id, fm.role
+                    FROM faction_members fm
+                    JOIN factions f ON fm.faction_id = f.id
+                    WHERE f.guild_id = ? AND f.destroyed = 0
+                      AND fm.user_id IN ({', '.join('?' for _ in chunk)})
+                    """,
+                    (guild_id, *chunk),
+                )
+                rows = await cur.fetchall()
+                await cur.close()
+                removed += [(user_id, faction_id) for user_id, faction_id, _role in rows]
+                leaders += [(faction_id, user_id) for user_id, faction_id, role in rows if role == "leader"]
+            if not removed:
+                return [], []
+
+            await db.executemany(
+                "DELETE FROM faction_members WHERE user_id = ? AND faction_id = ?",
+                removed,
+            )
+            for faction_id, leader_id in leaders:
+                # 幹部を優先し、同じ役職なら先に入った（rowid が小さい）人
+                cur = await db.execute(
+                    """
+                    SELECT user_id FROM faction_members
+                    WHERE faction_id = ?
+                    ORDER BY CASE role WHEN 'officer' THEN 0 ELSE 1 END, rowid
+                    LIMIT 1
+                    """,
+                    (faction_id,),
+                )
+                row = await cur.fetchone()
+                await cur.close()
+                successor = row[0] if row else None
+                if successor is not None:
+                    await db.execute(
+                        "UPDATE faction_members SET role = 'leader' WHERE user_id = ? AND faction_id = ?",
+                        (successor, faction_id),
+                    )
+                    await db.execute(
+                        "UPDATE factions SET leader_id = ? WHERE id = ?",
+                        (successor, faction_id),
+                    )
+                successions.append((faction_id, leader_id, successor))
+            await db.commit()
+        for faction_id, _leader_id, _successor in successions:
+            self.faction_reads.forget((guild_id, faction_id))
+        return removed, successions
+
+    # --- wars ---
+    async def get_active_war(self, guild_id: int):
+        # どの戦争が進行中かだけを相乗り・使い回しし（開始/終了で捨てる）、
+        # メッセージごとに変わるカウントは主キーで毎回読む
+        async def query():
+            async with open_db(guild_id) as db:
+                cur = await db.execute(
+                    """
+                    SELECT id, attacker_faction_id, defender_faction_id
+                    FROM wars
+                    WHERE guild_id = ? AND active = 1
+                    """,
+                    (guild_id,),
+                )
+                row = await cur.fetchone()
+                await cur.close()
+                return row
+
+        war = await self.active_war_reads.do(guild_id, query)
+        if war is None:
+            return None
+        async with open_db(guild_id) as db:
+            cur = await db.execute(
+                "SELECT attacker_messages, defender_messages FROM wars WHERE id = ? AND active = 1",
+                (war[0],),
+            )
+            counts = await cur.fetchone()
+            await cur.close()
+        if counts is None:
+            return None
+        return (*war, *counts)
+
+    async def load_active_wars(self) -> Tuple[list[tuple], list[tuple]]:
+        wars, members = [], []
+        for partition in list_storage_partitions():
+            async with open_db(partition, cached=False) as db:
+                cur = await db.execute(
+                    """
+                    SELECT w.guild_id, w.id, w.attacker_faction_id, w.defender_faction_id,
+                           w.attacker_messages, w.defender_messages,
+                           w.scoreboard_channel_id, w.scoreboard_message_id,
+                           a.name, d.name
+                    FROM wars w
+                    JOIN factions a ON a.id = w.attacker_faction_id
+                    JOIN factions d ON d.id = w.defender_faction_id
+                    WHERE w.active = 1
+                    """
+                )
+                wars += await cur.fetchall()
+                await cur.close()
+                cur = await db.execute(
+                    """
+                    SELECT w.guild_id, fm.user_id, fm.faction_id
+                    FROM wars w
+                    JOIN faction_members fm
+                      ON fm.faction_id IN (w.attacker_faction_id, w.defender_faction_id)
+                    WHERE w.active = 1
+                    """
+                )
+                members += await cur.fetchall()
+                await cur.close()
+        return wars, members
+
+    async def start_war(self, attacker_id: int, defender_id: int, guild_id: int) -> int:
+        async with open_db(guild_id) as db:
+            cur = await db.execute(
+                """
+                INSERT INTO wars (
+                    guild_id, attacker_faction_id, defender_faction_id,
+                    active, attacker_messages, defender_messages
+                )
+                VALUES (?, ?, ?, 1, 0, 0)
+                """,
+                (guild_id, attacker_id, defender_id),
+            )
+            war_id = cur.lastrowid
+            await db.commit()
+        self.active_war_reads.forget(guild_id)
+        return war_id
+
+    async def end_war(self, war_id: int, guild_id: int):
+        async with open_db(guild_id) as db:
+            await db.execute(
+                "UPDATE wars SET active = 0, ended_at = ? WHERE id = ?",
+                (int(time.time()), war_id),
+            )
+            await db.commit()
+        self.active_war_reads.forget(guild_id)
+
+    async def add_war_message(self, war_id: int, attacker: bool, guild_id: int) -> bool:
+        column = "attacker_messages" if attacker else "defender_messages"
+        async with open_db(guild_id) as db:
+            cur = await db.execute(
+                f"UPDATE wars SET {column} = {column} + 1 WHERE id = ? AND active = 1",
+                (war_id,),
+            )
+            updated = cur.rowcount == 1
+            await db.commit()
+        return updated
+
+    async def set_war_scoreboard(self, war_id: int, channel_id: int, message_id: int, guild_id: int):
+        async with open_db(guild_id) as db:
+            await db.execute(
+                "UPDATE wars SET scoreboard_channel_id = ?, scoreboard_message_id = ? WHERE id = ?",
+                (channel_id, message_id, war_id),
+            )
+            await db.commit()
+
+    # --- guild settings ---
+    async def load_guild_settings(self) -> list[tuple]:
+        rows = []
+        for partition in list_storage_partitions():
+            async with open_db(partition, cached=False) as db:
+                cur = await db.execute(
+                    f"SELECT guild_id, {', '.join(GUILD_SETTING_KEYS)} FROM guild_settings"
+                )
+                rows += await cur.fetchall()
+                await cur.close()
+        return rows
+
+    async def update_guild_settings(self, values: dict, guild_id: int):
+        cols = list(values)
+        async with open_db(guild_id) as db:
+            await db.execute(
+                f"""
+                INSERT INTO guild_settings (guild_id, {', '.join(cols)})
+                VALUES (?, {', '.join('?' for _ in cols)})
+                ON CONFLICT (guild_id) DO UPDATE SET
+                    {', '.join(f"{c} = excluded.{c}" for c in cols)}
+                """,
+                (guild_id, *values.values()),
+            )
+            await db.commit()
+
+    # --- activity ---
+    async def record_activity(self, rows: list[Tuple[str, str, int, Optional[int], int]], guild_id: int):
+        # 同じ行への加算は先にまとめ、テーブルごとに executemany 1回にする
+        sums = {key: {"user": {}, "faction": {}} for key in ACTIVITY_TABLES}
+        for day, week, user_id, faction_id, count in rows:
+            for window, bucket in (("day", day), ("week", week)):
+                users = sums[window]["user"]
+                users[(bucket, user_id)] = users.get((bucket, user_id), 0) + count
+                if faction_id is not None:
+                    factions = sums[window]["faction"]
+                    factions[(faction_id, bucket)] = factions.get((faction_id, bucket), 0) + count
+
+        async with open_db(guild_id) as db:
+            for window, tables in ACTIVITY_TABLES.items():
+                await db.executemany(
+                    f"""
+                    INSERT INTO {tables["user"]} (guild_id, bucket, user_id, messages) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (guild_id, bucket, user_id) DO UPDATE SET messages = messages + excluded.messages
+                    """,
+                    [(guild_id, bucket, uid, n) for (bucket, uid), n in sums[window]["user"].items()],
+                )
+                await db.executemany(
+                    f"""
+                    INSERT INTO {tables["faction"]} (guild_id, faction_id, bucket, messages) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (guild_id, faction_id, bucket) DO UPDATE SET messages = messages + excluded.messages
+                    """,
+                    [(guild_id, fid, bucket, n) for (fid, bucket), n in sums[window]["faction"].items()],
+                )
+            await db.commit()
+
+    async def activity_series(
+        self,
+        window: str,
+        since: str,
+        guild_id: int,
+        *,
+        faction_id: Optional[int] = None,
+        user_id: Optional[int] = None,
+    ) -> list[Tuple[str, int]]:
+        tables = ACTIVITY_TABLES[window]
+        if faction_id is not None:
+            sql = f"SELECT bucket, messages FROM {tables['faction']} WHERE guild_id = ? AND faction_id = ? AND bucket >= ?"
+            params = (guild_id, faction_id, since)
+        else:
+            sql = f"SELECT bucket, messages FROM {tables['user']} WHERE guild_id = ? AND user_id = ? AND bucket >= ?"
+            params = (guild_id, user_id, since)
+        async with open_db(guild_id) as db:
+            cur = await db.execute(sql + " ORDER BY bucket", params)
+            rows = await cur.fetchall()
+            await cur.close()
+        return rows
+
+    async def top_activity(
+        self,
+        window: str,
+        since: str,
+        guild_id: int,
+        *,
+        faction_id: Optional[int] = None,
+        limit: int = 5,
+    ) -> list[Tuple[int, int]]:
+        tables = ACTIVITY_TABLES[window]
+        if faction_id is not None:
+            # メンバーごとに (guild_id, user_id, bucket) の索引を引く
+            sql = f"""
+                SELECT fm.user_id, SUM(a.messages) AS total
+                FROM faction_members fm
+                JOIN {tables["user"]} a ON a.guild_id = ? AND a.user_id = fm.user_id AND a.bucket >= ?
+                WHERE fm.faction_id = ?
+                GROUP BY fm.user_id
+                ORDER BY total DESC
+                LIMIT ?
+            """
+            params = (guild_id, since, faction_id, limit)
+        else:
+            sql = f"""
+                SELECT a.faction_id, SUM(a.messages) AS total
+                FROM {tables["faction"]} a
+                JOIN factions f ON f.id = a.faction_id AND f.destroyed = 0
+                WHERE a.guild_id = ? AND a.bucket >= ?
+                GROUP BY a.faction_id
+                ORDER BY total DESC
+                LIMIT ?
+            """
+            params = (guild_id, since, limit)
+        async with open_db(guild_id) as db:
+            cur = await db.execute(sql, params)
+            rows = await cur.fetchall()
+            await cur.close()
+        return rows
+
+    # --- guild removal ---
+    async def purge_guild(self, guild_id: int, limit: int) -> int:
+        async with open_db(guild_id, cached=False) as db:
+            for table, key, select in GUILD_PURGE_STEPS:
+                cur = await db.execute(
+                    f"DELETE FROM {table} WHERE ({key}) IN ({select} LIMIT ?)",
+                    (guild_id, limit),
+                )
+                deleted = cur.rowcount
+                await cur.close()
+                if deleted:
+                    await db.commit()
+                    return deleted
+        self.active_war_reads.forget(guild_id)
+        return 0
+
+
+class MemoryStorage(Storage):
+    """プロセス内の dict だけで持つ実装（テスト・ベンチマーク用。再起動で消える）。
+
+    await を挟まずに更新するので、各メソッドはそれだけでアトミックになる。
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self.balances: dict[int, int] = {}
+        self.factions: dict[int, dict[int, dict]] = {}  # guild_id -> {faction_id: 列名 -> 値}
+        self.members: dict[int, dict[int, dict[int, str]]] = {}  # guild_id -> {faction_id: {user_id: role}}
+        self.wars: dict[int, dict[int, dict]] = {}  # guild_id -> {war_id: 列名 -> 値}
+        self.settings: dict[int, dict] = {}
+        self.bulk_grants: list[tuple] = []  # bulk_grants テーブルと同じ列（id を除く）
+        # (窓, "user" / "faction") -> guild_id -> {(bucket, id): 件数}
+        self.activity: dict[Tuple[str, str], dict[int, dict[Tuple[str, int], int]]] = {
+            (window, kind): {} for window in ACTIVITY_TABLES for kind in ("user", "faction")
+        }
+        self.faction_ids = itertools.count(1)
+        self.war_ids = itertools.count(1)
+
+    # --- users ---
+    async def get_balance(self, user_id: int) -> int:
+        return self.balances.setdefault(user_id, 0)
+
+    async def add_balance(self, user_id: int, amount: int) -> int:
+        self.balances[user_id] = self.balances.get(user_id, 0) + amount
+        return self.balances[user_id]
+
+    async def remove_balance(self, user_id: int, amount: int) -> bool:
+        if self.balances.get(user_id, 0) < amount:
+            return False
+        self.balances[user_id] -= amount
+        return True
+
+    async def transfer_balance(self, from_user_id: int, to_user_id: int, amount: int) -> Optional[Tuple[int, int]]:
+        if amount <= 0 or from_user_id == to_user_id:
+            raise ValueError("invalid transfer")
+        if self.balances.get(from_user_id, 0) < amount:
+            incr_metric("transfer.rejected")
+            return None
+        self.balances[from_user_id] -= amount
+        self.balances[to_user_id] = self.balances.get(to_user_id, 0) + amount
+        incr_metric("transfer.done")
+        return self.balances[from_user_id], self.balances[to_user_id]
+
+    async def reset_balances(self, user_ids: list[int], balance: int):
+        for uid in user_ids:
+            self.balances[uid] = balance
+
+    async def balance_stats(self, user_ids: list[int]) -> Tuple[int, int]:
+        values = [self.balances.get(uid, 0) for uid in user_ids if uid in self.balances]
+        return sum(values), min(values, default=0)
+
+    async def grant_bulk(
+        self,
+        user_ids: list[int],
+        amount: int,
+        guild_id: int,
+        actor_id: int,
+        target_kind: str,
+        target_id: int,
+    ) -> Tuple[int, int]:
+        total = 0
+        for uid in user_ids:
+            before = self.balances.get(uid, 0)
+            self.balances[uid] = max(before + amount, 0)
+            total += self.balances[uid] - before
+        self.bulk_grants.append(
+            (guild_id, actor_id, target_kind, target_id, amount, len(user_ids), total, int(time.time()))
+        )
+        return len(self.bulk_grants), total
+
+    # --- factions ---
+    def _live_faction(self, faction_id: int, guild_id: int) -> Optional[dict]:
+        faction = self.factions.get(guild_id, {}).get(faction_id)
+        return faction if faction is not None and not faction["destroyed"] else None
+
+    async def get_faction_by_id(self, faction_id: int, guild_id: int):
+        faction = self.factions.get(guild_id, {}).get(faction_id)
+        return tuple(faction[c] for c in FACTION_COLUMNS) if faction else None
+
+    async def get_faction_by_name(self, name: str, guild_id: int):
+        for faction in self.factions.get(guild_id, {}).values():
+            if faction["name"] == name and not faction["destroyed"]:
+                return tuple(faction[c] for c in FACTION_COLUMNS if c != "guild_id")
+        return None
+
+    async def create_faction(self, name: str, leader_id: int, resources: dict, guild_id: int) -> int:
+        faction_id = next(self.faction_ids)
+        faction = {"id": faction_id, "guild_id": guild_id, "name": name, "leader_id": leader_id}
+        faction.update({c: resources[c] for c in FACTION_RESOURCE_COLUMNS})
+        faction.update(destroyed=0, is_open=0, destroyed_at=None)
+        self.factions.setdefault(guild_id, {})[faction_id] = faction
+        return faction_id
+
+    async def set_faction_open(self, faction_id: int, is_open: int, guild_id: int):
+        faction = self.factions.get(guild_id, {}).get(faction_id)
+        if faction is not None:
+            faction["is_open"] = is_open
+
+    async def set_faction_panel_channel(self, faction_id: int, channel_id: int, guild_id: int):
+        faction = self.factions.get(guild_id, {}).get(faction_id)
+        if faction is not None:
+            faction["control_panel_channel_id"] = channel_id
+
+    async def destroy_faction(self, faction_id: int, guild_id: int):
+        faction = self.factions.get(guild_id, {}).get(faction_id)
+        if faction is not None:
+            faction.update(destroyed=1, destroyed_at=int(time.time()))
+        self.members.get(guild_id, {}).pop(faction_id, None)
+
+    async def list_factions(self, guild_id: int, after_id: int = 0, limit: Optional[int] = None) -> list[tuple]:
+        rows = [
+            tuple(f[c] for c in FACTION_COLUMNS)
+            for fid, f in sorted(self.factions.get(guild_id, {}).items())
+            if fid > after_id and not f["destroyed"]
+        ]
+        return rows if limit is None else rows[:limit]
+
+    async def count_faction_members(self, faction_id: int, guild_id: int) -> int:
+        return len(self.members.get(guild_id, {}).get(faction_id, {}))
+
+    # --- members ---
+    async def get_faction_role(self, user_id: int, guild_id: int) -> Tuple[Optional[int], Optional[str]]:
+        for faction_id, roster in self.members.get(guild_id, {}).items():
+            if user_id in roster and self._live_faction(faction_id, guild_id):
+                return faction_id, roster[user_id]
+        return None, None
+
+    async def list_memberships(self, guild_id: int) -> list[Tuple[int, int, str]]:
+        return [
+            (uid, fid, role)
+            for fid, roster in self.members.get(guild_id, {}).items()
+            if self._live_faction(fid, guild_id)
+            for uid, role in roster.items()
+        ]
+
+    async def list_faction_members(self, faction_ids: list[int], guild_id: int) -> list[Tuple[int, int]]:
+        guild_members = self.members.get(guild_id, {})
+        return [(uid, fid) for fid in faction_ids for uid in guild_members.get(fid, {})]
+
+    async def add_faction_members(self, user_ids: list[int], faction_id: int, role: str, guild_id: int):
+        roster = self.members.setdefault(guild_id, {}).setdefault(faction_id, {})
+        for uid in user_ids:
+            roster[uid] = role
+
+    async def remove_faction_member(self, user_id: int, faction_id: int, guild_id: int):
+        self.members.get(guild_id, {}).get(faction_id, {}).pop(user_id, None)
+
+    async def remove_departed_members(
+        self,
+        user_ids: list[int],
+        guild_id: int,
+    ) -> Tuple[list[Tuple[int, int]], list[Tuple[int, int, Optional[int]]]]:
+        departed = set(user_ids)
+        removed: list[Tuple[int, int]] = []
+        successions: list[Tuple[int, int, Optional[int]]] = []
+        for faction_id, roster in self.members.get(guild_id, {}).items():
+            faction = self._live_faction(faction_id, guild_id)
+            if faction is None:
+                continue
+            leaving = [uid for uid in roster if uid in departed]
+            leader_id = next((uid for uid in leaving if roster[uid] == "leader"), None)
+            for uid in leaving:
+                del roster[uid]
+                removed.append((uid, faction_id))
+            if leader_id is None:
+                continue
+            # 辞書の順序 = 加入順
+            successor = next((uid for uid, role in roster.items() if role == "officer"), None)
+            if successor is None:
+                successor = next(iter(roster), None)
+            if successor is not None:
+                roster[successor] = "leader"
+                faction["leader_id"] = successor
+            successions.append((faction_id, leader_id, successor))
+        return removed, successions
+
+    # --- wars ---
+    async def get_active_war(self, guild_id: int):
+        for war in self.wars.get(guild_id, {}).values():
+            if war["active"]:
+                return (
+                    war["id"],
+                    war["attacker_faction_id"],
+                    war["defender_faction_id"],
+                    war["attacker_messages"],
+                    war["defender_messages"],
+                )
+        return None
+
+    async def load_active_wars(self) -> Tuple[list[tuple], list[tuple]]:
+        wars, members = [], []
+        for guild_id, guild_wars in self.wars.items():
+            for war in guild_wars.values():
+                if not war["active"]:
+                    continue
+                attacker = self.factions[guild_id][war["attacker_faction_id"]]
+                defender = self.factions[guild_id][war["defender_faction_id"]]
+                wars.append((
+                    guild_id, war["id"], attacker["id"], defender["id"],
+                    war["attacker_messages"], war["defender_messages"],
+                    war["scoreboard_channel_id"], war["scoreboard_message_id"],
+                    attacker["name"], defender["name"],
+                ))
+                for uid, fid in await self.list_faction_members([attacker["id"], defender["id"]], guild_id):
+                    members.append((guild_id, uid, fid))
+        return wars, members
+
+    async def start_war(self, attacker_id: int, defender_id: int, guild_id: int) -> int:
+        war_id = next(self.war_ids)
+        self.wars.setdefault(guild_id, {})[war_id] = {
+            "id": war_id,
+            "attacker_faction_id": attacker_id,
+            "defender_faction_id": defender_id,
+            "active": 1,
+            "attacker_messages": 0,
+            "defender_messages": 0,
+            "ended_at": None,
+            "scoreboard_channel_id": None,
+            "scoreboard_message_id": None,
+        }
+        return war_id
+
+    async def end_war(self, war_id: int, guild_id: int):
+        war = self.wars.get(guild_id, {}).get(war_id)
+        if war is not None:
+            war.update(active=0, ended_at=int(time.time()))
+
+    async def add_war_message(self, war_id: int, attacker: bool, guild_id: int) -> bool:
+        war = self.wars.get(guild_id, {}).get(war_id)
+        if war is None or not war["active"]:
+            return False
+        war["attacker_messages" if attacker else "defender_messages"] += 1
+        return True
+
+    async def set_war_scoreboard(self, war_id: int, channel_id: int, message_id: int, guild_id: int):
+        war = self.wars.get(guild_id, {}).get(war_id)
+        if war is not None:
+            war.update(scoreboard_channel_id=channel_id, scoreboard_message_id=message_id)
+
+    # --- guild settings ---
+    async def load_guild_settings(self) -> list[tuple]:
+        return [
+            (guild_id, *(values.get(k) for k in GUILD_SETTING_KEYS))
+            for guild_id, values in self.settings.items()
+        ]
+
+    async def update_guild_settings(self, values: dict, guild_id: int):
+        self.settings.setdefault(guild_id, {}).update(values)
+
+    # --- activity ---
+    async def record_activity(self, rows: list[Tuple[str, str, int, Optional[int], int]], guild_id: int):
+        for day, week, user_id, faction_id, count in rows:
+            for window, bucket in (("day", day), ("week", week)):
+                for kind, key_id in (("user", user_id), ("faction", faction_id)):
+                    if key_id is None:
+                        continue
+                    counts = self.activity[(window, kind)].setdefault(guild_id, {})
+                    counts[(bucket, key_id)] = counts.get((bucket, key_id), 0) + count
+
+    async def activity_series(
+        self,
+        window: str,
+        since: str,
+        guild_id: int,
+        *,
+        faction_id: Optional[int] = None,
+        user_id: Optional[int] = None,
+    ) -> list[Tuple[str, int]]:
+        kind, key_id = ("faction", faction_id) if faction_id is not None else ("user", user_id)
+        counts = self.activity[(window, kind)].get(guild_id, {})
+        return sorted((bucket, n) for (bucket, i), n in counts.items() if i == key_id and bucket >= since)
+
+    async def top_activity(
+        self,
+        window: str,
+        since: str,
+        guild_id: int,
+        *,
+        faction_id: Optional[int] = None,
+        limit: int = 5,
+    ) -> list[Tuple[int, int]]:
+        if faction_id is not None:
+            members = self.members.get(guild_id, {}).get(faction_id, {})
+            counts = self.activity[(window, "user")].get(guild_id, {})
+        else:
+            counts = self.activity[(window, "faction")].get(guild_id, {})
+        totals: dict[int, int] = {}
+        for (bucket, i), n in counts.items():
+            if bucket < since:
+                continue
+            if faction_id is not None and i not in members:
+                continue
+            if faction_id is None and not self._live_faction(i, guild_id):
+                continue
+            totals[i] = totals.get(i, 0) + n
+        return sorted(totals.items(), key=lambda kv: kv[1], reverse=True)[:limit]
+
+    # --- guild removal ---
+    async def purge_guild(self, guild_id: int, limit: int) -> int:
+        # dict ごと外すだけなので一度に済む
+        deleted = sum(len(roster) for roster in self.members.pop(guild_id, {}).values())
+        deleted += sum(
+            len(rows)
+            for rows in (
+                self.factions.pop(guild_id, {}),
+                self.wars.pop(guild_id, {}),
+                *(counts.pop(guild_id, {}) for counts in self.activity.values()),
+            )
+        )
+        deleted += self.settings.pop(guild_id, None) is not None
+        return deleted
+
+
+STORAGE_BACKENDS = {"sqlite": SQLiteStorage, "memory": MemoryStorage}
+storage: Storage = STORAGE_BACKENDS[STORAGE_BACKEND]()
+
+
+# ===================== 通貨関連 =====================
+
+async def stress_test_transfers(
+    users: int = 50,
+    transfers: int = 5000,
+    concurrency: int = 200,
+    initial: int = 1000,
+) -> bool:
+    """ランダムな送金を並行に流し、残高の合計が保存されマイナスが出ないことを確認する"""
+    import random
+
+    user_ids = list(range(1, users + 1))
+    await storage.reset_balances(user_ids, initial)
+
+    sem = asyncio.Semaphore(concurrency)
+    results = {"ok": 0, "rejected": 0, "errors": 0}
+
+    async def one():
+        src, dst = random.sample(user_ids, 2)
+        amount = random.randint(1, initial // 2)
+        async with sem:
+            try:
+                res = await storage.transfer_balance(src, dst, amount)
+            except Exception as e:
+                results["errors"] += 1
+                print(f"transfer error: {e}", file=sys.stderr)
+                return
+        results["ok" if res else "rejected"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(transfers)))
+    elapsed = time.perf_counter() - started
+
+    total, minimum = await storage.balance_stats(user_ids)
+
+    expected = users * initial
+    passed = total == expected and minimum >= 0 and results["errors"] == 0
+    print(
+        f"{transfers} transfers in {elapsed:.2f}s ({transfers / elapsed:.0f}/s): "
+        f"ok={results['ok']} rejected={results['rejected']} errors={results['errors']} "
+        f"total={total} (expected {expected}) min={minimum} -> {'PASS' if passed else 'FAIL'}",
+        file=sys.stderr,
+    )
+    return passed
+
+
+# ===================== 派閥関連 =====================
+# 読み取りは storage を直接使う。メンバーの増減はキャッシュも更新するのでここを通す。
+
+async def add_faction_member(user_id: int, faction_id: int, role: str, guild_id: int):
+    await storage.add_faction_members([user_id], faction_id, role, guild_id)
+    update_membership_index(guild_id, ("set", user_id, (faction_id, role)))
+    note_war_membership(guild_id, [user_id], faction_id)
+
+
+async def add_faction_members_bulk(
+    user_ids: list[int],
+    faction_id: int,
+    role: str,
+    guild_id: int,
+):
+    """複数メンバーを1トランザクションでまとめて登録する"""
+    await storage.add_faction_members(user_ids, faction_id, role, guild_id)
+    for uid in user_ids:
+        update_membership_index(guild_id, ("set", uid, (faction_id, role)))
+    note_war_membership(guild_id, user_ids, faction_id)
+
+
+async def remove_faction_member(user_id: int, faction_id: int, guild_id: int):
+    await storage.remove_faction_member(user_id, faction_id, guild_id)
+    update_membership_index(guild_id, ("remove", user_id, faction_id))
+    note_war_membership(guild_id, [user_id], None)
+
+
+# ===================== メンバー参照（省メモリモード対応） =====================
+
+# (guild_id, user_id) -> (表示名 or None, 取得時刻)
+member_name_cache: "OrderedDict[Tuple[int, int], Tuple[Optional[str], float]]" = OrderedDict()
+
+
+async def resolve_member_name(guild: discord.Guild, user_id: int) -> Optional[str]:
+    """キャッシュに無ければ API から取得し、表示名を LRU に保持する"""
+    member = guild.get_member(user_id)
+    if member is not None:
+        return member.display_name
+
+    key = (guild.id, user_id)
+    cached = member_name_cache.get(key)
+    if cached is not None and time.monotonic() - cached[1] < MEMBER_NAME_CACHE_TTL:
+        member_name_cache.move_to_end(key)
+        incr_metric("member_lookup.cache_hit")
+        return cached[0]
+
+    incr_metric("member_lookup.fetch")
+    try:
+        name = (await guild.fetch_member(user_id)).display_name
+    except discord.NotFound:
+        name = None  # サーバーにいない（これもキャッシュする）
+    except discord.HTTPException:
+        return None
+
+    member_name_cache[key] = (name, time.monotonic())
+    member_name_cache.move_to_end(key)
+    while len(member_name_cache) > MEMBER_NAME_CACHE_SIZE:
+        member_name_cache.popitem(last=False)
+    return name
+
+
+async def get_role_members(guild: discord.Guild, role: discord.Role) -> list[discord.Member]:
+    """ロールを持つメンバー一覧。メンバーキャッシュが無い場合はキャッシュせずに一括取得する"""
+    if guild.chunked:
+        return role.members
+    members = await guild.chunk(cache=False)
+    return [m for m in members if m.get_role(role.id) is not None]
+
+
+def current_rss_mb() -> float:
+    """現在の常駐メモリ（MB）。/proc が無い環境では最大値で代用する"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# ===================== 所属インデックス =====================
+
+# guild_id -> {user_id: (faction_id, role)}
+# ギルドごとに初回参照時に一括ロードし、以降はメンバー追加/削除と派閥解体で更新する。
+membership_index: dict[int, dict[int, Tuple[int, str]]] = {}
+# guild_id -> 一括ロード中のタスク（同時に来たロードはこれを待つ）
+membership_loads: dict[int, asyncio.Task] = {}
+# guild_id -> 一括ロード中に起きた変更。読み込んだ行は古いかもしれないので、ロード後に上から適用する
+membership_pending: dict[int, list[tuple]] = {}
+
+
+def _apply_membership_change(index: dict, change: tuple):
+    kind = change[0]
+    if kind == "set":
+        _kind, user_id, entry = change
+        index[user_id] = entry
+    elif kind == "remove":
+        _kind, user_id, faction_id = change
+        if index.get(user_id, (None,))[0] == faction_id:
+            del index[user_id]
+    elif kind == "drop":
+        faction_id = change[1]
+        for user_id in [uid for uid, (fid, _r) in index.items() if fid == faction_id]:
+            del index[user_id]
+
+
+def update_membership_index(guild_id: int, change: tuple):
+    """("set", user_id, (faction_id, role)) / ("remove", user_id, faction_id) / ("drop", faction_id)"""
+    index = membership_index.get(guild_id)
+    if index is not None:
+        _apply_membership_change(index, change)
+    pending = membership_pending.get(guild_id)
+    if pending is not None:
+        pending.append(change)
+
+
+async def _load_membership_index(guild_id: int) -> dict[int, Tuple[int, str]]:
+    pending = membership_pending[guild_id] = []
+    try:
+        rows = await storage.list_memberships(guild_id)
+        index = {user_id: (faction_id, role) for user_id, faction_id, role in rows}
+        for change in pending:
+            _apply_membership_change(index, change)
+        membership_index[guild_id] = index
+        return index
+    finally:
+        membership_pending.pop(guild_id, None)
+        membership_loads.pop(guild_id, None)
+
+
+async def load_membership_index(guild_id: int) -> dict[int, Tuple[int, str]]:
+    index = membership_index.get(guild_id)
+    if index is not None:
+        return index
+
+    task = membership_loads.get(guild_id)
+    if task is None:
+        task = membership_loads[guild_id] = asyncio.create_task(_load_membership_index(guild_id))
+    # 待っている側がキャンセルされてもロードは止めない
+    return await asyncio.shield(task)
+
+
+def drop_faction_from_index(guild_id: int, faction_id: int):
+    update_membership_index(guild_id, ("drop", faction_id))
+
+
+# ===================== 戦争参加者キャッシュ =====================
+
+# guild_id -> (war_id, attacker_faction_id, defender_faction_id)。戦争が無いギルドは入らない。
+active_war_cache: dict[int, Tuple[int, int, int]] = {}
+# guild_id -> {user_id: faction_id}。戦争中の2派閥に所属するユーザーだけを持つ。
+war_participants: dict[int, dict[int, int]] = {}
+# guild_id -> [attacker_messages, defender_messages]。スコアボード表示用（正は DB の値）
+war_counts: dict[int, list[int]] = {}
+
+
+async def load_war_state():
+    """起動時: 全ギルドの進行中の戦争と参加者をまとめて読み込む"""
+    wars, members = await storage.load_active_wars()
+    restore_war_state(wars, members)
+
+
+def restore_war_state(wars, members):
+    """load_active_wars と同じ形の行からキャッシュを作り直す（スナップショットからも使う）"""
+    active_war_cache.clear()
+    war_participants.clear()
+    war_counts.clear()
+    scoreboards.clear()
+    for (guild_id, war_id, attacker_id, defender_id, attacker_msgs, defender_msgs,
+         channel_id, message_id, attacker_name, defender_name) in wars:
+        active_war_cache[guild_id] = (war_id, attacker_id, defender_id)
+        war_participants[guild_id] = {}
+        war_counts[guild_id] = [attacker_msgs, defender_msgs]
+        if channel_id and message_id:
+            # 再起動後も同じメッセージを編集し続ける
+            scoreboards[guild_id] = {
+                "war_id": war_id,
+                "channel_id": channel_id,
+                "message_id": message_id,
+                "attacker_name": attacker_name,
+                "defender_name": defender_name,
+                "rendered": None,
+            }
+    for guild_id, user_id, faction_id in members:
+        war_participants.setdefault(guild_id, {})[user_id] = faction_id
+
+
+async def rebuild_war_participants(guild_id: int):
+    """戦争の開始/終了時: そのギルドの参加者集合を作り直す"""
+    war = await storage.get_active_war(guild_id)
+    if not war:
+        active_war_cache.pop(guild_id, None)
+        war_participants.pop(guild_id, None)
+        war_counts.pop(guild_id, None)
+        return
+
+    war_id, attacker_id, defender_id, attacker_msgs, defender_msgs = war
+    rows = await storage.list_faction_members([attacker_id, defender_id], guild_id)
+    active_war_cache[guild_id] = (war_id, attacker_id, defender_id)
+    war_participants[guild_id] = {user_id: faction_id for user_id, faction_id in rows}
+    war_counts[guild_id] = [attacker_msgs, defender_msgs]
+
+
+def note_war_membership(guild_id: int, user_ids: list[int], faction_id: Optional[int]):
+    """所属変更を参加者集合に反映する（faction_id=None は脱退）"""
+    war = active_war_cache.get(guild_id)
+    if war is None:
+        return
+    participants = war_participants.setdefault(guild_id, {})
+    for user_id in user_ids:
+        if faction_id is not None and faction_id in war[1:]:
+            participants[user_id] = faction_id
+        else:
+            participants.pop(user_id, None)
+
+
+def drop_faction_from_war_participants(guild_id: int, faction_id: int):
+    participants = war_participants.get(guild_id)
+    if participants:
+        for user_id in [uid for uid, fid in participants.items() if fid == faction_id]:
+            del participants[user_id]
+
+
+# ===================== 戦争関連 =====================
+
+async def add_message_for_war(user_id: int, guild_id: int):
+    # 戦争中の派閥のメンバー以外は DB に触れずに終わる
+    faction_id = war_participants.get(guild_id, {}).get(user_id)
+    if faction_id is None:
+        return
+    war = active_war_cache.get(guild_id)
+    if war is None:
+        return
+
+    war_id, attacker_id, defender_id = war
+    is_attacker = faction_id == attacker_id
+    updated = await storage.add_war_message(war_id, is_attacker, guild_id)
+    counts = war_counts.get(guild_id)
+    if updated and counts is not None and active_war_cache.get(guild_id) == war:
+        counts[0 if is_attacker else 1] += 1
+
+
+# ===================== 戦争スコアボード =====================
+
+# guild_id -> {"war_id", "channel_id", "message_id", "attacker_name", "defender_name", "rendered"}
+# rendered は最後に編集した時点の (attacker, defender)。None なら次の周期で必ず編集する。
+# final は投稿前に戦争が終わったときの最終結果（投稿直後にこの内容で編集する）。
+scoreboards: dict[int, dict] = {}
+
+
+def render_scoreboard(board: dict, counts, result: Optional[str] = None) -> str:
+    attacker_msgs, defender_msgs = counts
+    lines = [
+        "📊 **戦争スコアボード**" if result is None else "🏁 **戦争スコアボード（終了）**",
+        f"攻撃側 **{board['attacker_name']}**: {attacker_msgs} メッセージ",
+        f"防衛側 **{board['defender_name']}**: {defender_msgs} メッセージ",
+    ]
+    if result is None:
+        lines.append(f"最終更新: <t:{int(time.time())}:R>")
+    else:
+        lines.append(result)
+    return "\n".join(lines)
+
+
+def scoreboard_url(guild_id: int) -> Optional[str]:
+    board = scoreboards.get(guild_id)
+    if not board or not board["message_id"]:
+        return None
+    return f"https://discord.com/channels/{guild_id}/{board['channel_id']}/{board['message_id']}"
+
+
+def start_scoreboard(
+    guild_id: int,
+    war_id: int,
+    channel: discord.TextChannel,
+    attacker_name: str,
+    defender_name: str,
+):
+    """スコアボードを投稿してピン留めし、メッセージ ID を wars に保存する"""
+    board = {
+        "war_id": war_id,
+        "channel_id": channel.id,
+        "message_id": None,
+        "attacker_name": attacker_name,
+        "defender_name": defender_name,
+        "rendered": (0, 0),
+    }
+    scoreboards[guild_id] = board
+
+    async def post():
+        message = await channel.send(render_scoreboard(board, board["rendered"]))
+        board["message_id"] = message.id
+        if board.get("final") is not None:
+            # 投稿を待つ間に戦争が終わっていたので、ピン留めせず最終結果で編集する
+            queue_scoreboard_edit(board, board["final"])
+            return
+        try:
+            await message.pin(reason="戦争スコアボード")
+        except discord.HTTPException as e:
+            print(f"Failed to pin scoreboard in {channel.id}: {e}")
+        await storage.set_war_scoreboard(war_id, channel.id, message.id, guild_id)
+
+    enqueue_outbound(channel.id, post, coalesce_key=f"scoreboard_post:{war_id}")
+
+
+def queue_scoreboard_edit(board: dict, content: str, *, unpin: bool = False):
+    """スコアボードの編集をアウトボックスに積む（未送信の古い編集は置き換わる）"""
+    channel = bot.get_channel(board["channel_id"])
+    if channel is None or not board["message_id"]:
+        return
+    message = channel.get_partial_message(board["message_id"])
+
+    async def edit():
+        try:
+            await message.edit(content=content)
+            if unpin:
+                await message.unpin(reason="戦争終了")
+        except discord.NotFound:
+            # 手動で消された場合は以後編集しない
+            board["message_id"] = None
+
+    enqueue_outbound(board["channel_id"], edit, coalesce_key=f"scoreboard:{board['war_id']}")
+
+
+def finish_scoreboard(guild_id: int, counts, result: str):
+    """戦争終了時: 最終結果で編集してピンを外す"""
+    board = scoreboards.pop(guild_id, None)
+    if board is None:
+        return
+    content = render_scoreboard(board, counts, result)
+    if board["message_id"]:
+        queue_scoreboard_edit(board, content, unpin=True)
+    else:
+        # まだ投稿されていない。投稿後に post() がこの内容で編集する
+        board["final"] = content
+
+
+async def scoreboard_loop():
+    """カウントが変わったスコアボードだけを SCOREBOARD_INTERVAL ごとに編集する"""
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        await asyncio.sleep(SCOREBOARD_INTERVAL)
+        for guild_id, board in list(scoreboards.items()):
+            counts = war_counts.get(guild_id)
+            if counts is None or not board["message_id"]:
+                continue
+            snapshot = tuple(counts)
+            if snapshot == board["rendered"]:
+                continue
+            board["rendered"] = snapshot
+            queue_scoreboard_edit(board, render_scoreboard(board, snapshot))
+            incr_metric("scoreboard.edits")
+
+
+# ===================== ギルド設定 =====================
+
+# 設定が無いギルド・NULL の列はこの値を使う
+DEFAULT_GUILD_SETTINGS: dict = {
+    "war_status_channel_id": None,
+    "faction_create_cost": FACTION_CREATE_COST,
+    "message_reward": MESSAGE_REWARD,
+    "reward_cooldown_seconds": REWARD_COOLDOWN_SECONDS,
+}
+GUILD_SETTING_KEYS = tuple(DEFAULT_GUILD_SETTINGS)
+
+# guild_id -> 設定。起動時に全件読み込み、変更時は DB と同時に更新する（ホットパスは DB を読まない）
+guild_settings_cache: dict[int, dict] = {}
+
+
+async def load_guild_settings():
+    rows = await storage.load_guild_settings()
+
+    guild_settings_cache.clear()
+    for guild_id, *values in rows:
+        settings = dict(DEFAULT_GUILD_SETTINGS)
+        for key, value in zip(GUILD_SETTING_KEYS, values):
+            if value is not None:
+                settings[key] = value
+        guild_settings_cache[guild_id] = settings
+
+
+def get_guild_settings(guild_id: int) -> dict:
+    """キャッシュ済みの設定を返す（読み取り専用として扱うこと）"""
+    return guild_settings_cache.get(guild_id, DEFAULT_GUILD_SETTINGS)
+
+
+async def update_guild_settings(guild_id: int, **values):
+    """指定した項目だけ書き込み、キャッシュにも反映する"""
+    unknown = set(values) - set(GUILD_SETTING_KEYS)
+    if unknown:
+        raise ValueError(f"unknown guild settings: {', '.join(sorted(unknown))}")
+    if not values:
+        return
+
+    await storage.update_guild_settings(values, guild_id)
+
+    settings = dict(get_guild_settings(guild_id))
+    settings.update(values)
+    guild_settings_cache[guild_id] = settings
+
+
+async def set_guild_war_status_channel_id(guild_id: int, channel_id: int):
+    await update_guild_settings(guild_id, war_status_channel_id=channel_id)
+
+
+async def get_war_status_channel(guild: discord.Guild) -> Optional[discord.TextChannel]:
+    channel_id = get_guild_settings(guild.id)["war_status_channel_id"]
+    if channel_id:
+        ch = guild.get_channel(channel_id)
+        if isinstance(ch, discord.TextChannel):
+            return ch
+    return None
+
+
+# ===================== 派閥解体 & 解散ヘルパー =====================
+
+async def destroy_faction(guild: discord.Guild, faction_row):
+    (
+        faction_id,
         guild_id,
         name,
         leader_id,
@@ -432,16 +2800,9 @@ async def destroy_faction(guild: discord.Guild, faction_row):
                 pass
 
     # DB 更新
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE factions SET destroyed = 1 WHERE id = ?",
-            (faction_id,),
-        )
-        await db.execute(
-            "DELETE FROM faction_members WHERE faction_id = ?",
-            (faction_id,),
-        )
-        await db.commit()
+    await storage.destroy_faction(faction_id, guild.id)
+    drop_faction_from_index(guild.id, faction_id)
+    drop_faction_from_war_participants(guild.id, faction_id)
 
 
 async def attempt_disband_faction(
@@ -450,17 +2811,15 @@ async def attempt_disband_faction(
     faction_id_override: Optional[int] = None,
 ) -> Tuple[bool, str]:
     """派閥解散の共通処理（コマンド/ボタン両方から呼ぶ）"""
+    # 所属と派閥の行を1回で読む
+    context = await storage.get_faction_context(user.id, guild.id, faction_id=faction_id_override)
+    user_fid, _role, _target_fid, _target_role, faction, _member_count = context
     if faction_id_override is None:
-        faction_id, _role = await get_faction_role(user.id, guild.id)
-        if not faction_id:
+        if not user_fid:
             return False, "あなたはどの派閥にも所属していません。"
-    else:
-        faction_id = faction_id_override
-        user_fid = await get_user_faction_id(user.id, guild.id)
-        if user_fid != faction_id and not user.guild_permissions.administrator:
-            return False, "この派閥のメンバーではありません。"
+    elif user_fid != faction_id_override and not user.guild_permissions.administrator:
+        return False, "この派閥のメンバーではありません。"
 
-    faction = await get_faction_by_id(faction_id)
     if not faction or faction[13] == 1:
         return False, "派閥情報が見つかりません。"
 
@@ -489,23 +2848,1332 @@ async def attempt_disband_faction(
         return False, "派閥解散はリーダー（またはサーバー管理者）のみ可能です。"
 
     await destroy_faction(guild, faction)
+    log_event(guild.id, "faction.disband", actor_id=user.id, faction_id=fid, name=name)
     return True, f"派閥 **{name}** を解散しました。"
 
 
+# ===================== 退出・サーバー削除時の後片付け =====================
+
+# guild_id -> サーバーを抜けたユーザー。DEPARTURE_FLUSH_INTERVAL ごとにまとめて派閥から外す
+departure_queue: dict[int, set[int]] = {}
+departure_flush_lock = asyncio.Lock()
+# guild_id -> ボットが外されたギルドの削除タスク
+guild_purge_tasks: dict[int, asyncio.Task] = {}
+
+
+def note_departure(guild_id: int, user_id: int):
+    departure_queue.setdefault(guild_id, set()).add(user_id)
+    member_name_cache.pop((guild_id, user_id), None)
+
+
+async def hand_over_leadership(guild: discord.Guild, faction_id: int, leader_id: int, successor_id: Optional[int]):
+    """抜けたリーダーの後任にリーダーロールを付け替える。後任がいなければ派閥ごと片付ける。"""
+    async with keyed_locks(faction_key(guild.id, faction_id)):
+        await _hand_over_leadership(guild, faction_id, leader_id, successor_id)
+
+
+async def _hand_over_leadership(guild: discord.Guild, faction_id: int, leader_id: int, successor_id: Optional[int]):
+    faction = await storage.get_faction_by_id(faction_id, guild.id)
+    if not faction or faction[13] == 1:
+        return
+    if successor_id is None:
+        await destroy_faction(guild, faction)
+        log_event(guild.id, "faction.auto_disband", faction_id=faction_id, target_id=leader_id, name=faction[2])
+        return
+
+    update_membership_index(guild.id, ("set", successor_id, (faction_id, "leader")))
+    log_event(guild.id, "faction.leader_succession", faction_id=faction_id, actor_id=leader_id, target_id=successor_id)
+
+    member = guild.get_member(successor_id)
+    try:
+        if member is None:
+            member = await guild.fetch_member(successor_id)
+        leader_role = guild.get_role(faction[5])
+        officer_role = guild.get_role(faction[6])
+        if leader_role is not None:
+            await member.add_roles(leader_role, reason="前リーダーの退出による引き継ぎ")
+        if officer_role is not None and member.get_role(officer_role.id) is not None:
+            await member.remove_roles(officer_role, reason="前リーダーの退出による引き継ぎ")
+    except discord.HTTPException as e:
+        # ロールは整合性チェックで後から直る
+        print(f"Failed to update roles for new leader {successor_id} of faction {faction_id}: {e}")
+
+
+async def flush_departures():
+    global departure_queue
+    async with departure_flush_lock:
+        if not departure_queue:
+            return
+        batch, departure_queue = departure_queue, {}
+        for guild_id, user_ids in batch.items():
+            guild = bot.get_guild(guild_id)
+            if guild is None:
+                continue  # ボットごと外れたギルドは purge_guild_data が消す
+            try:
+                removed, successions = await storage.remove_departed_members(sorted(user_ids), guild_id)
+            except Exception as e:
+                print(f"Failed to remove departed members in guild {guild_id}: {e}")
+                departure_queue.setdefault(guild_id, set()).update(user_ids)
+                continue
+
+            for user_id, faction_id in removed:
+                update_membership_index(guild_id, ("remove", user_id, faction_id))
+                note_war_membership(guild_id, [user_id], None)
+                log_event(guild_id, "faction.member_departed", faction_id=faction_id, target_id=user_id)
+            for faction_id, leader_id, successor_id in successions:
+                try:
+                    await hand_over_leadership(guild, faction_id, leader_id, successor_id)
+                except Exception as e:
+                    print(f"Failed to hand over faction {faction_id}: {e}")
+            incr_metric("departures.removed", len(removed))
+            incr_metric("departures.successions", len(successions))
+
+
+async def departure_flush_loop():
+    while not bot.is_closed():
+        await asyncio.sleep(DEPARTURE_FLUSH_INTERVAL)
+        try:
+            await flush_departures()
+        except Exception as e:
+            print(f"Failed to flush departures: {e}")
+
+
+def forget_guild(guild_id: int):
+    """ボットが外されたギルドのキャッシュとバッファを捨てる"""
+    membership_index.pop(guild_id, None)
+    active_war_cache.pop(guild_id, None)
+    war_participants.pop(guild_id, None)
+    war_counts.pop(guild_id, None)
+    scoreboards.pop(guild_id, None)
+    guild_settings_cache.pop(guild_id, None)
+    departure_queue.pop(guild_id, None)
+    for key in [k for k in activity_buffer if k[0] == guild_id]:
+        del activity_buffer[key]
+    for key in [k for k in member_name_cache if k[0] == guild_id]:
+        del member_name_cache[key]
+    for key in [k for k in reconcile_flagged if k[0] == guild_id]:
+        del reconcile_flagged[key]
+
+
+async def purge_guild_data(guild_id: int):
+    """ギルドの行を GUILD_PURGE_CHUNK 行ずつ消す。書き込みロックを長く握らないよう間をあける。"""
+    total = 0
+    started = time.perf_counter()
+    try:
+        while True:
+            deleted = await storage.purge_guild(guild_id, GUILD_PURGE_CHUNK)
+            if not deleted:
+                break
+            total += deleted
+            await asyncio.sleep(GUILD_PURGE_PAUSE)
+    except asyncio.CancelledError:
+        print(f"Purge of guild {guild_id} cancelled after {total} row(s).")
+        raise
+    finally:
+        guild_purge_tasks.pop(guild_id, None)
+    incr_metric("guild_purge.rows", total)
+    print(f"Purged {total} row(s) for guild {guild_id} in {time.perf_counter() - started:.1f}s.")
+
+
+# ===================== 監査ログ =====================
+
+# (guild_id, faction_id, actor_id, action, target_id, payload, created_at)
+audit_buffer: list[tuple] = []
+audit_flush_event = asyncio.Event()
+audit_flush_lock = asyncio.Lock()
+
+
+def log_event(
+    guild_id: int,
+    action: str,
+    *,
+    actor_id: Optional[int] = None,
+    faction_id: Optional[int] = None,
+    target_id: Optional[int] = None,
+    **payload,
+):
+    """監査イベントをバッファに積むだけ（DB 書き込みはバックグラウンドでまとめて行う）"""
+    audit_buffer.append(
+        (
+            guild_id,
+            faction_id,
+            actor_id,
+            action,
+            target_id,
+            json.dumps(payload, ensure_ascii=False) if payload else None,
+            int(time.time()),
+        )
+    )
+    if len(audit_buffer) >= AUDIT_FLUSH_MAX:
+        audit_flush_event.set()
+
+
+async def flush_audit_events():
+    global audit_buffer
+    async with audit_flush_lock:
+        if not audit_buffer:
+            return
+        batch, audit_buffer = audit_buffer, []
+        try:
+            async with aiosqlite.connect(DB_PATH) as db:
+                await db.executemany(
+                    """
+                    INSERT INTO audit_events (
+                        guild_id, faction_id, actor_id, action, target_id, payload, created_at
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    batch,
+                )
+                await db.commit()
+        except Exception:
+            # 失敗したら次回に回す
+            audit_buffer[:0] = batch
+            raise
+        incr_metric("audit.written", len(batch))
+
+
+async def audit_flush_loop():
+    while not bot.is_closed():
+        try:
+            await asyncio.wait_for(audit_flush_event.wait(), timeout=AUDIT_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        audit_flush_event.clear()
+        try:
+            await flush_audit_events()
+        except Exception as e:
+            print(f"Failed to flush audit events: {e}")
+
+
+async def query_audit_events(
+    guild_id: int,
+    *,
+    user_id: Optional[int] = None,
+    faction_id: Optional[int] = None,
+    limit: int = 20,
+) -> list[tuple]:
+    await flush_audit_events()
+    sql = (
+        "SELECT id, faction_id, actor_id, action, target_id, payload, created_at "
+        "FROM audit_events WHERE guild_id = ?"
+    )
+    params: list = [guild_id]
+    if faction_id is not None:
+        sql += " AND faction_id = ?"
+        params.append(faction_id)
+    if user_id is not None:
+        sql += " AND (actor_id = ? OR target_id = ?)"
+        params.extend([user_id, user_id])
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+
+    async with aiosqlite.connect(DB_PATH) as db:
+        cur = await db.execute(sql, params)
+        rows = await cur.fetchall()
+        await cur.close()
+    return rows
+
+
+async def compact_audit_events() -> int:
+    """保持期間を過ぎたイベントを日別・アクション別の件数に畳んで削除する"""
+    cutoff = int(time.time()) - AUDIT_RETENTION_DAYS * 86400
+    compacted = 0
+    while True:
+        async with aiosqlite.connect(DB_PATH) as db:
+            cur = await db.execute(
+                """
+                SELECT MAX(id) FROM (
+                    SELECT id FROM audit_events
+                    WHERE created_at < ?
+                    ORDER BY created_at
+                    LIMIT ?
+                )
+                """,
+                (cutoff, AUDIT_COMPACT_CHUNK),
+            )
+            row = await cur.fetchone()
+            await cur.close()
+            upper = row[0] if row else None
+            if upper is None:
+                break
+
+            await db.execute(
+                """
+                INSERT INTO audit_summaries (guild_id, day, action, faction_id, count)
+                SELECT guild_id, date(created_at, 'unixepoch'), action,
+                       COALESCE(faction_id, 0), COUNT(*)
+                FROM audit_events
+                WHERE id <= ? AND created_at < ?
+                GROUP BY 1, 2, 3, 4
+                ON CONFLICT (guild_id, day, action, faction_id)
+                DO UPDATE SET count = count + excluded.count
+                """,
+                (upper, cutoff),
+            )
+            cur = await db.execute(
+                "DELETE FROM audit_events WHERE id <= ? AND created_at < ?",
+                (upper, cutoff),
+            )
+            deleted = cur.rowcount
+            await db.commit()
+        compacted += deleted
+        if deleted < AUDIT_COMPACT_CHUNK:
+            break
+        # 大量にある場合も他の書き込みを詰まらせないよう間をあける
+        await asyncio.sleep(0.05)
+    incr_metric("audit.compacted", compacted)
+    return compacted
+
+
+async def audit_compaction_loop():
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        try:
+            n = await compact_audit_events()
+            if n:
+                print(f"Compacted {n} audit event(s).")
+        except Exception as e:
+            print(f"Audit compaction failed: {e}")
+        await asyncio.sleep(24 * 3600)
+
+
+# ===================== 発言アクティビティ =====================
+
+# (guild_id, user_id, 日) -> 件数。on_message では数えるだけにして、まとめて集計テーブルへ足し込む
+activity_buffer: dict[Tuple[int, int, date], int] = {}
+activity_flush_event = asyncio.Event()
+activity_flush_lock = asyncio.Lock()
+
+
+def activity_bucket(day: date, window: str) -> str:
+    """日別ならその日、週別ならその週の月曜日（UTC）"""
+    if window == "week":
+        day -= timedelta(days=day.weekday())
+    return day.isoformat()
+
+
+def note_activity(guild_id: int, user_id: int, now: datetime):
+    key = (guild_id, user_id, now.date())
+    activity_buffer[key] = activity_buffer.get(key, 0) + 1
+    if len(activity_buffer) >= ACTIVITY_FLUSH_MAX:
+        activity_flush_event.set()
+
+
+def buffered_activity(guild_id: int, window: str, since: str) -> dict[Tuple[str, int], int]:
+    """まだ書き出していない分を (bucket, user_id) -> 件数 で返す（読み取り側で DB の値に足す）"""
+    counts: dict[Tuple[str, int], int] = {}
+    for (gid, user_id, day), count in activity_buffer.items():
+        if gid != guild_id:
+            continue
+        bucket = activity_bucket(day, window)
+        if bucket >= since:
+            counts[(bucket, user_id)] = counts.get((bucket, user_id), 0) + count
+    return counts
+
+
+async def flush_activity():
+    global activity_buffer
+    async with activity_flush_lock:
+        if not activity_buffer:
+            return
+        batch, activity_buffer = activity_buffer, {}
+        by_guild: dict[int, list[Tuple[date, int, int]]] = {}
+        for (guild_id, user_id, day), count in batch.items():
+            by_guild.setdefault(guild_id, []).append((day, user_id, count))
+
+        error = None
+        for guild_id, entries in by_guild.items():
+            try:
+                # 派閥別の集計は書き出す時点の所属で数える
+                index = await load_membership_index(guild_id)
+                rows = [
+                    (
+                        activity_bucket(day, "day"),
+                        activity_bucket(day, "week"),
+                        user_id,
+                        index.get(user_id, (None,))[0],
+                        count,
+                    )
+                    for day, user_id, count in entries
+                ]
+                await storage.record_activity(rows, guild_id)
+                incr_metric("activity.rows_written", len(rows))
+            except Exception as e:
+                # 失敗したギルドの分だけ次回に回す
+                for day, user_id, count in entries:
+                    key = (guild_id, user_id, day)
+                    activity_buffer[key] = activity_buffer.get(key, 0) + count
+                error = e
+        if error is not None:
+            raise error
+
+
+async def activity_flush_loop():
+    while not bot.is_closed():
+        try:
+            await asyncio.wait_for(activity_flush_event.wait(), timeout=ACTIVITY_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        activity_flush_event.clear()
+        try:
+            await flush_activity()
+        except Exception as e:
+            print(f"Failed to flush activity counts: {e}")
+
+
+async def prune_daily_activity(partition: Optional[int]) -> int:
+    """保持日数を過ぎた日別の行を消す（週別の行は残すので長期の推移はそちらで見る）"""
+    cutoff = activity_bucket(datetime.utcnow().date() - timedelta(days=ACTIVITY_DAILY_RETENTION_DAYS), "day")
+    deleted = 0
+    async with open_db(partition, cached=False) as db:
+        for table in ACTIVITY_TABLES["day"].values():
+            cur = await db.execute(f"DELETE FROM {table} WHERE bucket < ?", (cutoff,))
+            deleted += cur.rowcount
+        await db.commit()
+    return deleted
+
+
+# ===================== 定期経済ジョブ =====================
+
+# 各ジョブは users を主キー範囲ごとに区切り、範囲ごとに1文（または1トランザクション）で処理する
+ECONOMY_JOB_SQL = {
+    # 利息: 残高 × rate を加算（min_balance 以上のユーザーのみ）
+    "interest": (
+        """
+        UPDATE users SET balance = balance + CAST(balance * :rate AS INTEGER)
+        WHERE user_id > :lo AND user_id <= :hi AND balance > 0 AND balance >= :min_balance
+        """,
+    ),
+    # 減衰: min_balance を超える分に rate を掛けて差し引く
+    "decay": (
+        """
+        UPDATE users SET balance = balance - CAST((balance - :min_balance) * :rate AS INTEGER)
+        WHERE user_id > :lo AND user_id <= :hi AND balance > :min_balance
+        """,
+    ),
+    # シーズンリセット: 残高をアーカイブしてから 0 にする
+    "season_reset": (
+        """
+        INSERT OR REPLACE INTO users_season_archive (season, user_id, balance, archived_at)
+        SELECT :season, user_id, balance, :now FROM users
+        WHERE user_id > :lo AND user_id <= :hi AND balance != 0
+        """,
+        """
+        UPDATE users SET balance = 0
+        WHERE user_id > :lo AND user_id <= :hi AND balance != 0
+        """,
+    ),
+}
+
+economy_job_lock = asyncio.Lock()
+
+
+async def get_economy_jobs() -> list[tuple]:
+    async with aiosqlite.connect(DB_PATH) as db:
+        cur = await db.execute(
+            """
+            SELECT name, kind, rate, min_balance, interval_hours, enabled, last_run_at
+            FROM economy_jobs
+            ORDER BY name
+            """
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+    return rows
+
+
+async def run_economy_job(name: str) -> Tuple[int, int]:
+    """ジョブを1回実行して (更新行数, 所要ミリ秒) を返す。実行履歴も記録する。
+
+    範囲ごとのコミットと同じトランザクションで進捗を economy_job_runs に書くので、
+    途中で失敗・停止した実行は次回その続きから再開する（同じユーザーに二重に適用しない）。
+    """
+    async with economy_job_lock:
+        jobs = {row[0]: row for row in await get_economy_jobs()}
+        if name not in jobs:
+            raise ValueError(f"unknown economy job: {name}")
+        _name, kind, rate, min_balance, _interval, _enabled, _last = jobs[name]
+        statements = ECONOMY_JOB_SQL[kind]
+
+        started = time.perf_counter()
+        affected = 0
+        error = None
+        async with aiosqlite.connect(DB_PATH) as db:
+            cur = await db.execute(
+                """
+                SELECT id, started_at, status, last_key, season, rows_affected
+                FROM economy_job_runs
+                WHERE job_name = ?
+                ORDER BY id DESC
+                LIMIT 1
+                """,
+                (name,),
+            )
+            last_run = await cur.fetchone()
+            await cur.close()
+
+            if last_run is not None and (last_run[2] == "running" or (last_run[2] == "error" and last_run[3] is not None)):
+                run_id, started_at, _status, last_key, season, affected = last_run
+                lo = -1 if last_key is None else last_key
+                print(f"Resuming economy job {name} (run {run_id}) after user {lo}.")
+                await db.execute(
+                    "UPDATE economy_job_runs SET status = 'running', error = NULL WHERE id = ?",
+                    (run_id,),
+                )
+            else:
+                started_at = int(time.time())
+                lo = -1
+                season = None
+                if kind == "season_reset":
+                    cur = await db.execute("SELECT COALESCE(MAX(season), 0) + 1 FROM users_season_archive")
+                    season = (await cur.fetchone())[0]
+                    await cur.close()
+                cur = await db.execute(
+                    """
+                    INSERT INTO economy_job_runs (
+                        job_name, kind, started_at, duration_ms, rows_affected, status, season
+                    )
+                    VALUES (?, ?, ?, 0, 0, 'running', ?)
+                    """,
+                    (name, kind, started_at, season),
+                )
+                run_id = cur.lastrowid
+                await cur.close()
+            await db.commit()
+
+            params = {"rate": rate, "min_balance": min_balance, "now": started_at, "season": season}
+            try:
+                while True:
+                    cur = await db.execute(
+                        """
+                        SELECT MAX(user_id) FROM (
+                            SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?
+                        )
+                        """,
+                        (lo, ECONOMY_JOB_CHUNK),
+                    )
+                    hi = (await cur.fetchone())[0]
+                    await cur.close()
+                    if hi is None:
+                        break
+                    for sql in statements:
+                        cur = await db.execute(sql, {**params, "lo": lo, "hi": hi})
+                        await cur.close()
+                    # 最後の UPDATE で変更された行数を数える
+                    changed = max(cur.rowcount, 0)
+                    await db.execute(
+                        "UPDATE economy_job_runs SET last_key = ?, rows_affected = rows_affected + ? WHERE id = ?",
+                        (hi, changed, run_id),
+                    )
+                    await db.commit()
+                    affected += changed
+                    lo = hi
+                    # 範囲ごとにコミットして、メッセージ報酬などの書き込みを待たせない
+                    await asyncio.sleep(0)
+            except Exception as e:
+                error = str(e)
+                await db.rollback()
+
+            duration_ms = int((time.perf_counter() - started) * 1000)
+            await db.execute(
+                """
+                UPDATE economy_job_runs SET duration_ms = duration_ms + ?, status = ?, error = ?
+                WHERE id = ?
+                """,
+                (duration_ms, "error" if error else "ok", error, run_id),
+            )
+            # 失敗した実行は次の確認で再開させたいので、最終実行時刻は成功したときだけ進める
+            if not error:
+                await db.execute(
+                    "UPDATE economy_jobs SET last_run_at = ? WHERE name = ?",
+                    (started_at, name),
+                )
+            await db.commit()
+
+        incr_metric(f"economy_job.{kind}.runs")
+        if error:
+            incr_metric(f"economy_job.{kind}.errors")
+            raise RuntimeError(error)
+        return affected, duration_ms
+
+
+async def update_economy_job(name: str, **values):
+    allowed = {"rate", "min_balance", "interval_hours", "enabled"}
+    values = {k: v for k, v in values.items() if k in allowed and v is not None}
+    if not values:
+        return
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(
+            f"UPDATE economy_jobs SET {', '.join(f'{k} = ?' for k in values)} WHERE name = ?",
+            (*values.values(), name),
+        )
+        await db.commit()
+
+
+async def get_economy_job_runs(name: str, limit: int = 5) -> list[tuple]:
+    async with aiosqlite.connect(DB_PATH) as db:
+        cur = await db.execute(
+            """
+            SELECT started_at, duration_ms, rows_affected, status, error
+            FROM economy_job_runs
+            WHERE job_name = ?
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (name, limit),
+        )
+        rows = await cur.fetchall()
+        await cur.close()
+    return rows
+
+
+async def economy_job_loop():
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        now = int(time.time())
+        try:
+            for name, kind, _rate, _min, interval_hours, enabled, last_run_at in await get_economy_jobs():
+                if not enabled:
+                    continue
+                if last_run_at is not None and last_run_at + interval_hours * 3600 > now:
+                    continue
+                try:
+                    affected, duration_ms = await run_economy_job(name)
+                    print(f"Economy job {name}: {affected} row(s) in {duration_ms} ms")
+                except Exception as e:
+                    print(f"Economy job {name} failed: {e}")
+        except Exception as e:
+            print(f"Economy job scheduler failed: {e}")
+        await asyncio.sleep(ECONOMY_JOB_CHECK_INTERVAL)
+
+
+# ===================== 保持期間とアーカイブ =====================
+
+async def archive_rows(
+    partition: Optional[int],
+    table: str,
+    archive_table: str,
+    columns: tuple,
+    where: str,
+    params: tuple,
+) -> int:
+    """where に合う行を RETENTION_BATCH 件ずつアーカイブへ移す（1バッチ1トランザクション）"""
+    cols = ", ".join(columns)
+    moved = 0
+    while True:
+        async with open_db(partition, cached=False) as db:
+            cur = await db.execute(
+                f"SELECT id FROM {table} WHERE {where} ORDER BY id LIMIT ?",
+                (*params, RETENTION_BATCH),
+            )
+            ids = [r[0] for r in await cur.fetchall()]
+            await cur.close()
+            if not ids:
+                break
+            marks = ", ".join("?" for _ in ids)
+            await db.execute(
+                f"""
+                INSERT OR REPLACE INTO {archive_table} ({cols}, archived_at)
+                SELECT {cols}, ? FROM {table} WHERE id IN ({marks})
+                """,
+                (int(time.time()), *ids),
+            )
+            await db.execute(f"DELETE FROM {table} WHERE id IN ({marks})", ids)
+            await db.commit()
+        moved += len(ids)
+        if len(ids) < RETENTION_BATCH:
+            break
+        await asyncio.sleep(0.05)
+    return moved
+
+
+async def run_retention() -> Tuple[int, int]:
+    """保持期間を過ぎた解体済み派閥・終了済み戦争をアーカイブへ移し、空き領域を少し返す"""
+    now = int(time.time())
+    factions_moved = wars_moved = 0
+    for partition in list_storage_partitions():
+        # 進行中の戦争から参照されている派閥は残す
+        moved_f = await archive_rows(
+            partition,
+            "factions",
+            "factions_archive",
+            FACTION_ARCHIVE_COLUMNS,
+            """
+            destroyed = 1 AND COALESCE(destroyed_at, 0) < ?
+            AND id NOT IN (SELECT attacker_faction_id FROM wars WHERE active = 1)
+            AND id NOT IN (SELECT defender_faction_id FROM wars WHERE active = 1)
+            """,
+            (now - FACTION_RETENTION_DAYS * 86400,),
+        )
+        moved_w = await archive_rows(
+            partition,
+            "wars",
+            "wars_archive",
+            WAR_ARCHIVE_COLUMNS,
+            "active = 0 AND COALESCE(ended_at, 0) < ?",
+            (now - WAR_RETENTION_DAYS * 86400,),
+        )
+        pruned = await prune_daily_activity(partition)
+        incr_metric("retention.activity_pruned", pruned)
+        if moved_f or moved_w or pruned:
+            async with open_db(partition, cached=False) as db:
+                await db.execute(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES});")
+                await db.commit()
+        factions_moved += moved_f
+        wars_moved += moved_w
+
+    incr_metric("retention.factions_archived", factions_moved)
+    incr_metric("retention.wars_archived", wars_moved)
+    return factions_moved, wars_moved
+
+
+async def retention_loop():
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        try:
+            factions_moved, wars_moved = await run_retention()
+            if factions_moved or wars_moved:
+                print(f"Archived {factions_moved} faction(s) and {wars_moved} war(s).")
+        except Exception as e:
+            print(f"Retention job failed: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL_HOURS * 3600)
+
+
+# ===================== メッセージ処理キュー =====================
+
+# (user_id, guild_id, 報酬額（0 なら無し）, キューに積んだ時刻)
+message_queue: "asyncio.Queue[Tuple[int, int, int, float]]" = asyncio.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+
+
+async def enqueue_message_work(item: Tuple[int, int, int, float]):
+    """ポリシーに従ってキューに積む。積めなかった場合は破棄数を数える。"""
+    if MESSAGE_QUEUE_POLICY == "drop_oldest":
+        while True:
+            try:
+                message_queue.put_nowait(item)
+                break
+            except asyncio.QueueFull:
+                try:
+                    message_queue.get_nowait()
+                    message_queue.task_done()
+                    incr_metric("message_queue.dropped")
+                except asyncio.QueueEmpty:
+                    pass
+    elif MESSAGE_QUEUE_POLICY == "drop_new":
+        try:
+            message_queue.put_nowait(item)
+        except asyncio.QueueFull:
+            incr_metric("message_queue.dropped")
+    else:
+        # block: 満杯なら待つ（= イベント処理側に背圧をかける）。待ちすぎたら破棄。
+        try:
+            await asyncio.wait_for(message_queue.put(item), timeout=MESSAGE_QUEUE_PUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            incr_metric("message_queue.dropped")
+    set_metric("message_queue.depth", message_queue.qsize())
+
+
+async def message_worker():
+    while True:
+        user_id, guild_id, reward, enqueued_at = await message_queue.get()
+        try:
+            lag_ms = round((time.monotonic() - enqueued_at) * 1000, 1)
+            set_metric("message_queue.lag_ms_max", max(metrics.get("message_queue.lag_ms_max", 0), lag_ms))
+            if reward:
+                await storage.add_balance(user_id, reward)
+            await add_message_for_war(user_id, guild_id)
+            incr_metric("message_queue.processed")
+        except Exception as e:
+            incr_metric("message_queue.errors")
+            print(f"Failed to process message work: {e}")
+        finally:
+            message_queue.task_done()
+            set_metric("message_queue.depth", message_queue.qsize())
+
+
+# ===================== オンラインバックアップ =====================
+
+backup_lock = asyncio.Lock()
+
+
+def _backup_sync(src_path: str, dest_path: str):
+    """SQLite のオンラインバックアップ API で全ページを一度にコピーする（別スレッドで実行）"""
+    src = sqlite3.connect(src_path, timeout=30)
+    dst = sqlite3.connect(dest_path)
+    try:
+        # 少しずつコピーすると途中の書き込みのたびに最初からやり直しになり、書き込みが続くと終わらない。
+        # WAL モードなので読み取りトランザクション1回でコピーしても書き込みは止まらない。
+        src.backup(dst, pages=-1)
+    finally:
+        dst.close()
+        src.close()
+
+
+def rotate_backups():
+    """古いスナップショットを BACKUP_RETENTION 世代だけ残して削除する"""
+    files = sorted(glob.glob(os.path.join(BACKUP_DIR, "bot-*.db")))
+    for path in files[:-BACKUP_RETENTION] if BACKUP_RETENTION > 0 else []:
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Failed to remove old backup {path}: {e}")
+    dirs = sorted(glob.glob(os.path.join(BACKUP_DIR, "guilds-*")))
+    for path in dirs[:-BACKUP_RETENTION] if BACKUP_RETENTION > 0 else []:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+async def run_backup() -> Tuple[str, float]:
+    """スナップショットを1つ作成して (パス, 所要秒) を返す。同時実行はしない。"""
+    async with backup_lock:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        dest = os.path.join(BACKUP_DIR, f"bot-{stamp}.db")
+        tmp = dest + ".tmp"
+        guild_dir = os.path.join(BACKUP_DIR, f"guilds-{stamp}")
+        started = time.perf_counter()
+        try:
+            # スレッドで実行するのでイベントループ（on_message）は止まらない
+            await asyncio.to_thread(_backup_sync, DB_PATH, tmp)
+            os.replace(tmp, dest)
+            if is_partitioned():
+                # ギルド別DBは同じ時刻のディレクトリにまとめる
+                os.makedirs(guild_dir, exist_ok=True)
+                for guild_id in list_storage_partitions():
+                    src = guild_db_path(guild_id)
+                    await asyncio.to_thread(_backup_sync, src, os.path.join(guild_dir, os.path.basename(src)))
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            shutil.rmtree(guild_dir, ignore_errors=True)
+            incr_metric("backup.failed")
+            raise
+        elapsed = time.perf_counter() - started
+        rotate_backups()
+        incr_metric("backup.done")
+        set_metric("backup.last_seconds_max", round(elapsed, 2))
+        return dest, elapsed
+
+
+async def backup_loop():
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600)
+        try:
+            path, elapsed = await run_backup()
+            print(f"Backup written: {path} ({elapsed:.1f}s)")
+        except Exception as e:
+            print(f"Backup failed: {e}")
+
+
+# ===================== ウォームリスタート用スナップショット =====================
+# 終了時（と定期的に）キャッシュを固定長レコードのバイナリで保存し、起動時に mmap で読み戻す。
+# DB 由来の部分は PRAGMA user_version と終了時に DB に書いたマーカーが一致するときだけ使う。
+
+# 形式: ヘッダ, [セクションヘッダ + レコード列] * セクション数（すべてリトルエンディアン）
+SNAPSHOT_MAGIC = b"FBSN"
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHiQdI")  # マジック, 形式, user_version, マーカー, 作成時刻, セクション数
+SNAPSHOT_SECTION = struct.Struct("<BII")  # 種別, 件数, バイト数
+
+SNAP_SETTINGS = 1  # guild_id, GUILD_SETTING_KEYS の値（None は -1）。guild_id=0 は既定値
+SNAP_MEMBER_GUILDS = 2  # 所属インデックスを読み込み済みのギルド
+SNAP_MEMBERS = 3  # guild_id, user_id, faction_id, 役職コード
+SNAP_WARS = 4  # WAR_RECORD + 攻撃側名 + 防衛側名（UTF-8）
+SNAP_PARTICIPANTS = 5  # guild_id, user_id, faction_id
+SNAP_COOLDOWNS = 6  # user_id, 最後に報酬を出した時刻（UNIX 秒）
+
+SETTINGS_RECORD = struct.Struct("<q" + "q" * len(GUILD_SETTING_KEYS))
+GUILD_RECORD = struct.Struct("<q")
+MEMBER_RECORD = struct.Struct("<qqqB")
+# guild, war, attacker, defender, 攻撃側数, 防衛側数, スコアボードのチャンネル/メッセージ（0 はなし）, 名前のバイト数 x2
+WAR_RECORD = struct.Struct("<qqqqqqqqHH")
+PARTICIPANT_RECORD = struct.Struct("<qqq")
+COOLDOWN_RECORD = struct.Struct("<qd")
+
+ROLE_CODES = {"leader": 0, "officer": 1, "member": 2}
+ROLE_NAMES = {code: role for role, code in ROLE_CODES.items()}
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+
+def snapshot_path() -> str:
+    # クラスタではワーカーごとに別ファイル
+    return SNAPSHOT_PATH if cluster_worker_id is None else f"{SNAPSHOT_PATH}.{cluster_worker_id}"
+
+
+def snapshot_marker_key() -> str:
+    return f"snapshot_marker:{cluster_worker_id or 0}"
+
+
+async def get_db_user_version() -> int:
+    async with open_db() as db:
+        cur = await db.execute("PRAGMA user_version")
+        row = await cur.fetchone()
+        await cur.close()
+    return row[0]
+
+
+async def get_snapshot_marker() -> int:
+    async with open_db() as db:
+        cur = await db.execute("SELECT value FROM bot_state WHERE key = ?", (snapshot_marker_key(),))
+        row = await cur.fetchone()
+        await cur.close()
+    return row[0] if row else 0
+
+
+async def set_snapshot_marker(value: int):
+    async with open_db() as db:
+        await db.execute(
+            """
+            INSERT INTO bot_state (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            """,
+            (snapshot_marker_key(), value),
+        )
+        await db.commit()
+
+
+async def invalidate_snapshots():
+    """ボットの外で DB を書き換えたとき（インポートなど）に全ワーカーのスナップショットを無効にする"""
+    async with open_db() as db:
+        await db.execute("DELETE FROM bot_state WHERE key LIKE 'snapshot_marker:%'")
+        await db.commit()
+
+
+def encode_snapshot(user_version: int, marker: int) -> bytes:
+    """現在のキャッシュをバイト列にする（await を挟まないので一貫した状態になる）"""
+    sections = []
+
+    def add(kind: int, count: int, payload: bytes):
+        sections.append(SNAPSHOT_SECTION.pack(kind, count, len(payload)) + payload)
+
+    def pack_settings(guild_id: int, settings: dict) -> bytes:
+        return SETTINGS_RECORD.pack(
+            guild_id, *(-1 if settings[k] is None else settings[k] for k in GUILD_SETTING_KEYS)
+        )
+
+    add(
+        SNAP_SETTINGS,
+        len(guild_settings_cache) + 1,
+        pack_settings(0, DEFAULT_GUILD_SETTINGS)
+        + b"".join(pack_settings(gid, s) for gid, s in guild_settings_cache.items()),
+    )
+    add(SNAP_MEMBER_GUILDS, len(membership_index), b"".join(GUILD_RECORD.pack(gid) for gid in membership_index))
+    members = [
+        MEMBER_RECORD.pack(gid, uid, fid, ROLE_CODES[role])
+        for gid, index in membership_index.items()
+        for uid, (fid, role) in index.items()
+    ]
+    add(SNAP_MEMBERS, len(members), b"".join(members))
+
+    wars = []
+    for gid, (war_id, attacker_id, defender_id) in active_war_cache.items():
+        attacker_msgs, defender_msgs = war_counts.get(gid, (0, 0))
+        board = scoreboards.get(gid) or {}
+        names = [board.get("attacker_name", "").encode(), board.get("defender_name", "").encode()]
+        wars.append(
+            WAR_RECORD.pack(
+                gid, war_id, attacker_id, defender_id, attacker_msgs, defender_msgs,
+                board.get("channel_id") or 0, board.get("message_id") or 0, len(names[0]), len(names[1]),
+            )
+            + names[0]
+            + names[1]
+        )
+    add(SNAP_WARS, len(wars), b"".join(wars))
+    participants = [
+        PARTICIPANT_RECORD.pack(gid, uid, fid)
+        for gid, users in war_participants.items()
+        for uid, fid in users.items()
+    ]
+    add(SNAP_PARTICIPANTS, len(participants), b"".join(participants))
+
+    # 1日以上前のクールダウンはもう効かないので保存しない
+    cutoff = datetime.utcnow() - timedelta(days=1)
+    cooldowns = [
+        COOLDOWN_RECORD.pack(uid, (at - UNIX_EPOCH).total_seconds())
+        for uid, at in last_message_times.items()
+        if at >= cutoff
+    ]
+    add(SNAP_COOLDOWNS, len(cooldowns), b"".join(cooldowns))
+
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, user_version, marker, time.time(), len(sections))
+    return header + b"".join(sections)
+
+
+def _write_snapshot_file(path: str, data: bytes):
+    """一時ファイルを mmap して書き、まるごと置き換える（途中で落ちても古い版が残る）"""
+    tmp = path + ".tmp"
+    with open(tmp, "w+b") as f:
+        f.truncate(len(data))
+        with mmap.mmap(f.fileno(), len(data)) as mm:
+            mm[:] = data
+            mm.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+async def write_snapshot(final: bool = False) -> int:
+    """スナップショットを書いてバイト数を返す。final=True（終了時）のときだけ DB にマーカーを残す。"""
+    # SQLite の INTEGER に収まる 0 以外の乱数
+    marker = (int.from_bytes(os.urandom(8), "little") >> 1 or 1) if final else 0
+    data = encode_snapshot(await get_db_user_version(), marker)
+    await asyncio.to_thread(_write_snapshot_file, snapshot_path(), data)
+    if final:
+        await set_snapshot_marker(marker)
+    set_metric("snapshot.bytes", len(data))
+    return len(data)
+
+
+def decode_snapshot(view: memoryview) -> Optional[Tuple[int, int, dict]]:
+    """(user_version, マーカー, 種別 -> デコード済みレコード) を返す。形式が違えば None。"""
+    if len(view) < SNAPSHOT_HEADER.size:
+        return None
+    magic, fmt, user_version, marker, _created_at, section_count = SNAPSHOT_HEADER.unpack_from(view, 0)
+    if magic != SNAPSHOT_MAGIC or fmt != SNAPSHOT_FORMAT:
+        return None
+
+    fixed = {
+        SNAP_SETTINGS: SETTINGS_RECORD,
+        SNAP_MEMBER_GUILDS: GUILD_RECORD,
+        SNAP_MEMBERS: MEMBER_RECORD,
+        SNAP_PARTICIPANTS: PARTICIPANT_RECORD,
+        SNAP_COOLDOWNS: COOLDOWN_RECORD,
+    }
+    sections: dict[int, list] = {}
+    offset = SNAPSHOT_HEADER.size
+    for _ in range(section_count):
+        kind, count, size = SNAPSHOT_SECTION.unpack_from(view, offset)
+        offset += SNAPSHOT_SECTION.size
+        if kind in fixed:
+            # コピーせずに mmap 上のバイト列をそのまま読む
+            with view[offset:offset + size] as part:
+                sections[kind] = list(fixed[kind].iter_unpack(part))
+        elif kind == SNAP_WARS:
+            wars, pos = [], offset
+            for _ in range(count):
+                rec = WAR_RECORD.unpack_from(view, pos)
+                pos += WAR_RECORD.size
+                attacker_len, defender_len = rec[-2:]
+                names = (
+                    str(view[pos:pos + attacker_len], "utf-8"),
+                    str(view[pos + attacker_len:pos + attacker_len + defender_len], "utf-8"),
+                )
+                pos += attacker_len + defender_len
+                wars.append(rec[:-2] + names)
+            sections[kind] = wars
+        offset += size
+    return user_version, marker, sections
+
+
+def apply_snapshot(sections: dict, warm: bool):
+    """デコード済みのスナップショットをキャッシュに戻す。warm=False ならクールダウンだけ。"""
+    for user_id, at in sections.get(SNAP_COOLDOWNS, ()):
+        last_message_times[user_id] = UNIX_EPOCH + timedelta(seconds=at)
+    if not warm:
+        return
+
+    guild_settings_cache.clear()
+    for guild_id, *values in sections[SNAP_SETTINGS]:
+        if guild_id:
+            guild_settings_cache[guild_id] = {
+                k: None if v == -1 else v for k, v in zip(GUILD_SETTING_KEYS, values)
+            }
+
+    membership_index.clear()
+    for (guild_id,) in sections[SNAP_MEMBER_GUILDS]:
+        membership_index[guild_id] = {}
+    for guild_id, user_id, faction_id, role in sections[SNAP_MEMBERS]:
+        membership_index[guild_id][user_id] = (faction_id, ROLE_NAMES[role])
+
+    restore_war_state(sections[SNAP_WARS], sections[SNAP_PARTICIPANTS])
+
+
+async def load_snapshot() -> bool:
+    """スナップショットを読み込む。DB 由来のキャッシュまで復元できたら True（False なら通常の読み込みが必要）。"""
+    path = snapshot_path()
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return False
+
+    user_version = await get_db_user_version()
+    marker = await get_snapshot_marker()
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                decoded = decode_snapshot(view)
+    except (OSError, ValueError, struct.error, UnicodeDecodeError, KeyError) as e:
+        print(f"Ignoring unreadable snapshot {path}: {e}")
+        return False
+    if decoded is None:
+        return False
+
+    snap_version, snap_marker, sections = decoded
+    defaults = sections.get(SNAP_SETTINGS, [()])[0][1:]
+    warm = (
+        snap_marker != 0
+        and snap_marker == marker
+        and snap_version == user_version
+        # 既定値が変わっていたら保存済みの設定は使えない
+        and tuple(-1 if DEFAULT_GUILD_SETTINGS[k] is None else DEFAULT_GUILD_SETTINGS[k] for k in GUILD_SETTING_KEYS) == defaults
+    )
+    apply_snapshot(sections, warm)
+    incr_metric("snapshot.warm_loads" if warm else "snapshot.cold_loads")
+    return warm
+
+
+async def snapshot_loop():
+    """異常終了してもクールダウンなどが残るよう定期的に書く（DB 由来の部分は次回の検証で捨てられる）"""
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            await write_snapshot()
+        except Exception as e:
+            print(f"Snapshot failed: {e}")
+
+
+# ===================== 操作の直列化（キー付きロック） =====================
+# 同じユーザー・同じ派閥に対する変更を1つずつ実行する。
+# ダブルクリックなど実行者本人の重複は待たせずに断り、別の操作との競合は順番待ちにする。
+
+USER_BUSY_MESSAGE = "前の操作を処理中です。完了してからもう一度お試しください。"
+
+# キー -> [ロック, 保持中 + 待機中の数, うち reject 指定で取った数]。0 になったら消す
+keyed_lock_table: dict[tuple, list] = {}
+
+
+class KeyBusy(Exception):
+    """reject 指定のキーを、同じく reject 指定の操作（本人の前の操作）が使っていた"""
+
+
+def user_key(guild_id: int, user_id: int) -> tuple:
+    return ("user", guild_id, user_id)
+
+
+def faction_key(guild_id: int, faction_id: int) -> tuple:
+    return ("faction", guild_id, faction_id)
+
+
+def _release_key(key: tuple, owned: bool = False):
+    entry = keyed_lock_table[key]
+    entry[1] -= 1
+    if owned:
+        entry[2] -= 1
+    if entry[1] == 0:
+        del keyed_lock_table[key]
+
+
+@contextlib.asynccontextmanager
+async def keyed_locks(*keys: tuple, reject: tuple = ()):
+    """keys をすべて取ってから本体を実行する。
+
+    reject に含むキーは「本人の操作」として取る。同じキーを別の本人の操作が保持・待機中なら
+    待たずに KeyBusy（ダブルクリック対策）。他人の操作の対象として使われているだけなら順番を待つ。
+    reject の確認は何かを待つ前にまとめて行い、取得はすべて同じ順序で行うのでデッドロックしない。
+    """
+    ordered = sorted(set(keys))
+    owned = {key for key in ordered if key in reject}
+    for key in owned:
+        entry = keyed_lock_table.get(key)
+        if entry is not None and entry[2] > 0:
+            incr_metric("keyed_lock.rejected")
+            raise KeyBusy(key)
+    # 待っている間に来た本人の重複も断れるよう、確認と同時に印を付けておく
+    for key in ordered:
+        entry = keyed_lock_table.setdefault(key, [asyncio.Lock(), 0, 0])
+        entry[1] += 1
+        if key in owned:
+            entry[2] += 1
+    acquired = []
+    try:
+        for key in ordered:
+            lock = keyed_lock_table[key][0]
+            if lock.locked():
+                started = time.monotonic()
+                await lock.acquire()
+                wait_ms = (time.monotonic() - started) * 1000
+                incr_metric("keyed_lock.waits")
+                incr_metric("keyed_lock.wait_ms_total", round(wait_ms, 1))
+                set_metric("keyed_lock.wait_ms_max", max(metrics.get("keyed_lock.wait_ms_max", 0), round(wait_ms, 1)))
+            else:
+                await lock.acquire()
+            acquired.append(key)
+        yield
+    finally:
+        for key in reversed(ordered):
+            if key in acquired:
+                keyed_lock_table[key][0].release()
+            _release_key(key, key in owned)
+        set_metric("keyed_lock.keys", len(keyed_lock_table))
+
+
+def serialized_command(*, target: Optional[str] = None, faction: bool = False, war: bool = False):
+    """コマンドを (ギルド, 実行者) のロックで囲む。
+
+    target は対象メンバーの引数名、faction=True なら実行者の派閥、war=True ならギルドの戦争も一緒にロックする。
+    latency_guard の内側に付ける（待っている間は自動 defer される）。
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(interaction: discord.Interaction, *args, **kwargs):
+            guild = interaction.guild
+            if guild is None:
+                return await func(interaction, *args, **kwargs)
+
+            actor = user_key(guild.id, interaction.user.id)
+            keys = [actor]
+            member = kwargs.get(target) if target else None
+            if member is not None:
+                keys.append(user_key(guild.id, member.id))
+            if faction:
+                faction_id = (await load_membership_index(guild.id)).get(interaction.user.id, (None,))[0]
+                if faction_id is not None:
+                    keys.append(faction_key(guild.id, faction_id))
+            if war:
+                keys.append(("war", guild.id))
+
+            try:
+                async with keyed_locks(*keys, reject=(actor,)):
+                    return await func(interaction, *args, **kwargs)
+            except KeyBusy:
+                await send_response(interaction, USER_BUSY_MESSAGE, ephemeral=True)
+
+        return wrapper
+
+    return decorator
+
+
+def serialized_button(func):
+    """コントロールパネルのボタンを (ギルド, 押した人) と (ギルド, パネルの派閥) のロックで囲む。
+
+    待っている間にボタンの応答期限が切れないよう、先に defer しておく。
+    """
+
+    @functools.wraps(func)
+    async def wrapper(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await defer_response(interaction)
+        guild = interaction.guild
+        if guild is None:
+            return await func(self, interaction, button)
+
+        actor = user_key(guild.id, interaction.user.id)
+        try:
+            async with keyed_locks(actor, faction_key(guild.id, self.faction_id), reject=(actor,)):
+                return await func(self, interaction, button)
+        except KeyBusy:
+            await send_response(interaction, USER_BUSY_MESSAGE, ephemeral=True)
+
+    return wrapper
+
+
 # ===================== Bot クラス =====================
 
-class FactionBot(commands.Bot):
+class FactionBot(commands.AutoShardedBot):
+    # shard_ids / shard_count はクラスタ起動時にワーカーごとに上書きされる。
+    # 単一プロセス起動では Discord 推奨のシャード数を自動で使う。
     def __init__(self):
-        super().__init__(command_prefix=COMMAND_PREFIX, intents=intents)
+        if LEAN_GATEWAY:
+            member_cache_flags = discord.MemberCacheFlags.none()
+        else:
+            member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+        super().__init__(
+            command_prefix=COMMAND_PREFIX,
+            intents=intents,
+            chunk_guilds_at_startup=not LEAN_GATEWAY,
+            member_cache_flags=member_cache_flags,
+        )
+        self.startup_reported = False
+        self.shutdown_task: Optional[asyncio.Task] = None
 
     async def setup_hook(self):
+        # SIGTERM（コーディネーターの停止・再起動や systemd など）でも close() を通して終了する
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, lambda: asyncio.create_task(self.close())
+            )
+        except (NotImplementedError, RuntimeError):
+            pass  # シグナルハンドラを登録できない環境
         await init_db()
+        warm = isinstance(storage, SQLiteStorage) and await load_snapshot()
+        if not warm:
+            await load_guild_settings()
+            await load_war_state()
+        if isinstance(storage, SQLiteStorage):
+            # 正常終了で書き直されるまで、ここから先のスナップショットは DB と一致しないものとして扱う
+            await set_snapshot_marker(0)
+            asyncio.create_task(snapshot_loop())
+        print(f"Loaded state ({'warm snapshot' if warm else 'database'}).")
+        for _ in range(MESSAGE_WORKERS):
+            asyncio.create_task(message_worker())
+        asyncio.create_task(audit_flush_loop())
+        asyncio.create_task(activity_flush_loop())
+        asyncio.create_task(departure_flush_loop())
+        # 整合性チェックは各ワーカーが自分の担当ギルドについて行う
+        asyncio.create_task(reconcile_loop())
+        asyncio.create_task(scoreboard_loop())
+        if is_partitioned():
+            asyncio.create_task(guild_db_idle_loop())
+        if cluster_status_queue is not None:
+            asyncio.create_task(cluster_heartbeat_loop())
+        # 定期ジョブとコマンド同期はクラスタでも1プロセスだけが行う
+        if not is_primary_worker():
+            return
+        asyncio.create_task(audit_compaction_loop())
+        # バックアップ・保持期間・経済ジョブは SQLite のテーブルを直接扱う
+        if isinstance(storage, SQLiteStorage):
+            asyncio.create_task(backup_loop())
+            asyncio.create_task(retention_loop())
+            asyncio.create_task(economy_job_loop())
         try:
             synced = await self.tree.sync()
             print(f"Synced {len(synced)} command(s).")
         except Exception as e:
             print(f"Failed to sync commands: {e}")
 
+    async def close(self):
+        # SIGTERM と bot.run の後片付けの両方から呼ばれるので、書き出しは1回だけ行い、
+        # 後から来た呼び出しもそれが終わるまで接続を閉じない
+        if self.shutdown_task is None:
+            self.shutdown_task = asyncio.create_task(self.flush_on_shutdown())
+        await asyncio.shield(self.shutdown_task)
+        await super().close()
+
+    async def flush_on_shutdown(self):
+        # キューに残っている分はなるべく処理してから止める
+        try:
+            await asyncio.wait_for(message_queue.join(), timeout=5)
+        except asyncio.TimeoutError:
+            print(f"Dropping {message_queue.qsize()} queued message(s) on shutdown.")
+        # 退出処理は監査イベントを積むので先に流す
+        try:
+            await flush_departures()
+        except Exception as e:
+            print(f"Failed to flush departures: {e}")
+        try:
+            await flush_audit_events()
+        except Exception as e:
+            print(f"Failed to flush audit events: {e}")
+        try:
+            await flush_activity()
+        except Exception as e:
+            print(f"Failed to flush activity counts: {e}")
+        # 戦争の告知やスコアボードの最終編集などの未送信分は、接続を閉じる前に送り切る
+        tasks = [task for task in outbox_tasks.values() if not task.done()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=OUTBOX_SHUTDOWN_TIMEOUT)
+            dropped = sum(len(p) for p in outbox_pending.values())
+            if dropped:
+                print(f"Dropping {dropped} pending outbound message(s) on shutdown.")
+                incr_metric("outbox.dropped", dropped)
+        if isinstance(storage, SQLiteStorage):
+            try:
+                size = await write_snapshot(final=True)
+                print(f"Wrote snapshot {snapshot_path()} ({size} bytes).")
+            except Exception as e:
+                print(f"Failed to write snapshot: {e}")
+        await storage.close()
+        await close_idle_guild_dbs(max_idle=0)
+
 
 bot = FactionBot()
 
@@ -525,14 +4193,15 @@ class FactionControlView(discord.ui.View):
         if guild is None or not isinstance(user, discord.Member):
             return False, "サーバー内でのみ使用できます。"
 
-        faction = await get_faction_by_id(self.faction_id)
+        # 派閥の行・押した人の所属・メンバー数を1回で読む
+        context = await storage.get_faction_context(user.id, guild.id, faction_id=self.faction_id)
+        user_fid, user_role, _target_fid, _target_role, faction, member_count = context
         if not faction or faction[13] == 1:
             return False, "この派閥情報が見つかりません。"
 
         if guild.id != faction[1]:
             return False, "この派閥は別サーバーのものです。"
 
-        user_fid, user_role = await get_faction_role(user.id, guild.id)
         if user_fid != self.faction_id and not user.guild_permissions.administrator:
             return False, "この派閥のメンバーではありません。"
 
@@ -541,6 +4210,7 @@ class FactionControlView(discord.ui.View):
             "user": user,
             "role": user_role or "admin",
             "faction": faction,
+            "member_count": member_count,
         }
 
     @discord.ui.button(
@@ -581,17 +4251,9 @@ class FactionControlView(discord.ui.View):
             is_open,
         ) = faction
 
-        leader = guild.get_member(leader_id)
-        leader_name = leader.display_name if leader else "不明"
+        leader_name = await resolve_member_name(guild, leader_id) or "不明"
 
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute(
-                "SELECT COUNT(*) FROM faction_members WHERE faction_id = ?",
-                (fid,),
-            )
-            row = await cur.fetchone()
-            await cur.close()
-        member_count = row[0] if row else 0
+        member_count: int = data["member_count"]
 
         join_mode = (
             "オープン（誰でも /f_join で参加可能）"
@@ -612,12 +4274,13 @@ class FactionControlView(discord.ui.View):
         style=discord.ButtonStyle.primary,
         custom_id="faction_panel:toggle_open",
     )
+    @serialized_button
     async def toggle_open_button(
         self,
         interaction: discord.Interaction,
         button: discord.ui.Button,
     ):
-        await interaction.response.defer(ephemeral=True)
+        await defer_response(interaction)
         ok, data = await self._check_permission(interaction)
         if not ok:
             await interaction.followup.send(str(data), ephemeral=True)
@@ -654,12 +4317,8 @@ class FactionControlView(discord.ui.View):
         ) = faction
 
         new_state = 0 if is_open else 1
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute(
-                "UPDATE factions SET is_open = ? WHERE id = ?",
-                (new_state, fid),
-            )
-            await db.commit()
+        await storage.set_faction_open(fid, new_state, guild.id)
+        log_event(guild.id, "faction.set_open", actor_id=user.id, faction_id=fid, is_open=new_state)
 
         text = (
             "オープン（誰でも /f_join で参加可能）"
@@ -676,12 +4335,13 @@ class FactionControlView(discord.ui.View):
         style=discord.ButtonStyle.danger,
         custom_id="faction_panel:disband",
     )
+    @serialized_button
     async def disband_button(
         self,
         interaction: discord.Interaction,
         button: discord.ui.Button,
     ):
-        await interaction.response.defer(ephemeral=True)
+        await defer_response(interaction)
         guild = interaction.guild
         user = interaction.user
         if guild is None or not isinstance(user, discord.Member):
@@ -692,11 +4352,259 @@ class FactionControlView(discord.ui.View):
         await interaction.followup.send(msg, ephemeral=True)
 
 
+CONTROL_PANEL_TEXT = (
+    "ここから派閥の管理ができます：\n"
+    "・派閥情報\n"
+    "・参加モード切替（オープン/クローズ）\n"
+    "・派閥解散\n"
+)
+
+
+def control_panel_overwrites(
+    guild: discord.Guild,
+    leader_role: Optional[discord.Role],
+    officer_role: Optional[discord.Role],
+) -> dict:
+    overwrites = {guild.default_role: discord.PermissionOverwrite(view_channel=False)}
+    if leader_role is not None:
+        overwrites[leader_role] = discord.PermissionOverwrite(
+            view_channel=True,
+            send_messages=True,
+            manage_channels=True,
+            manage_roles=True,
+        )
+    if officer_role is not None:
+        overwrites[officer_role] = discord.PermissionOverwrite(
+            view_channel=True,
+            send_messages=True,
+            manage_channels=True,
+        )
+    return overwrites
+
+
+# ===================== DB とギルドの整合性チェック =====================
+
+RECONCILE_INTERVAL = 120.0  # 秒
+RECONCILE_FACTIONS_PER_CYCLE = 25  # 1サイクルで確認する派閥数
+RECONCILE_API_BUDGET = 10  # 1サイクルで行う変更系 API 呼び出しの上限
+RECONCILE_ORPHAN_MIN_AGE = 15 * 60  # 作成途中のものを消さないよう、これより新しいものは放置（秒）
+
+# (guild_id, faction_id) -> 前回報告した不足リソース（同じ内容を毎回報告しない）
+reconcile_flagged: dict[Tuple[int, int], frozenset] = {}
+
+
+async def get_reconciler_cursor(key: str) -> int:
+    async with aiosqlite.connect(DB_PATH) as db:
+        cur = await db.execute("SELECT value FROM reconciler_state WHERE key = ?", (key,))
+        row = await cur.fetchone()
+        await cur.close()
+    return row[0] if row else 0
+
+
+async def set_reconciler_cursor(key: str, value: int):
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(
+            """
+            INSERT INTO reconciler_state (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            """,
+            (key, value),
+        )
+        await db.commit()
+
+
+def is_old_enough(obj) -> bool:
+    age = (discord.utils.utcnow() - obj.created_at).total_seconds()
+    return age >= RECONCILE_ORPHAN_MIN_AGE
+
+
+async def reconcile_faction(guild: discord.Guild, faction, budget: int) -> int:
+    """1派閥のロール/チャンネルを確認し、直せるものは直す。使った API 呼び出し数を返す。"""
+    (
+        fid,
+        guild_id,
+        name,
+        leader_id,
+        base_role_id,
+        leader_role_id,
+        officer_role_id,
+        category_id,
+        forum_id,
+        chat_id,
+        vc_id,
+        listen_id,
+        panel_id,
+        destroyed,
+        is_open,
+    ) = faction
+
+    used = 0
+    category = guild.get_channel(category_id)
+    leader_role = guild.get_role(leader_role_id)
+    officer_role = guild.get_role(officer_role_id)
+
+    # コントロールパネルが消えていたら作り直す
+    if guild.get_channel(panel_id) is None and isinstance(category, discord.CategoryChannel) and budget >= 2:
+        try:
+            panel = await guild.create_text_channel(
+                "派閥コントロールパネル",
+                category=category,
+                overwrites=control_panel_overwrites(guild, leader_role, officer_role),
+                topic=f"{name} の派閥管理用チャンネル",
+            )
+            outbox_send(panel, CONTROL_PANEL_TEXT, view=FactionControlView(fid))
+            used += 2
+            await storage.set_faction_panel_channel(fid, panel.id, guild.id)
+            log_event(guild.id, "reconcile.repair", faction_id=fid, resource="control_panel")
+            incr_metric("reconcile.repaired")
+            panel_id = panel.id
+        except discord.HTTPException as e:
+            print(f"[reconcile] failed to recreate panel for faction {fid}: {e}")
+
+    # それ以外は自動では直さず報告だけする
+    # 基本ロールが消えていても一時的な不整合の可能性があるので解体はせず、報告だけする
+    missing = []
+    if guild.get_role(base_role_id) is None:
+        missing.append("base_role")
+    if leader_role is None:
+        missing.append("leader_role")
+    if officer_role is None:
+        missing.append("officer_role")
+    if category is None:
+        missing.append("category")
+    for label, cid in (
+        ("forum", forum_id),
+        ("chat", chat_id),
+        ("vc", vc_id),
+        ("listen_vc", listen_id),
+        ("control_panel", panel_id),
+    ):
+        if guild.get_channel(cid) is None:
+            missing.append(label)
+
+    flagged = frozenset(missing)
+    if flagged and reconcile_flagged.get((guild.id, fid)) != flagged:
+        print(f"[reconcile] faction {fid} ({name}) is missing: {', '.join(missing)}")
+        log_event(guild.id, "reconcile.drift", faction_id=fid, missing=missing)
+        incr_metric("reconcile.flagged")
+    if flagged:
+        reconcile_flagged[(guild.id, fid)] = flagged
+    else:
+        reconcile_flagged.pop((guild.id, fid), None)
+    return used
+
+
+async def reconcile_orphans(guild: discord.Guild, budget: int) -> int:
+    """DB のどの派閥にも属さない [派閥] ロールと 派閥: カテゴリを削除する"""
+    factions = await storage.list_factions(guild.id)
+    live_roles = {rid for f in factions for rid in f[4:7]}
+    live_categories = {f[7] for f in factions}
+
+    used = 0
+    for role in guild.roles:
+        if used >= budget:
+            return used
+        if role.name.startswith("[派閥] ") and role.id not in live_roles and is_old_enough(role):
+            try:
+                await role.delete(reason="Orphaned faction role")
+                incr_metric("reconcile.orphans_deleted")
+            except discord.HTTPException:
+                pass
+            used += 1
+
+    for category in guild.categories:
+        if category.name.startswith("派閥: ") and category.id not in live_categories and is_old_enough(category):
+            channels = list(category.channels)
+            if used + len(channels) + 1 > budget:
+                return used
+            for ch in channels:
+                try:
+                    await ch.delete(reason="Orphaned faction category")
+                except discord.HTTPException:
+                    pass
+            try:
+                await category.delete(reason="Orphaned faction category")
+                incr_metric("reconcile.orphans_deleted")
+            except discord.HTTPException:
+                pass
+            used += len(channels) + 1
+    return used
+
+
+async def run_reconcile_cycle():
+    """派閥を少しずつ確認し、1サイクルに1ギルドずつ孤立リソースを掃除する"""
+    suffix = cluster_worker_id or 0
+    budget = RECONCILE_API_BUDGET
+    guild_ids = sorted(g.id for g in bot.guilds)
+
+    # 派閥はギルドごとに ID 順で確認する（ギルド別DBでは ID がギルドをまたいで重複するため）
+    faction_guild_key = f"faction_guild:{suffix}"
+    cursor_key = f"faction_cursor:{suffix}"
+    current_guild = await get_reconciler_cursor(faction_guild_key)
+    cursor = await get_reconciler_cursor(cursor_key)
+    candidates = [gid for gid in guild_ids if gid >= current_guild] or guild_ids[:1]
+    if candidates:
+        guild_id = candidates[0]
+        if guild_id != current_guild:
+            cursor = 0
+        factions = await storage.list_factions(guild_id, cursor, RECONCILE_FACTIONS_PER_CYCLE)
+
+        guild = bot.get_guild(guild_id)
+        finished = len(factions) < RECONCILE_FACTIONS_PER_CYCLE
+        next_cursor = factions[-1][0] if factions else 0
+        for faction in factions:
+            if budget <= 0:
+                next_cursor = faction[0] - 1  # 次回はここから
+                finished = False
+                break
+            budget -= await reconcile_faction(guild, faction, budget)
+            incr_metric("reconcile.checked")
+        if finished:
+            # このギルドは一巡したので次のギルドへ
+            later = [gid for gid in guild_ids if gid > guild_id]
+            guild_id, next_cursor = (later or guild_ids)[0], 0
+        await set_reconciler_cursor(faction_guild_key, guild_id)
+        await set_reconciler_cursor(cursor_key, next_cursor)
+
+    guild_key = f"guild_cursor:{suffix}"
+    guild_cursor = await get_reconciler_cursor(guild_key)
+    guild_ids = sorted(g.id for g in bot.guilds)
+    next_guilds = [gid for gid in guild_ids if gid > guild_cursor] or guild_ids[:1]
+    if next_guilds and budget > 0:
+        guild = bot.get_guild(next_guilds[0])
+        if guild is not None:
+            budget -= await reconcile_orphans(guild, budget)
+        await set_reconciler_cursor(guild_key, next_guilds[0])
+
+    incr_metric("reconcile.api_calls", RECONCILE_API_BUDGET - budget)
+
+
+async def reconcile_loop():
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        try:
+            await run_reconcile_cycle()
+        except Exception as e:
+            print(f"Reconcile cycle failed: {e}")
+
+
 # ===================== イベント =====================
 
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user} (ID: {bot.user.id})")
+    if not bot.startup_reported:
+        # on_ready は再接続のたびに呼ばれるので起動時の1回だけ記録する
+        bot.startup_reported = True
+        elapsed = time.perf_counter() - PROCESS_STARTED_AT
+        rss = current_rss_mb()
+        set_metric("startup.seconds_max", round(elapsed, 2))
+        set_metric("memory.rss_mb_max", round(rss, 1))
+        print(
+            f"Startup ({'lean' if LEAN_GATEWAY else 'full'} gateway): "
+            f"{elapsed:.1f}s, {len(bot.guilds)} guild(s), RSS {rss:.1f} MB"
+        )
 
 
 @bot.event
@@ -704,35 +4612,189 @@ async def on_message(message: discord.Message):
     if message.author.bot or message.guild is None:
         return
 
+    settings = get_guild_settings(message.guild.id)
     now = datetime.utcnow()
+    note_activity(message.guild.id, message.author.id, now)
     last = last_message_times.get(message.author.id)
-    if last is None or (now - last) >= timedelta(seconds=10):
+    reward = 0
+    if last is None or (now - last) >= timedelta(seconds=settings["reward_cooldown_seconds"]):
         last_message_times[message.author.id] = now
-        await add_balance(message.author.id, 1)
+        reward = settings["message_reward"]
 
-    await add_message_for_war(message.author.id, message.guild.id)
+    # DB 処理は必要なときだけキューに積み、ワーカーに任せる
+    in_war = message.author.id in war_participants.get(message.guild.id, ())
+    if reward or in_war:
+        await enqueue_message_work(
+            (message.author.id, message.guild.id, reward, time.monotonic())
+        )
 
     await bot.process_commands(message)
 
 
+@bot.event
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    # メンバーキャッシュが無くても届く raw イベントを使う
+    if not payload.user.bot:
+        note_departure(payload.guild_id, payload.user.id)
+
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    forget_guild(guild.id)
+    if guild.id not in guild_purge_tasks:
+        guild_purge_tasks[guild.id] = asyncio.create_task(purge_guild_data(guild.id))
+    log_event(guild.id, "guild.removed")
+
+
+@bot.event
+async def on_guild_join(guild: discord.Guild):
+    # 外されてすぐ戻された場合も削除は途中で止めない（メンバーだけ消えた派閥などが残る）。
+    # 削除中に読み込まれたキャッシュは消えた行を指すので、終わってから捨て直す。
+    task = guild_purge_tasks.get(guild.id)
+    if task is not None:
+        print(f"Rejoined guild {guild.id} while its data is being purged; waiting for the purge.")
+        try:
+            await asyncio.shield(task)
+        except Exception as e:
+            print(f"Purge of guild {guild.id} failed: {e}")
+        forget_guild(guild.id)
+
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    # 退出後すぐに戻ったメンバーは、まだ反映していなければ派閥から外さない
+    queued = departure_queue.get(member.guild.id)
+    if queued is not None:
+        queued.discard(member.id)
+        if not queued:
+            del departure_queue[member.guild.id]
+
+
+# ===================== 共通: 応答期限ガード =====================
+
+# interaction.id -> ロック（自動 defer とハンドラの応答が同時に飛ばないようにする）
+interaction_locks: dict[int, asyncio.Lock] = {}
+
+
+def latency_guard(func):
+    """ハンドラが LATENCY_GUARD_SECONDS 以内に応答しなければ自動で defer するデコレータ"""
+
+    @functools.wraps(func)
+    async def wrapper(interaction: discord.Interaction, *args, **kwargs):
+        name = interaction.command.name if interaction.command else func.__name__
+        lock = interaction_locks[interaction.id] = asyncio.Lock()
+
+        async def guard():
+            await asyncio.sleep(LATENCY_GUARD_SECONDS)
+            async with lock:
+                if not interaction.response.is_done():
+                    await interaction.response.defer(ephemeral=True, thinking=True)
+                    incr_metric(f"latency_guard.fired.{name}")
+
+        incr_metric(f"latency_guard.calls.{name}")
+        task = asyncio.create_task(guard())
+        try:
+            return await func(interaction, *args, **kwargs)
+        finally:
+            task.cancel()
+            interaction_locks.pop(interaction.id, None)
+
+    return wrapper
+
+
+async def send_response(interaction: discord.Interaction, content: Optional[str] = None, **kwargs):
+    """まだ応答していなければ send_message、defer 済みなら followup で送る"""
+    lock = interaction_locks.get(interaction.id) or asyncio.Lock()
+    async with lock:
+        if interaction.response.is_done():
+            await interaction.followup.send(content, **kwargs)
+        else:
+            await interaction.response.send_message(content, **kwargs)
+
+
+async def defer_response(interaction: discord.Interaction):
+    """重い処理の前に明示的に defer する（自動 defer 済みなら何もしない）"""
+    lock = interaction_locks.get(interaction.id) or asyncio.Lock()
+    async with lock:
+        if not interaction.response.is_done():
+            await interaction.response.defer(ephemeral=True)
+
+
 # ===================== 通貨コマンド =====================
 
 @bot.tree.command(name="money", description="自分または指定ユーザーの所持金を表示します")
 @app_commands.describe(user="確認したいユーザー（省略時は自分）")
+@latency_guard
 async def money_cmd(
     interaction: discord.Interaction,
     user: Optional[discord.Member] = None,
 ):
     target = user or interaction.user
-    bal = await get_balance(target.id)
-    await interaction.response.send_message(
+    bal = await storage.get_balance(target.id)
+    await send_response(
+        interaction,
         f"{target.mention} の所持金は `{bal}` コインです。",
         ephemeral=True,
     )
 
 
+@bot.tree.command(name="pay", description="他のユーザーにコインを送ります")
+@app_commands.describe(user="送り先のユーザー", amount="送るコイン数")
+@latency_guard
+@serialized_command(target="user")
+async def pay_cmd(
+    interaction: discord.Interaction,
+    user: discord.Member,
+    amount: app_commands.Range[int, 1],
+):
+    if user.id == interaction.user.id or user.bot:
+        await send_response(
+            interaction,
+            "そのユーザーには送金できません。",
+            ephemeral=True,
+        )
+        return
+
+    try:
+        result = await storage.transfer_balance(interaction.user.id, user.id, amount)
+    except Exception as e:
+        print(f"[pay] transfer {interaction.user.id} -> {user.id} failed: {e}")
+        incr_metric("transfer.command_errors")
+        await send_response(
+            interaction,
+            "送金に失敗しました。しばらくしてからもう一度お試しください。",
+            ephemeral=True,
+        )
+        return
+    if result is None:
+        bal = await storage.get_balance(interaction.user.id)
+        await send_response(
+            interaction,
+            f"お金が足りません。送金額: {amount} / 所持: {bal}",
+            ephemeral=True,
+        )
+        return
+
+    from_bal, _to_bal = result
+    if interaction.guild is not None:
+        log_event(
+            interaction.guild.id,
+            "balance.pay",
+            actor_id=interaction.user.id,
+            target_id=user.id,
+            amount=amount,
+        )
+    await send_response(
+        interaction,
+        f"{user.mention} に `{amount}` コイン送りました。（残高: {from_bal}）",
+        ephemeral=True,
+    )
+
+
 @bot.tree.command(name="give", description="管理者用: 指定ユーザーにコインを付与します")
 @app_commands.describe(user="付与するユーザー", amount="付与するコイン数")
+@latency_guard
+@serialized_command(target="user")
 async def give_cmd(
     interaction: discord.Interaction,
     user: discord.Member,
@@ -742,59 +4804,172 @@ async def give_cmd(
         not isinstance(interaction.user, discord.Member)
         or not interaction.user.guild_permissions.administrator
     ):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "このコマンドは管理者のみが実行できます。",
             ephemeral=True,
         )
         return
 
-    new_bal = await add_balance(user.id, amount)
-    await interaction.response.send_message(
+    new_bal = await storage.add_balance(user.id, amount)
+    if interaction.guild is not None:
+        log_event(
+            interaction.guild.id,
+            "balance.give",
+            actor_id=interaction.user.id,
+            target_id=user.id,
+            amount=amount,
+            balance=new_bal,
+        )
+    await send_response(
+        interaction,
         f"{user.mention} に `{amount}` コイン付与しました。（合計: {new_bal}）",
         ephemeral=True,
     )
 
 
+@bot.tree.command(
+    name="give_bulk",
+    description="管理者用: ロールまたは派閥の全員にコインを付与（負の値で没収）します",
+)
+@app_commands.describe(
+    amount="1人あたりのコイン数（負の値なら没収。残高は 0 未満にならない）",
+    role="このロールを持つメンバー全員",
+    faction_name="この派閥のメンバー全員",
+)
+@latency_guard
+@serialized_command()
+async def give_bulk_cmd(
+    interaction: discord.Interaction,
+    amount: int,
+    role: Optional[discord.Role] = None,
+    faction_name: Optional[str] = None,
+):
+    guild = interaction.guild
+    user = interaction.user
+
+    if guild is None or not isinstance(user, discord.Member):
+        await send_response(
+            interaction,
+            "サーバー内でのみ使用できます。",
+            ephemeral=True,
+        )
+        return
+
+    if not user.guild_permissions.administrator:
+        await send_response(
+            interaction,
+            "このコマンドは管理者のみが実行できます。",
+            ephemeral=True,
+        )
+        return
+
+    if (role is None) == (faction_name is None) or amount == 0:
+        await send_response(
+            interaction,
+            "ロールか派閥名のどちらか一方と、0 以外のコイン数を指定してください。",
+            ephemeral=True,
+        )
+        return
+
+    if faction_name is not None:
+        faction = await storage.get_faction_by_name(faction_name, guild.id)
+        if not faction:
+            await send_response(
+                interaction,
+                "その名前の派閥は見つかりません。",
+                ephemeral=True,
+            )
+            return
+
+    # ロールのメンバー取得やチャンク書き込みに時間がかかることがある
+    await defer_response(interaction)
+
+    started = time.perf_counter()
+    if role is not None:
+        target_kind, target_id, target_name = "role", role.id, role.mention
+        user_ids = [m.id for m in await get_role_members(guild, role) if not m.bot]
+    else:
+        target_kind, target_id, target_name = "faction", faction[0], f"派閥 **{faction[1]}**"
+        user_ids = [uid for uid, _fid in await storage.list_faction_members([faction[0]], guild.id)]
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        await send_response(interaction, "対象のメンバーがいません。", ephemeral=True)
+        return
+
+    grant_id, total = await storage.grant_bulk(user_ids, amount, guild.id, user.id, target_kind, target_id)
+    elapsed = time.perf_counter() - started
+    incr_metric("balance.bulk_grants")
+    incr_metric("balance.bulk_granted_users", len(user_ids))
+    log_event(
+        guild.id,
+        "balance.give_bulk",
+        actor_id=user.id,
+        faction_id=target_id if target_kind == "faction" else None,
+        grant_id=grant_id,
+        target_kind=target_kind,
+        target_id=target_id,
+        amount=amount,
+        users=len(user_ids),
+        total=total,
+    )
+    await send_response(
+        interaction,
+        f"{target_name} の {len(user_ids)} 人に 1人あたり `{amount}` コインを"
+        f"{'付与' if amount > 0 else '没収'}しました。\n"
+        f"・増減の合計: {total}\n"
+        f"・所要時間: {elapsed:.2f} 秒（記録ID: {grant_id}）",
+        ephemeral=True,
+    )
+
+
 # ===================== 派閥コマンド =====================
 
 @bot.tree.command(name="create_faction", description="新しい派閥を作成します")
 @app_commands.describe(name="作成する派閥名")
+@latency_guard
+@serialized_command()
 async def create_faction_cmd(interaction: discord.Interaction, name: str):
     guild = interaction.guild
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内で実行してください。",
             ephemeral=True,
         )
         return
 
-    existing = await get_user_faction_id(user.id, guild.id)
+    existing = await storage.get_user_faction_id(user.id, guild.id)
     if existing:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "すでに派閥に所属しています。",
             ephemeral=True,
         )
         return
 
-    if not await remove_balance(user.id, FACTION_CREATE_COST):
-        bal = await get_balance(user.id)
-        await interaction.response.send_message(
-            f"お金が足りません。必要: {FACTION_CREATE_COST} / 所持: {bal}",
+    cost = get_guild_settings(guild.id)["faction_create_cost"]
+    if not await storage.remove_balance(user.id, cost):
+        bal = await storage.get_balance(user.id)
+        await send_response(
+            interaction,
+            f"お金が足りません。必要: {cost} / 所持: {bal}",
             ephemeral=True,
         )
         return
 
-    if await get_faction_by_name(name, guild.id):
-        await interaction.response.send_message(
+    if await storage.get_faction_by_name(name, guild.id):
+        await send_response(
+            interaction,
             "同じ名前の派閥が既に存在します。別の名前を使ってください。",
             ephemeral=True,
         )
         return
 
     # ここから重い処理なので先に defer
-    await interaction.response.defer(ephemeral=True)
+    await defer_response(interaction)
 
     # ロール
     faction_role = await guild.create_role(name=f"[派閥] {name}", mentionable=True)
@@ -861,176 +5036,325 @@ async def create_faction_cmd(interaction: discord.Interaction, name: str):
     )
 
     # コントロールパネル（ボタン用）
-    overwrites_panel = {
-        guild.default_role: discord.PermissionOverwrite(view_channel=False),
-        leader_role: discord.PermissionOverwrite(
-            view_channel=True,
-            send_messages=True,
-            manage_channels=True,
-            manage_roles=True,
-        ),
-        officer_role: discord.PermissionOverwrite(
-            view_channel=True,
-            send_messages=True,
-            manage_channels=True,
-        ),
-    }
     control_panel_ch = await guild.create_text_channel(
         "派閥コントロールパネル",
         category=category,
-        overwrites=overwrites_panel,
+        overwrites=control_panel_overwrites(guild, leader_role, officer_role),
         topic=f"{name} の派閥管理用チャンネル",
     )
 
     # DB 登録
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            """
-            INSERT INTO factions (
-                guild_id, name, leader_id, base_role_id, leader_role_id,
-                officer_role_id, category_id, forum_channel_id, chat_channel_id,
-                vc_channel_id, listen_vc_channel_id, control_panel_channel_id
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                guild.id,
-                name,
-                user.id,
-                faction_role.id,
-                leader_role.id,
-                officer_role.id,
-                category.id,
-                forum_ch.id,
-                chat_ch.id,
-                vc_ch.id,
-                listen_vc_ch.id,
-                control_panel_ch.id,
-            ),
-        )
-        faction_id = cur.lastrowid
-        await db.commit()
+    faction_id = await storage.create_faction(
+        name,
+        user.id,
+        {
+            "base_role_id": faction_role.id,
+            "leader_role_id": leader_role.id,
+            "officer_role_id": officer_role.id,
+            "category_id": category.id,
+            "forum_channel_id": forum_ch.id,
+            "chat_channel_id": chat_ch.id,
+            "vc_channel_id": vc_ch.id,
+            "listen_vc_channel_id": listen_vc_ch.id,
+            "control_panel_channel_id": control_panel_ch.id,
+        },
+        guild.id,
+    )
 
-    await add_faction_member(user.id, faction_id, "leader")
+    await add_faction_member(user.id, faction_id, "leader", guild.id)
+    log_event(guild.id, "faction.create", actor_id=user.id, faction_id=faction_id, name=name, cost=cost)
 
     # ボタン付きパネル
     view = FactionControlView(faction_id)
-    await control_panel_ch.send(
-        "ここから派閥の管理ができます：\n"
-        "・派閥情報\n"
-        "・参加モード切替（オープン/クローズ）\n"
-        "・派閥解散\n",
-        view=view,
+    outbox_send(control_panel_ch, CONTROL_PANEL_TEXT, view=view)
+
+    await interaction.followup.send(
+        f"派閥 **{name}** を作成しました！必要コスト `{cost}` コインを消費しました。",
+        ephemeral=True,
     )
 
-    await interaction.followup.send(
-        f"派閥 **{name}** を作成しました！必要コスト `{FACTION_CREATE_COST}` コインを消費しました。",
+
+@bot.tree.command(name="f_invite", description="自分の派閥にメンバーを招待します")
+@app_commands.describe(member="招待するメンバー")
+@latency_guard
+@serialized_command(target="member", faction=True)
+async def faction_invite_cmd(interaction: discord.Interaction, member: discord.Member):
+    guild = interaction.guild
+    user = interaction.user
+
+    if guild is None or not isinstance(user, discord.Member):
+        await send_response(
+            interaction,
+            "サーバー内でのみ使用できます。",
+            ephemeral=True,
+        )
+        return
+
+    context = await storage.get_faction_context(user.id, guild.id, target_id=member.id)
+    my_faction_id, my_role, target_faction_id, _target_role, faction, _member_count = context
+    if not my_faction_id or my_role not in ("leader", "officer"):
+        await send_response(
+            interaction,
+            "このコマンドは派閥のリーダーまたは幹部のみ使用できます。",
+            ephemeral=True,
+        )
+        return
+
+    if target_faction_id:
+        await send_response(
+            interaction,
+            "そのユーザーは既にどこかの派閥に所属しています。",
+            ephemeral=True,
+        )
+        return
+
+    if not faction or faction[13] == 1:
+        await send_response(
+            interaction,
+            "派閥情報が見つかりません。",
+            ephemeral=True,
+        )
+        return
+
+    (
+        fid,
+        g_id,
+        name,
+        leader_id,
+        base_role_id,
+        leader_role_id,
+        officer_role_id,
+        category_id,
+        forum_id,
+        chat_id,
+        vc_id,
+        listen_id,
+        panel_id,
+        destroyed,
+        is_open,
+    ) = faction
+
+    base_role = guild.get_role(base_role_id)
+    if not base_role:
+        await send_response(
+            interaction,
+            "派閥ロールが見つかりません。管理者に連絡してください。",
+            ephemeral=True,
+        )
+        return
+
+    await member.add_roles(base_role)
+    await add_faction_member(member.id, my_faction_id, "member", guild.id)
+    log_event(guild.id, "faction.invite", actor_id=user.id, faction_id=my_faction_id, target_id=member.id)
+    await send_response(
+        interaction,
+        f"{member.mention} を派閥 **{name}** に招待しました。",
         ephemeral=True,
     )
 
 
-@bot.tree.command(name="f_invite", description="自分の派閥にメンバーを招待します")
-@app_commands.describe(member="招待するメンバー")
-async def faction_invite_cmd(interaction: discord.Interaction, member: discord.Member):
+def parse_member_ids(text: str) -> list[int]:
+    """メンション/ID が並んだ文字列からユーザーIDを順序を保って取り出す"""
+    seen: dict[int, None] = {}
+    for m in re.finditer(r"\d{15,20}", text):
+        seen.setdefault(int(m.group(0)), None)
+    return list(seen)
+
+
+@bot.tree.command(
+    name="f_invite_bulk",
+    description="複数メンバー（またはロールの全員）をまとめて派閥に招待します",
+)
+@app_commands.describe(
+    members="招待するメンバー（メンションまたはIDを空白区切りで複数指定）",
+    role="このロールを持つメンバー全員を招待",
+)
+@latency_guard
+async def faction_invite_bulk_cmd(
+    interaction: discord.Interaction,
+    members: Optional[str] = None,
+    role: Optional[discord.Role] = None,
+):
     guild = interaction.guild
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
-    my_faction_id, my_role = await get_faction_role(user.id, guild.id)
-    if not my_faction_id or my_role not in ("leader", "officer"):
-        await interaction.response.send_message(
-            "このコマンドは派閥のリーダーまたは幹部のみ使用できます。",
+    if not members and role is None:
+        await send_response(
+            interaction,
+            "招待するメンバーかロールを指定してください。",
             ephemeral=True,
         )
         return
 
-    if await get_user_faction_id(member.id, guild.id):
-        await interaction.response.send_message(
-            "そのユーザーは既にどこかの派閥に所属しています。",
+    context = await storage.get_faction_context(user.id, guild.id)
+    my_faction_id, my_role, _target_faction_id, _target_role, faction, _member_count = context
+    if not my_faction_id or my_role not in ("leader", "officer"):
+        await send_response(
+            interaction,
+            "このコマンドは派閥のリーダーまたは幹部のみ使用できます。",
             ephemeral=True,
         )
         return
 
-    faction = await get_faction_by_id(my_faction_id)
     if not faction or faction[13] == 1:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "派閥情報が見つかりません。",
             ephemeral=True,
         )
         return
 
-    (
-        fid,
-        g_id,
-        name,
-        leader_id,
-        base_role_id,
-        leader_role_id,
-        officer_role_id,
-        category_id,
-        forum_id,
-        chat_id,
-        vc_id,
-        listen_id,
-        panel_id,
-        destroyed,
-        is_open,
-    ) = faction
-
-    base_role = guild.get_role(base_role_id)
+    name = faction[2]
+    base_role = guild.get_role(faction[4])
     if not base_role:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "派閥ロールが見つかりません。管理者に連絡してください。",
             ephemeral=True,
         )
         return
 
-    await member.add_roles(base_role)
-    await add_faction_member(member.id, my_faction_id, "member")
-    await interaction.response.send_message(
-        f"{member.mention} を派閥 **{name}** に招待しました。",
+    await defer_response(interaction)
+
+    # 候補を集める（ID指定 + ロール指定、重複除去）
+    candidates: dict[int, discord.Member] = {}
+    for uid in parse_member_ids(members or ""):
+        m = guild.get_member(uid)
+        if m is None:
+            try:
+                m = await guild.fetch_member(uid)
+            except discord.HTTPException:
+                continue
+        candidates[m.id] = m
+    if role is not None:
+        for m in await get_role_members(guild, role):
+            candidates.setdefault(m.id, m)
+
+    # 所属インデックスで一括判定
+    index = await load_membership_index(guild.id)
+    to_invite: list[discord.Member] = []
+    skipped = 0
+    for m in candidates.values():
+        if m.bot or m.id in index:
+            skipped += 1
+            continue
+        to_invite.append(m)
+
+    if len(to_invite) > BULK_INVITE_MAX:
+        await interaction.followup.send(
+            f"一度に招待できるのは {BULK_INVITE_MAX} 人までです。（対象: {len(to_invite)} 人）",
+            ephemeral=True,
+        )
+        return
+
+    # 対象が決まってから、実行者・派閥・招待する全員のロックをまとめて取り、その中で確認し直して登録する。
+    # （招待される側の /f_join などと同時に走って2つの派閥に入るのを防ぐ。
+    #   後からキーを足すと取得順が崩れるので serialized_command は使わない）
+    actor = user_key(guild.id, user.id)
+    keys = [actor, faction_key(guild.id, my_faction_id)] + [user_key(guild.id, m.id) for m in to_invite]
+    try:
+        async with keyed_locks(*keys, reject=(actor,)):
+            context = await storage.get_faction_context(user.id, guild.id)
+            if context[0] != my_faction_id or context[1] not in ("leader", "officer") or not context[4] or context[4][13] == 1:
+                await interaction.followup.send(
+                    "派閥の状態が変わったため招待を中止しました。",
+                    ephemeral=True,
+                )
+                return
+            index = await load_membership_index(guild.id)
+            skipped += sum(1 for m in to_invite if m.id in index)
+            to_invite = [m for m in to_invite if m.id not in index]
+            if not to_invite:
+                await interaction.followup.send(
+                    f"招待できるメンバーがいません。（既に所属/対象外: {skipped} 人）",
+                    ephemeral=True,
+                )
+                return
+            await add_faction_members_bulk(
+                [m.id for m in to_invite], my_faction_id, "member", guild.id
+            )
+    except KeyBusy:
+        await interaction.followup.send(USER_BUSY_MESSAGE, ephemeral=True)
+        return
+    for m in to_invite:
+        log_event(guild.id, "faction.invite", actor_id=user.id, faction_id=my_faction_id, target_id=m.id, bulk=True)
+
+    progress_msg = await interaction.followup.send(
+        f"{len(to_invite)} 人を派閥 **{name}** に登録しました。ロールを付与中... (0/{len(to_invite)})",
         ephemeral=True,
+        wait=True,
+    )
+
+    async def on_progress(done: int, total: int):
+        await progress_msg.edit(
+            content=f"{total} 人を派閥 **{name}** に登録しました。ロールを付与中... ({done}/{total})"
+        )
+
+    _done, failed = await run_rate_limited_batch(
+        to_invite,
+        lambda m: m.add_roles(base_role, reason=f"派閥 {name} への一括招待"),
+        on_progress=on_progress,
+    )
+
+    summary = (
+        f"派閥 **{name}** に {len(to_invite)} 人を招待しました。\n"
+        f"・既に所属/対象外でスキップ: {skipped} 人"
     )
+    if failed:
+        summary += "\n・ロール付与に失敗: " + " ".join(m.mention for m in failed[:20])
+        if len(failed) > 20:
+            summary += f" ほか {len(failed) - 20} 人"
+    try:
+        await progress_msg.edit(content=summary)
+    except discord.HTTPException:
+        await interaction.followup.send(summary, ephemeral=True)
 
 
 @bot.tree.command(name="f_kick", description="派閥からメンバーを追放します")
 @app_commands.describe(member="追放するメンバー")
+@latency_guard
+@serialized_command(target="member", faction=True)
 async def faction_kick_cmd(interaction: discord.Interaction, member: discord.Member):
     guild = interaction.guild
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
-    my_faction_id, my_role = await get_faction_role(user.id, guild.id)
+    context = await storage.get_faction_context(user.id, guild.id, target_id=member.id)
+    my_faction_id, my_role, target_faction_id, _target_role, faction, _member_count = context
     if not my_faction_id or my_role not in ("leader", "officer"):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "このコマンドは派閥のリーダーまたは幹部のみ使用できます。",
             ephemeral=True,
         )
         return
 
-    target_faction_id = await get_user_faction_id(member.id, guild.id)
     if target_faction_id != my_faction_id:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "そのユーザーはあなたの派閥に所属していません。",
             ephemeral=True,
         )
         return
 
-    faction = await get_faction_by_id(my_faction_id)
     if not faction:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "派閥情報が見つかりません。",
             ephemeral=True,
         )
@@ -1055,7 +5379,8 @@ async def faction_kick_cmd(interaction: discord.Interaction, member: discord.Mem
     ) = faction
 
     if member.id == leader_id:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "リーダーは追放できません。",
             ephemeral=True,
         )
@@ -1072,8 +5397,10 @@ async def faction_kick_cmd(interaction: discord.Interaction, member: discord.Mem
     if roles_to_remove:
         await member.remove_roles(*roles_to_remove)
 
-    await remove_faction_member(member.id, my_faction_id)
-    await interaction.response.send_message(
+    await remove_faction_member(member.id, my_faction_id, guild.id)
+    log_event(guild.id, "faction.kick", actor_id=user.id, faction_id=my_faction_id, target_id=member.id)
+    await send_response(
+        interaction,
         f"{member.mention} を派閥 **{name}** から追放しました。",
         ephemeral=True,
     )
@@ -1081,6 +5408,8 @@ async def faction_kick_cmd(interaction: discord.Interaction, member: discord.Mem
 
 @bot.tree.command(name="f_promote", description="メンバーを幹部に昇格させます")
 @app_commands.describe(member="昇格させるメンバー")
+@latency_guard
+@serialized_command(target="member", faction=True)
 async def faction_promote_cmd(
     interaction: discord.Interaction,
     member: discord.Member,
@@ -1089,31 +5418,34 @@ async def faction_promote_cmd(
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
-    my_faction_id, my_role = await get_faction_role(user.id, guild.id)
+    context = await storage.get_faction_context(user.id, guild.id, target_id=member.id)
+    my_faction_id, my_role, target_faction_id, _target_role, faction, _member_count = context
     if not my_faction_id or my_role not in ("leader", "officer"):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "このコマンドは派閥のリーダーまたは幹部のみ使用できます。",
             ephemeral=True,
         )
         return
 
-    target_faction_id = await get_user_faction_id(member.id, guild.id)
     if target_faction_id != my_faction_id:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "そのユーザーはあなたの派閥に所属していません。",
             ephemeral=True,
         )
         return
 
-    faction = await get_faction_by_id(my_faction_id)
     if not faction:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "派閥情報が見つかりません。",
             ephemeral=True,
         )
@@ -1140,15 +5472,18 @@ async def faction_promote_cmd(
     officer_role = guild.get_role(officer_role_id)
     base_role = guild.get_role(base_role_id)
     if not officer_role or not base_role:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "派閥ロールが見つかりません。",
             ephemeral=True,
         )
         return
 
     await member.add_roles(base_role, officer_role)
-    await add_faction_member(member.id, my_faction_id, "officer")
-    await interaction.response.send_message(
+    await add_faction_member(member.id, my_faction_id, "officer", guild.id)
+    log_event(guild.id, "faction.promote", actor_id=user.id, faction_id=my_faction_id, target_id=member.id)
+    await send_response(
+        interaction,
         f"{member.mention} を派閥 **{name}** の幹部にしました。",
         ephemeral=True,
     )
@@ -1156,6 +5491,8 @@ async def faction_promote_cmd(
 
 @bot.tree.command(name="f_demote", description="幹部をメンバーに降格させます")
 @app_commands.describe(member="降格させるメンバー")
+@latency_guard
+@serialized_command(target="member", faction=True)
 async def faction_demote_cmd(
     interaction: discord.Interaction,
     member: discord.Member,
@@ -1164,31 +5501,34 @@ async def faction_demote_cmd(
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
-    my_faction_id, my_role = await get_faction_role(user.id, guild.id)
+    context = await storage.get_faction_context(user.id, guild.id, target_id=member.id)
+    my_faction_id, my_role, target_faction_id, _target_role, faction, _member_count = context
     if not my_faction_id or my_role not in ("leader", "officer"):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "このコマンドは派閥のリーダーまたは幹部のみ使用できます。",
             ephemeral=True,
         )
         return
 
-    target_faction_id = await get_user_faction_id(member.id, guild.id)
     if target_faction_id != my_faction_id:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "そのユーザーはあなたの派閥に所属していません。",
             ephemeral=True,
         )
         return
 
-    faction = await get_faction_by_id(my_faction_id)
     if not faction:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "派閥情報が見つかりません。",
             ephemeral=True,
         )
@@ -1215,36 +5555,42 @@ async def faction_demote_cmd(
     officer_role_obj = guild.get_role(officer_role_id)
     if officer_role_obj and officer_role_obj in member.roles:
         await member.remove_roles(officer_role_obj)
-    await add_faction_member(member.id, my_faction_id, "member")
-    await interaction.response.send_message(
+    await add_faction_member(member.id, my_faction_id, "member", guild.id)
+    log_event(guild.id, "faction.demote", actor_id=user.id, faction_id=my_faction_id, target_id=member.id)
+    await send_response(
+        interaction,
         f"{member.mention} を派閥 **{name}** の幹部から降格しました。",
         ephemeral=True,
     )
 
 
 @bot.tree.command(name="f_info", description="自分の所属している派閥情報を表示します")
+@latency_guard
 async def faction_info_cmd(interaction: discord.Interaction):
     guild = interaction.guild
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
-    faction_id, role = await get_faction_role(user.id, guild.id)
+    context = await storage.get_faction_context(user.id, guild.id)
+    faction_id, role, _target_faction_id, _target_role, faction, member_count = context
     if not faction_id:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "あなたはどの派閥にも所属していません。",
             ephemeral=True,
         )
         return
 
-    faction = await get_faction_by_id(faction_id)
     if not faction:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "派閥情報が見つかりません。",
             ephemeral=True,
         )
@@ -1268,23 +5614,14 @@ async def faction_info_cmd(interaction: discord.Interaction):
         is_open,
     ) = faction
 
-    leader = guild.get_member(leader_id)
-    leader_name = leader.display_name if leader else "不明"
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT COUNT(*) FROM faction_members WHERE faction_id = ?",
-            (faction_id,),
-        )
-        row = await cur.fetchone()
-        await cur.close()
-    member_count = row[0] if row else 0
+    leader_name = await resolve_member_name(guild, leader_id) or "不明"
 
     join_mode = (
         "オープン（誰でも /f_join で参加可能）" if is_open else "クローズ（招待制）"
     )
 
-    await interaction.response.send_message(
+    await send_response(
+        interaction,
         f"**{name}** の情報:\n"
         f"・リーダー: {leader_name}\n"
         f"・メンバー数: {member_count}\n"
@@ -1295,28 +5632,33 @@ async def faction_info_cmd(interaction: discord.Interaction):
 
 
 @bot.tree.command(name="f_leave", description="所属している派閥から脱退します")
+@latency_guard
+@serialized_command(faction=True)
 async def faction_leave_cmd(interaction: discord.Interaction):
     guild = interaction.guild
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
-    faction_id, role = await get_faction_role(user.id, guild.id)
+    context = await storage.get_faction_context(user.id, guild.id)
+    faction_id, role, _target_faction_id, _target_role, faction, _member_count = context
     if not faction_id:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "あなたはどの派閥にも所属していません。",
             ephemeral=True,
         )
         return
 
-    faction = await get_faction_by_id(faction_id)
     if not faction:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "派閥情報が見つかりません。",
             ephemeral=True,
         )
@@ -1341,7 +5683,8 @@ async def faction_leave_cmd(interaction: discord.Interaction):
     ) = faction
 
     if user.id == leader_id:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "リーダーは脱退できません。（解散機能を使ってください）",
             ephemeral=True,
         )
@@ -1357,8 +5700,10 @@ async def faction_leave_cmd(interaction: discord.Interaction):
     if roles_to_remove:
         await user.remove_roles(*roles_to_remove)
 
-    await remove_faction_member(user.id, faction_id)
-    await interaction.response.send_message(
+    await remove_faction_member(user.id, faction_id, guild.id)
+    log_event(guild.id, "faction.leave", actor_id=user.id, faction_id=faction_id)
+    await send_response(
+        interaction,
         f"派閥 **{name}** から脱退しました。",
         ephemeral=True,
     )
@@ -1369,22 +5714,119 @@ async def faction_leave_cmd(interaction: discord.Interaction):
     name="f_disband",
     description="所属している派閥を解散します（リーダー専用）",
 )
+@latency_guard
+@serialized_command(faction=True)
 async def faction_disband_cmd(interaction: discord.Interaction):
     guild = interaction.guild
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
-    await interaction.response.defer(ephemeral=True)
+    await defer_response(interaction)
     success, msg = await attempt_disband_faction(guild, user)
     await interaction.followup.send(msg, ephemeral=True)
 
 
+# ===================== 発言統計 =====================
+
+@bot.tree.command(name="f_stats", description="派閥とメンバーの発言数の推移を表示します")
+@app_commands.describe(
+    window="集計の単位（省略時は日別）",
+    faction_name="対象の派閥名（省略時は自分の派閥）",
+)
+@app_commands.choices(
+    window=[
+        app_commands.Choice(name="日別", value="day"),
+        app_commands.Choice(name="週別", value="week"),
+    ]
+)
+@latency_guard
+async def faction_stats_cmd(
+    interaction: discord.Interaction,
+    window: Optional[app_commands.Choice[str]] = None,
+    faction_name: Optional[str] = None,
+):
+    guild = interaction.guild
+    user = interaction.user
+
+    if guild is None or not isinstance(user, discord.Member):
+        await send_response(
+            interaction,
+            "サーバー内でのみ使用できます。",
+            ephemeral=True,
+        )
+        return
+
+    win = window.value if window else "day"
+    periods = ACTIVITY_STATS_PERIODS[win]
+    step = timedelta(days=1 if win == "day" else 7)
+    today = datetime.utcnow().date()
+    buckets = [activity_bucket(today - step * i, win) for i in reversed(range(periods))]
+    since = buckets[0]
+    label = f"直近{periods}日" if win == "day" else f"直近{periods}週"
+
+    # バッファに残っている直近の分は書き出さずにその場で足す（派閥は書き出し時と同じく現在の所属で数える）
+    pending = buffered_activity(guild.id, win, since)
+    index = await load_membership_index(guild.id) if pending else {}
+
+    if faction_name:
+        faction = await storage.get_faction_by_name(faction_name, guild.id)
+        if not faction:
+            await send_response(
+                interaction,
+                "その名前の派閥は見つかりません。",
+                ephemeral=True,
+            )
+            return
+        faction_id, name = faction[0], faction[1]
+    else:
+        context = await storage.get_faction_context(user.id, guild.id)
+        faction_id, _role, _target_fid, _target_role, faction, _member_count = context
+        name = faction[2] if faction else None
+
+    lines = []
+    if faction_id:
+        series = dict(await storage.activity_series(win, since, guild.id, faction_id=faction_id))
+        top = dict(await storage.top_activity(win, since, guild.id, faction_id=faction_id))
+        for (bucket, member_id), count in pending.items():
+            if index.get(member_id, (None,))[0] == faction_id:
+                series[bucket] = series.get(bucket, 0) + count
+                top[member_id] = top.get(member_id, 0) + count
+        top = sorted(top.items(), key=lambda item: (-item[1], item[0]))[:5]
+        lines.append(f"**{name}** の発言数（{label}）:")
+        lines += [f"・{bucket}: {series.get(bucket, 0)}" for bucket in buckets]
+        if top:
+            lines.append("よく発言しているメンバー:")
+            for rank, (member_id, count) in enumerate(top, 1):
+                member_name = await resolve_member_name(guild, member_id) or "不明"
+                lines.append(f"{rank}. {member_name}: {count}")
+    else:
+        top = dict(await storage.top_activity(win, since, guild.id))
+        for (_bucket, member_id), count in pending.items():
+            fid = index.get(member_id, (None,))[0]
+            if fid is not None:
+                top[fid] = top.get(fid, 0) + count
+        top = sorted(top.items(), key=lambda item: (-item[1], item[0]))[:5]
+        lines.append(f"発言数の多い派閥（{label}）:")
+        for rank, (fid, count) in enumerate(top, 1):
+            row = await storage.get_faction_by_id(fid, guild.id)
+            lines.append(f"{rank}. {row[2] if row else '不明'}: {count}")
+        if not top:
+            lines.append("まだ記録がありません。")
+
+    mine = await storage.activity_series(win, since, guild.id, user_id=user.id)
+    mine_total = sum(count for _bucket, count in mine)
+    mine_total += sum(count for (_bucket, member_id), count in pending.items() if member_id == user.id)
+    lines.append(f"あなたの発言数（{label}）: {mine_total}")
+    await send_response(interaction, "\n".join(lines), ephemeral=True)
+
+
 # ===================== 参加モード切替 & f_join =====================
 
 @bot.tree.command(
@@ -1397,6 +5839,8 @@ async def faction_disband_cmd(interaction: discord.Interaction):
         app_commands.Choice(name="クローズ（招待制）", value="close"),
     ]
 )
+@latency_guard
+@serialized_command(faction=True)
 async def faction_set_open_cmd(
     interaction: discord.Interaction,
     mode: app_commands.Choice[str],
@@ -1405,35 +5849,33 @@ async def faction_set_open_cmd(
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
-    faction_id, role = await get_faction_role(user.id, guild.id)
+    faction_id, role = await storage.get_faction_role(user.id, guild.id)
     if not faction_id or role not in ("leader", "officer"):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "このコマンドは派閥のリーダーまたは幹部のみ使用できます。",
             ephemeral=True,
         )
         return
 
     is_open = 1 if mode.value == "open" else 0
-
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE factions SET is_open = ? WHERE id = ?",
-            (is_open, faction_id),
-        )
-        await db.commit()
+    await storage.set_faction_open(faction_id, is_open, guild.id)
+    log_event(guild.id, "faction.set_open", actor_id=user.id, faction_id=faction_id, is_open=is_open)
 
     text = (
         "オープン（誰でも /f_join で参加可能）"
         if is_open
         else "クローズ（招待制）"
     )
-    await interaction.response.send_message(
+    await send_response(
+        interaction,
         f"あなたの派閥の参加モードを **{text}** に変更しました。",
         ephemeral=True,
     )
@@ -1441,6 +5883,8 @@ async def faction_set_open_cmd(
 
 @bot.tree.command(name="f_join", description="オープンな派閥に参加します")
 @app_commands.describe(faction_name="参加したい派閥名")
+@latency_guard
+@serialized_command()
 async def faction_join_cmd(
     interaction: discord.Interaction,
     faction_name: str,
@@ -1449,22 +5893,25 @@ async def faction_join_cmd(
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
-    if await get_user_faction_id(user.id, guild.id):
-        await interaction.response.send_message(
+    if await storage.get_user_faction_id(user.id, guild.id):
+        await send_response(
+            interaction,
             "すでにどこかの派閥に所属しています。",
             ephemeral=True,
         )
         return
 
-    faction = await get_faction_by_name(faction_name, guild.id)
+    faction = await storage.get_faction_by_name(faction_name, guild.id)
     if not faction:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "指定された派閥が見つかりません。",
             ephemeral=True,
         )
@@ -1488,14 +5935,16 @@ async def faction_join_cmd(
     ) = faction
 
     if destroyed:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "その派閥はすでに解体されています。",
             ephemeral=True,
         )
         return
 
     if not is_open:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "その派閥はクローズ状態です。参加には招待が必要です。",
             ephemeral=True,
         )
@@ -1503,15 +5952,18 @@ async def faction_join_cmd(
 
     base_role = guild.get_role(base_role_id)
     if not base_role:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "派閥ロールが見つかりません。管理者に連絡してください。",
             ephemeral=True,
         )
         return
 
     await user.add_roles(base_role)
-    await add_faction_member(user.id, faction_id, "member")
-    await interaction.response.send_message(
+    await add_faction_member(user.id, faction_id, "member", guild.id)
+    log_event(guild.id, "faction.join", actor_id=user.id, faction_id=faction_id)
+    await send_response(
+        interaction,
         f"派閥 **{name}** に参加しました！",
         ephemeral=True,
     )
@@ -1521,6 +5973,8 @@ async def faction_join_cmd(
 
 @bot.tree.command(name="f_war_start", description="他派閥に戦争を宣言します")
 @app_commands.describe(enemy_faction_name="戦争を仕掛ける相手派閥名")
+@latency_guard
+@serialized_command(faction=True, war=True)
 async def faction_war_start_cmd(
     interaction: discord.Interaction,
     enemy_faction_name: str,
@@ -1529,104 +5983,115 @@ async def faction_war_start_cmd(
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
-    if await get_active_war(guild.id):
-        await interaction.response.send_message(
+    if await storage.get_active_war(guild.id):
+        await send_response(
+            interaction,
             "既に他の戦争が進行中です。先に終了させてください。",
             ephemeral=True,
         )
         return
 
-    my_faction_id, my_role = await get_faction_role(user.id, guild.id)
+    context = await storage.get_faction_context(user.id, guild.id)
+    my_faction_id, my_role, _target_faction_id, _target_role, my_faction, _member_count = context
     if not my_faction_id or my_role not in ("leader", "officer"):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "このコマンドは派閥のリーダーまたは幹部のみ使用できます。",
             ephemeral=True,
         )
         return
 
-    my_faction = await get_faction_by_id(my_faction_id)
     if not my_faction:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "自派閥情報が見つかりません。",
             ephemeral=True,
         )
         return
 
-    enemy_faction = await get_faction_by_name(enemy_faction_name, guild.id)
+    enemy_faction = await storage.get_faction_by_name(enemy_faction_name, guild.id)
     if not enemy_faction:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "指定された派閥が見つかりません。",
             ephemeral=True,
         )
         return
 
     if enemy_faction[0] == my_faction_id:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "自分の派閥に戦争を宣言することはできません。",
             ephemeral=True,
         )
         return
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """
-            INSERT INTO wars (
-                guild_id, attacker_faction_id, defender_faction_id,
-                active, attacker_messages, defender_messages
-            )
-            VALUES (?, ?, ?, 1, 0, 0)
-            """,
-            (guild.id, my_faction_id, enemy_faction[0]),
-        )
-        await db.commit()
+    war_id = await storage.start_war(my_faction_id, enemy_faction[0], guild.id)
+    await rebuild_war_participants(guild.id)
+    log_event(
+        guild.id,
+        "war.start",
+        actor_id=user.id,
+        faction_id=my_faction_id,
+        target_id=enemy_faction[0],
+        war_id=war_id,
+    )
 
     attacker_name = my_faction[2]
     defender_name = enemy_faction[1]
 
-    await interaction.response.send_message(
+    await send_response(
+        interaction,
         f"派閥 **{attacker_name}** が **{defender_name}** に戦争を宣言しました！",
         ephemeral=True,
     )
 
     war_channel = await get_war_status_channel(guild)
     if war_channel:
-        await war_channel.send(
+        outbox_send(
+            war_channel,
             "⚔️ **戦争開始**\n"
             f"攻撃側: **{attacker_name}**\n"
             f"防衛側: **{defender_name}**\n"
-            "ここに戦争状況が通知されます。",
+            "ピン留めしたスコアボードで戦争状況を確認できます。",
         )
+        start_scoreboard(guild.id, war_id, war_channel, attacker_name, defender_name)
 
 
 @bot.tree.command(name="f_war_status", description="現在の戦争状況を表示します")
+@latency_guard
 async def faction_war_status_cmd(interaction: discord.Interaction):
     guild = interaction.guild
     if guild is None:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
-    war = await get_active_war(guild.id)
+    war = await storage.get_active_war(guild.id)
     if not war:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "現在進行中の戦争はありません。",
             ephemeral=True,
         )
         return
 
     war_id, attacker_id, defender_id, attacker_msgs, defender_msgs = war
-    attacker = await get_faction_by_id(attacker_id)
-    defender = await get_faction_by_id(defender_id)
+    attacker = await storage.get_faction_by_id(attacker_id, guild.id)
+    defender = await storage.get_faction_by_id(defender_id, guild.id)
     if not attacker or not defender:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "戦争情報の取得に失敗しました。",
             ephemeral=True,
         )
@@ -1637,49 +6102,54 @@ async def faction_war_status_cmd(interaction: discord.Interaction):
         f"・攻撃側 **{attacker[2]}** メッセージ数: {attacker_msgs}\n"
         f"・防衛側 **{defender[2]}** メッセージ数: {defender_msgs}"
     )
+    # 戦争チャンネルには投稿せず、編集され続けるスコアボードへのリンクを返す
+    url = scoreboard_url(guild.id)
+    if url:
+        msg += f"\nスコアボード: {url}"
 
-    await interaction.response.send_message(msg, ephemeral=True)
-
-    war_channel = await get_war_status_channel(guild)
-    if war_channel:
-        await war_channel.send("📊 " + msg)
+    await send_response(interaction, msg, ephemeral=True)
 
 
 @bot.tree.command(
     name="f_war_end",
     description="進行中の戦争を終了し、勝敗を確定します（管理者専用）",
 )
+@latency_guard
+@serialized_command(war=True)
 async def faction_war_end_cmd(interaction: discord.Interaction):
     guild = interaction.guild
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
     if not user.guild_permissions.administrator:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "このコマンドはサーバー管理者のみが実行できます。",
             ephemeral=True,
         )
         return
 
-    war = await get_active_war(guild.id)
+    war = await storage.get_active_war(guild.id)
     if not war:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "現在進行中の戦争はありません。",
             ephemeral=True,
         )
         return
 
-    await interaction.response.defer(ephemeral=True)
+    await defer_response(interaction)
 
     war_id, attacker_id, defender_id, attacker_msgs, defender_msgs = war
-    attacker = await get_faction_by_id(attacker_id)
-    defender = await get_faction_by_id(defender_id)
+    attacker = await storage.get_faction_by_id(attacker_id, guild.id)
+    defender = await storage.get_faction_by_id(defender_id, guild.id)
     if not attacker or not defender:
         await interaction.followup.send(
             "戦争情報の取得に失敗しました。",
@@ -1695,25 +6165,44 @@ async def faction_war_end_cmd(interaction: discord.Interaction):
         winner, loser = defender, attacker
         winner_msgs, loser_msgs = defender_msgs, attacker_msgs
     else:
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE wars SET active = 0 WHERE id = ?", (war_id,))
-            await db.commit()
+        await storage.end_war(war_id, guild.id)
+        await rebuild_war_participants(guild.id)
+        log_event(
+            guild.id,
+            "war.end",
+            actor_id=user.id,
+            war_id=war_id,
+            result="draw",
+            attacker_messages=attacker_msgs,
+            defender_messages=defender_msgs,
+        )
         msg = (
             "戦争は引き分けです。\n"
             f"攻撃側 **{attacker[2]}**: {attacker_msgs} メッセージ\n"
             f"防衛側 **{defender[2]}**: {defender_msgs} メッセージ"
         )
         await interaction.followup.send(msg, ephemeral=True)
+        finish_scoreboard(guild.id, (attacker_msgs, defender_msgs), "結果: 引き分け")
         war_channel = await get_war_status_channel(guild)
         if war_channel:
-            await war_channel.send("⚪ " + msg)
+            outbox_send(war_channel, "⚪ " + msg)
         return
 
     await destroy_faction(guild, loser)
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE wars SET active = 0 WHERE id = ?", (war_id,))
-        await db.commit()
+    await storage.end_war(war_id, guild.id)
+    await rebuild_war_participants(guild.id)
+    log_event(
+        guild.id,
+        "war.end",
+        actor_id=user.id,
+        faction_id=winner[0],
+        target_id=loser[0],
+        war_id=war_id,
+        result="win",
+        winner_messages=winner_msgs,
+        loser_messages=loser_msgs,
+    )
 
     msg = (
         "戦争終了！\n"
@@ -1722,10 +6211,15 @@ async def faction_war_end_cmd(interaction: discord.Interaction):
         f"敗北派閥 **{loser[2]}** は解体されました。"
     )
     await interaction.followup.send(msg, ephemeral=True)
+    finish_scoreboard(
+        guild.id,
+        (attacker_msgs, defender_msgs),
+        f"結果: **{winner[2]}** の勝利（**{loser[2]}** は解体）",
+    )
 
     war_channel = await get_war_status_channel(guild)
     if war_channel:
-        await war_channel.send("🏁 " + msg)
+        outbox_send(war_channel, "🏁 " + msg)
 
 
 # ===================== 全体チャンネルセットアップ =====================
@@ -1734,25 +6228,28 @@ async def faction_war_end_cmd(interaction: discord.Interaction):
     name="setup_global",
     description="全体雑談・全体VCなどをまとめて作成します（管理者専用）",
 )
+@latency_guard
 async def setup_global_cmd(interaction: discord.Interaction):
     guild = interaction.guild
     user = interaction.user
 
     if guild is None or not isinstance(user, discord.Member):
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "サーバー内でのみ使用できます。",
             ephemeral=True,
         )
         return
 
     if not user.guild_permissions.administrator:
-        await interaction.response.send_message(
+        await send_response(
+            interaction,
             "このコマンドはサーバー管理者のみが実行できます。",
             ephemeral=True,
         )
         return
 
-    await interaction.response.defer(ephemeral=True)
+    await defer_response(interaction)
 
     category: discord.CategoryChannel = await guild.create_category("全体")
 
@@ -1782,6 +6279,302 @@ async def setup_global_cmd(interaction: discord.Interaction):
     )
 
 
+# ===================== 管理コマンド =====================
+
+@bot.tree.command(
+    name="backup_now",
+    description="データベースのスナップショットを今すぐ作成します（ボット所有者専用）",
+)
+@latency_guard
+async def backup_now_cmd(interaction: discord.Interaction):
+    # バックアップは全サーバー共通で世代数も共有なので、ボット所有者に限定する
+    if not await bot.is_owner(interaction.user):
+        await send_response(
+            interaction,
+            "このコマンドはボット所有者のみが実行できます。",
+            ephemeral=True,
+        )
+        return
+
+    if not isinstance(storage, SQLiteStorage):
+        await send_response(
+            interaction,
+            "このストレージ設定ではバックアップを作成できません。",
+            ephemeral=True,
+        )
+        return
+
+    if backup_lock.locked():
+        await send_response(
+            interaction,
+            "バックアップは既に実行中です。",
+            ephemeral=True,
+        )
+        return
+
+    await defer_response(interaction)
+    try:
+        path, elapsed = await run_backup()
+    except Exception as e:
+        await interaction.followup.send(f"バックアップに失敗しました: {e}", ephemeral=True)
+        return
+
+    await interaction.followup.send(
+        f"スナップショットを作成しました: `{os.path.basename(path)}` （{elapsed:.1f} 秒）",
+        ephemeral=True,
+    )
+
+
+@bot.tree.command(
+    name="settings",
+    description="このサーバーの経済設定を表示・変更します（管理者専用）",
+)
+@app_commands.describe(
+    faction_create_cost="派閥作成コスト",
+    message_reward="1メッセージあたりの報酬コイン",
+    reward_cooldown_seconds="報酬のクールダウン（秒）",
+    war_status_channel="戦争状況を通知するチャンネル",
+)
+@latency_guard
+async def settings_cmd(
+    interaction: discord.Interaction,
+    faction_create_cost: Optional[app_commands.Range[int, 0, 10_000_000]] = None,
+    message_reward: Optional[app_commands.Range[int, 0, 1000]] = None,
+    reward_cooldown_seconds: Optional[app_commands.Range[int, 0, 86400]] = None,
+    war_status_channel: Optional[discord.TextChannel] = None,
+):
+    guild = interaction.guild
+    user = interaction.user
+    if guild is None or not isinstance(user, discord.Member):
+        await send_response(
+            interaction,
+            "サーバー内でのみ使用できます。",
+            ephemeral=True,
+        )
+        return
+
+    if not user.guild_permissions.administrator:
+        await send_response(
+            interaction,
+            "このコマンドはサーバー管理者のみが実行できます。",
+            ephemeral=True,
+        )
+        return
+
+    changes = {
+        key: value
+        for key, value in (
+            ("faction_create_cost", faction_create_cost),
+            ("message_reward", message_reward),
+            ("reward_cooldown_seconds", reward_cooldown_seconds),
+            ("war_status_channel_id", war_status_channel.id if war_status_channel else None),
+        )
+        if value is not None
+    }
+    if changes:
+        await update_guild_settings(guild.id, **changes)
+        log_event(guild.id, "settings.update", actor_id=user.id, **changes)
+
+    settings = get_guild_settings(guild.id)
+    channel_id = settings["war_status_channel_id"]
+    await send_response(
+        interaction,
+        ("設定を更新しました。\n" if changes else "")
+        + "現在の設定:\n"
+        f"・派閥作成コスト: {settings['faction_create_cost']} コイン\n"
+        f"・メッセージ報酬: {settings['message_reward']} コイン\n"
+        f"・報酬クールダウン: {settings['reward_cooldown_seconds']} 秒\n"
+        f"・戦争状況チャンネル: {f'<#{channel_id}>' if channel_id else '未設定'}",
+        ephemeral=True,
+    )
+
+
+@bot.tree.command(
+    name="eco_job",
+    description="定期経済ジョブ（利息・減衰・シーズンリセット）の確認と設定（ボット所有者専用）",
+)
+@app_commands.describe(
+    action="操作",
+    job="対象ジョブ名（interest / decay / season_reset）",
+    rate="割合（0.01 = 1%）",
+    min_balance="対象となる残高の下限",
+    interval_hours="実行間隔（時間）",
+)
+@app_commands.choices(
+    action=[
+        app_commands.Choice(name="一覧", value="list"),
+        app_commands.Choice(name="有効化", value="enable"),
+        app_commands.Choice(name="無効化", value="disable"),
+        app_commands.Choice(name="設定変更", value="set"),
+        app_commands.Choice(name="今すぐ実行", value="run"),
+        app_commands.Choice(name="実行履歴", value="history"),
+    ]
+)
+@latency_guard
+async def eco_job_cmd(
+    interaction: discord.Interaction,
+    action: app_commands.Choice[str],
+    job: Optional[str] = None,
+    rate: Optional[app_commands.Range[float, 0.0, 1.0]] = None,
+    min_balance: Optional[app_commands.Range[int, 0]] = None,
+    interval_hours: Optional[app_commands.Range[float, 0.1]] = None,
+):
+    # users は全サーバー共通なので、サーバー管理者ではなくボット所有者に限定する
+    if not await bot.is_owner(interaction.user):
+        await send_response(
+            interaction,
+            "このコマンドはボット所有者のみが実行できます。",
+            ephemeral=True,
+        )
+        return
+
+    if not isinstance(storage, SQLiteStorage):
+        await send_response(
+            interaction,
+            "このストレージ設定では経済ジョブを使用できません。",
+            ephemeral=True,
+        )
+        return
+
+    jobs = {row[0]: row for row in await get_economy_jobs()}
+    if action.value == "list":
+        lines = ["定期経済ジョブ:"]
+        for name, kind, j_rate, j_min, j_interval, enabled, last_run_at in jobs.values():
+            last = f"<t:{last_run_at}:R>" if last_run_at else "未実行"
+            lines.append(
+                f"・`{name}` ({kind}) {'有効' if enabled else '無効'} / "
+                f"rate={j_rate} min={j_min} 間隔={j_interval}h / 前回: {last}"
+            )
+        await send_response(interaction, "\n".join(lines), ephemeral=True)
+        return
+
+    if job not in jobs:
+        await send_response(
+            interaction,
+            f"ジョブ名を指定してください: {', '.join(jobs)}",
+            ephemeral=True,
+        )
+        return
+
+    if action.value in ("enable", "disable", "set"):
+        await update_economy_job(
+            job,
+            enabled=None if action.value == "set" else int(action.value == "enable"),
+            rate=rate,
+            min_balance=min_balance,
+            interval_hours=interval_hours,
+        )
+        await send_response(interaction, f"ジョブ `{job}` を更新しました。", ephemeral=True)
+        return
+
+    if action.value == "history":
+        runs = await get_economy_job_runs(job)
+        if not runs:
+            await send_response(interaction, "実行履歴はありません。", ephemeral=True)
+            return
+        lines = [f"`{job}` の実行履歴:"]
+        for started_at, duration_ms, rows_affected, status, error in runs:
+            line = f"・<t:{started_at}:f> {status} {rows_affected} 行 / {duration_ms} ms"
+            if error:
+                line += f" ({error[:100]})"
+            lines.append(line)
+        await send_response(interaction, "\n".join(lines), ephemeral=True)
+        return
+
+    await defer_response(interaction)
+    try:
+        affected, duration_ms = await run_economy_job(job)
+    except Exception as e:
+        await send_response(interaction, f"ジョブの実行に失敗しました: {e}", ephemeral=True)
+        return
+    await send_response(
+        interaction,
+        f"ジョブ `{job}` を実行しました。（{affected} 行 / {duration_ms} ms）",
+        ephemeral=True,
+    )
+
+
+@bot.tree.command(
+    name="audit_log",
+    description="派閥・戦争・コイン付与の履歴を表示します（管理者専用）",
+)
+@app_commands.describe(
+    user="このユーザーが実行者/対象のものに絞る",
+    faction_name="この派閥のものに絞る",
+    limit="表示件数（最大50）",
+)
+@latency_guard
+async def audit_log_cmd(
+    interaction: discord.Interaction,
+    user: Optional[discord.Member] = None,
+    faction_name: Optional[str] = None,
+    limit: app_commands.Range[int, 1, 50] = 20,
+):
+    guild = interaction.guild
+    caller = interaction.user
+    if guild is None or not isinstance(caller, discord.Member):
+        await send_response(
+            interaction,
+            "サーバー内でのみ使用できます。",
+            ephemeral=True,
+        )
+        return
+
+    if not caller.guild_permissions.administrator:
+        await send_response(
+            interaction,
+            "このコマンドはサーバー管理者のみが実行できます。",
+            ephemeral=True,
+        )
+        return
+
+    faction_id = None
+    if faction_name:
+        faction = await storage.get_faction_by_name(faction_name, guild.id)
+        if not faction:
+            await send_response(
+                interaction,
+                "指定された派閥が見つかりません。",
+                ephemeral=True,
+            )
+            return
+        faction_id = faction[0]
+
+    rows = await query_audit_events(
+        guild.id,
+        user_id=user.id if user else None,
+        faction_id=faction_id,
+        limit=limit,
+    )
+    if not rows:
+        await send_response(
+            interaction,
+            "該当する履歴はありません。",
+            ephemeral=True,
+        )
+        return
+
+    lines = []
+    for _id, fid, actor_id, action, target_id, payload, created_at in rows:
+        line = f"<t:{created_at}:f> `{action}`"
+        if actor_id:
+            line += f" 実行: <@{actor_id}>"
+        if target_id and not action.startswith("war."):
+            line += f" 対象: <@{target_id}>"
+        if fid:
+            line += f" 派閥ID: {fid}"
+        if payload:
+            line += f" {payload}"
+        lines.append(line[:300])
+
+    await send_response(
+        interaction,
+        "\n".join(lines)[:1900],
+        ephemeral=True,
+        allowed_mentions=discord.AllowedMentions.none(),
+    )
+
+
 # ===================== 実行部 =====================
 
 def main():
@@ -1791,6 +6584,372 @@ def main():
     bot.run(token)
 
 
-if __name__ == "__main__":
-    keep_alive()
+# ===================== クラスタ起動 =====================
+
+# コーディネーター側の状態: worker_id -> 情報
+cluster_workers: dict[int, dict] = {}
+
+
+async def cluster_heartbeat_loop():
+    """ワーカー内: 生存通知と自分のメトリクスを定期的にコーディネーターへ送る"""
+    while not bot.is_closed():
+        set_metric("guilds", len(bot.guilds))
+        set_metric("memory.rss_mb_max", round(current_rss_mb(), 1))
+        latency = bot.latency
+        set_metric("latency_ms_max", round(latency * 1000, 1) if math.isfinite(latency) else 0)
+        try:
+            cluster_status_queue.put_nowait(
+                (cluster_worker_id, time.time(), bot.is_ready(), dict(metrics))
+            )
+        except Exception as e:
+            print(f"[worker {cluster_worker_id}] heartbeat failed: {e}")
+        await asyncio.sleep(CLUSTER_HEARTBEAT_INTERVAL)
+
+
+def split_shard_ranges(shard_count: int, worker_count: int) -> list[list[int]]:
+    """シャード 0..shard_count-1 をワーカー数で連続区間に分割する"""
+    worker_count = max(1, min(worker_count, shard_count))
+    base, extra = divmod(shard_count, worker_count)
+    ranges = []
+    start = 0
+    for i in range(worker_count):
+        size = base + (1 if i < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+def cluster_worker_main(worker_id: int, shard_ids: list[int], shard_count: int, status_queue):
+    """ワーカープロセスのエントリポイント（fork 後に呼ばれる）"""
+    global cluster_worker_id, cluster_status_queue
+    cluster_worker_id = worker_id
+    cluster_status_queue = status_queue
+    # 停止シグナルは setup_hook で登録するハンドラが受けて close() を通して終了する
+    # （それまでは書き出すものが無いので既定動作のまま即終了してよい）
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    metrics.clear()
+    bot.shard_ids = shard_ids
+    bot.shard_count = shard_count
+    print(f"[worker {worker_id}] shards {shard_ids[0]}..{shard_ids[-1]} / {shard_count}")
     main()
+
+
+def aggregate_cluster_metrics() -> dict:
+    """全ワーカーのメトリクスを集計する（"_max" は最大値、それ以外は合計）"""
+    total: dict[str, float] = {}
+    workers = {}
+    now = time.time()
+    for worker_id, info in list(cluster_workers.items()):
+        for name, value in info["metrics"].items():
+            if name.endswith("_max"):
+                total[name] = max(total.get(name, value), value)
+            else:
+                total[name] = total.get(name, 0) + value
+        workers[worker_id] = {
+            "shards": f"{info['shard_ids'][0]}-{info['shard_ids'][-1]}",
+            "alive": info["process"].is_alive(),
+            "ready": info["ready"],
+            "restarts": info["restarts"],
+            "last_heartbeat_age": round(now - info["last_seen"], 1),
+        }
+    return {"workers": workers, "total": total}
+
+
+def run_cluster(worker_count: int, shard_count: Optional[int] = None):
+    """シャード範囲ごとにワーカープロセスを fork し、生存監視・再起動を行う"""
+    if not os.getenv("DISCORD_TOKEN", "").strip():
+        raise RuntimeError("環境変数 DISCORD_TOKEN にボットトークンを設定してください。")
+
+    shard_count = shard_count or worker_count
+    ctx = multiprocessing.get_context("fork")
+    status_queue = ctx.Queue()
+
+    # スキーマ作成はワーカー起動前に一度だけ済ませておく
+    asyncio.run(init_db())
+
+    def spawn(worker_id: int, shard_ids: list[int]):
+        proc = ctx.Process(
+            target=cluster_worker_main,
+            args=(worker_id, shard_ids, shard_count, status_queue),
+            name=f"faction-bot-worker-{worker_id}",
+            daemon=False,
+        )
+        proc.start()
+        return proc
+
+    for worker_id, shard_ids in enumerate(split_shard_ranges(shard_count, worker_count)):
+        cluster_workers[worker_id] = {
+            "shard_ids": shard_ids,
+            "process": spawn(worker_id, shard_ids),
+            "last_seen": time.time(),
+            "ready": False,
+            "metrics": {},
+            "restarts": 0,
+            "failures": 0,  # 連続失敗回数（バックオフ用。安定して動けば 0 に戻す）
+            "started_at": time.time(),
+            "next_restart_at": 0.0,
+        }
+
+    stopping = False
+
+    def handle_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    print(f"Cluster started: {len(cluster_workers)} worker(s), {shard_count} shard(s).")
+    while not stopping:
+        # ハートビートを取り込む
+        deadline = time.time() + 1.0
+        while time.time() < deadline:
+            try:
+                worker_id, seen_at, ready, worker_metrics = status_queue.get(timeout=0.2)
+            except Exception:
+                continue
+            info = cluster_workers.get(worker_id)
+            if info is not None:
+                info["last_seen"] = seen_at
+                info["ready"] = ready
+                info["metrics"] = worker_metrics
+
+        # 死活確認と再起動（連続失敗時は指数バックオフ）
+        now = time.time()
+        for worker_id, info in cluster_workers.items():
+            proc = info["process"]
+            stale = now - info["last_seen"] > CLUSTER_HEARTBEAT_TIMEOUT
+            if proc.is_alive() and not stale:
+                if info["failures"] and now - info["started_at"] >= CLUSTER_STABLE_SECONDS:
+                    info["failures"] = 0
+                continue
+            if info["next_restart_at"] == 0.0:
+                reason = "exited" if not proc.is_alive() else "heartbeat timeout"
+                print(f"[cluster] worker {worker_id} {reason}, restarting.")
+                if proc.is_alive():
+                    proc.terminate()
+                backoff = min(CLUSTER_RESTART_BACKOFF_MAX, 2 ** min(info["failures"], 6))
+                info["next_restart_at"] = now + backoff
+            elif now >= info["next_restart_at"]:
+                if proc.is_alive():
+                    proc.kill()
+                proc.join(timeout=5)
+                info["process"] = spawn(worker_id, info["shard_ids"])
+                info["restarts"] += 1
+                info["failures"] += 1
+                info["started_at"] = info["last_seen"] = time.time()
+                info["ready"] = False
+                info["next_restart_at"] = 0.0
+
+    print("[cluster] stopping workers...")
+    for info in cluster_workers.values():
+        if info["process"].is_alive():
+            info["process"].terminate()
+    for info in cluster_workers.values():
+        info["process"].join(timeout=30)
+
+
+# ===================== データのインポート/エクスポート =====================
+
+TRANSFER_TABLES = ("users", "factions", "faction_members", "wars")
+TRANSFER_CHUNK_SIZE = 5000
+
+
+def detect_transfer_format(path: str, fmt: Optional[str]) -> str:
+    if fmt:
+        return fmt
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+
+async def get_table_columns(db: aiosqlite.Connection, table: str) -> list[str]:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    rows = await cur.fetchall()
+    await cur.close()
+    return [r[1] for r in rows]
+
+
+def transfer_partition(table: str, guild_id: Optional[int]) -> Optional[int]:
+    """テーブルの置き場所を返す。partitioned モードのギルド単位テーブルはギルド指定が必須。"""
+    if table not in GUILD_TABLES:
+        return None
+    if is_partitioned() and guild_id is None:
+        raise ValueError(f"{table} is stored per guild; pass --guild")
+    return guild_id
+
+
+async def export_table(
+    table: str,
+    path: str,
+    fmt: Optional[str] = None,
+    chunk_size: int = TRANSFER_CHUNK_SIZE,
+    guild_id: Optional[int] = None,
+) -> int:
+    """テーブルをチャンク単位で読みながら JSONL/CSV に書き出す"""
+    if table not in TRANSFER_TABLES:
+        raise ValueError(f"unknown table: {table}")
+    fmt = detect_transfer_format(path, fmt)
+
+    count = 0
+    async with open_db(transfer_partition(table, guild_id), cached=False) as db:
+        columns = await get_table_columns(db, table)
+        cur = await db.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f) if fmt == "csv" else None
+            if writer is not None:
+                writer.writerow(columns)
+            while True:
+                rows = await cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                if writer is not None:
+                    writer.writerows(["" if v is None else v for v in row] for row in rows)
+                else:
+                    for row in rows:
+                        f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                        f.write("\n")
+                count += len(rows)
+        await cur.close()
+    return count
+
+
+def iter_import_records(path: str, fmt: str):
+    """ファイルを1行ずつ読み、dict を順に返す（全体をメモリに載せない）"""
+    with open(path, encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            for rec in csv.DictReader(f):
+                yield {k: (None if v == "" else v) for k, v in rec.items()}
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+async def import_table(
+    table: str,
+    path: str,
+    fmt: Optional[str] = None,
+    chunk_size: int = TRANSFER_CHUNK_SIZE,
+    guild_id: Optional[int] = None,
+) -> int:
+    """JSONL/CSV をチャンクごとに executemany で取り込む（同じ主キーは上書き）"""
+    if table not in TRANSFER_TABLES:
+        raise ValueError(f"unknown table: {table}")
+    fmt = detect_transfer_format(path, fmt)
+
+    count = 0
+    async with open_db(transfer_partition(table, guild_id), cached=False) as db:
+        table_columns = set(await get_table_columns(db, table))
+        columns: Optional[list[str]] = None
+        sql = ""
+        batch: list[tuple] = []
+
+        async def flush():
+            nonlocal count, batch
+            if batch:
+                await db.executemany(sql, batch)
+                await db.commit()
+                count += len(batch)
+                batch = []
+
+        for rec in iter_import_records(path, fmt):
+            if columns is None:
+                # 最初のレコードのキーで列を確定する（未知の列は無視）
+                columns = [c for c in rec if c in table_columns]
+                if not columns:
+                    raise ValueError(f"no known columns for {table} in {path}")
+                placeholders = ", ".join("?" for _ in columns)
+                sql = f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+            batch.append(tuple(rec.get(c) for c in columns))
+            if len(batch) >= chunk_size:
+                await flush()
+        await flush()
+    return count
+
+
+# ===================== CLI =====================
+
+def cli():
+    global DB_PATH, GUILD_DB_DIR, storage
+    parser = argparse.ArgumentParser(description="派閥ボット")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("run", help="単一プロセスで起動（既定）")
+    p_cluster = sub.add_parser("cluster", help="シャード範囲ごとに複数プロセスで起動")
+    p_cluster.add_argument("--workers", type=int, default=CLUSTER_WORKERS)
+    p_cluster.add_argument(
+        "--shards",
+        type=int,
+        default=int(os.getenv("SHARD_COUNT", "0")) or None,
+        help="総シャード数（省略時はワーカー数と同じ）",
+    )
+    for name, help_text in (
+        ("export", "テーブルを JSONL/CSV に書き出す"),
+        ("import", "JSONL/CSV をテーブルに取り込む（稼働中のボットのキャッシュには反映されません）"),
+    ):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("table", choices=TRANSFER_TABLES)
+        p.add_argument("path")
+        p.add_argument("--format", choices=("jsonl", "csv"), default=None, help="省略時は拡張子で判定")
+        p.add_argument("--chunk-size", type=int, default=TRANSFER_CHUNK_SIZE)
+        p.add_argument("--db", default=DB_PATH)
+        p.add_argument("--guild", type=int, default=None, help="STORAGE_MODE=partitioned で派閥・戦争などを扱うときのギルドID")
+    p_migrate = sub.add_parser("migrate-partitions", help="既存DBの派閥・戦争・設定をギルド別DBに分割する")
+    p_migrate.add_argument("--db", default=DB_PATH)
+    p_migrate.add_argument("--out", default=GUILD_DB_DIR, help="ギルド別DBの出力先ディレクトリ")
+    p_stress = sub.add_parser("stress-pay", help="送金の並行ストレステスト（残高の保存を検証）")
+    p_stress.add_argument("--users", type=int, default=50)
+    p_stress.add_argument("--transfers", type=int, default=5000)
+    p_stress.add_argument("--concurrency", type=int, default=200)
+    p_stress.add_argument("--db", default=None, help="省略時は一時ファイル（指定したDBの user_id 1..users は上書きされます）")
+    p_stress.add_argument(
+        "--backend",
+        choices=tuple(STORAGE_BACKENDS),
+        default=STORAGE_BACKEND,
+        help="memory にするとストレージを除いた処理だけの速度を測れる",
+    )
+    args = parser.parse_args()
+
+    if args.command == "stress-pay":
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tmp:
+            DB_PATH = args.db or os.path.join(tmp, "stress.db")
+            storage = STORAGE_BACKENDS[args.backend]()
+            asyncio.run(init_db())
+            ok = asyncio.run(stress_test_transfers(args.users, args.transfers, args.concurrency))
+        sys.exit(0 if ok else 1)
+    elif args.command in ("export", "import"):
+        DB_PATH = args.db
+        asyncio.run(init_db())
+        started = time.perf_counter()
+        func = export_table if args.command == "export" else import_table
+        count = asyncio.run(func(args.table, args.path, args.format, args.chunk_size, args.guild))
+        if args.command == "import":
+            # 取り込んだ行は実行中ボットのキャッシュに無いので、次回起動は DB から読み直させる
+            asyncio.run(invalidate_snapshots())
+        elapsed = time.perf_counter() - started
+        print(f"{args.command} {args.table}: {count} rows in {elapsed:.1f}s", file=sys.stderr)
+    elif args.command == "migrate-partitions":
+        GUILD_DB_DIR = args.out
+        started = time.perf_counter()
+        copied = asyncio.run(migrate_to_partitions(args.db))
+        elapsed = time.perf_counter() - started
+        print(
+            f"migrated {len(copied)} guild(s), {sum(copied.values())} rows in {elapsed:.1f}s -> {GUILD_DB_DIR}",
+            file=sys.stderr,
+        )
+        print(
+            f"{args.db} is unchanged; start with STORAGE_MODE=partitioned GUILD_DB_DIR={GUILD_DB_DIR}",
+            file=sys.stderr,
+        )
+    elif args.command == "cluster":
+        keep_alive()
+        run_cluster(args.workers, args.shards)
+    else:
+        keep_alive()
+        main()
+
+
+if __name__ == "__main__":
+    cli()